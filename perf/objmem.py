@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Measure the memory and time it takes to parse and keep a stack log's
+# worth of commits. Run it in a git repository (the commits are made
+# up, so any repository will do):
+#
+#   python perf/objmem.py [number of commits]
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import sys
+import time
+import tracemalloc
+
+from stgit.lib import git
+
+
+def raw_commit(i):
+    # Like the commits of a stack of 500 patches refreshed over and
+    # over: the author dates repeat, the committer dates don't.
+    return ('tree %040x\n'
+            'parent %040x\n'
+            'author A U Thor <author@example.com> %d +0100\n'
+            'committer C O Mitter <committer@example.com> %d +0200\n'
+            '\n'
+            'patch %d\n' % (i, i + 1, 1500000000 + i % 500,
+                            1600000000 + i, i % 500))
+
+
+def parse(raws):
+    repository = git.Repository.default()
+    return [git.CommitData.parse(repository, s) for s in raws]
+
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+raws = [raw_commit(i) for i in range(n)]
+start = time.time()
+parse(raws)
+elapsed = time.time() - start
+tracemalloc.start()
+commits = parse(raws)
+current, peak = tracemalloc.get_traced_memory()
+print('%d commits: %.1f MiB (peak %.1f MiB), %.3f s'
+      % (n, current / 2 ** 20, peak / 2 ** 20, elapsed))
@@ -8,6 +8,8 @@ from __future__ import (
     unicode_literals,
 )
 
+import os
+
 from stgit.compat import environ_get
 from stgit.run import Run, RunException
 
@@ -30,6 +32,74 @@ along with this program; if not, see http://www.gnu.org/licenses/.
 # GIT_DIR value cached
 __base_dir = None
 
+# The Discovery objects made so far
+__discoveries = []
+
+
+class Discovery(object):
+    """Where the repository and the worktree of a directory are, what
+    the directory is in, and what C{HEAD} is. The paths are absolute,
+    so they stay good if we change directory; C{top_dir} is C{None}
+    when the directory isn't in a worktree. C{head} is the full ref
+    name, C{HEAD} if it is detached, or C{None} if we don't know."""
+
+    __slots__ = ('cwd', 'env', 'git_dir', 'inside_git_dir',
+                 'inside_work_tree', 'top_dir', 'head')
+
+    def __init__(self, cwd, env, lines, head_ok):
+        self.cwd = cwd
+        self.env = env
+        self.git_dir = os.path.abspath(lines[0])
+        self.inside_git_dir = lines[1] == 'true'
+        self.inside_work_tree = lines[2] == 'true'
+        if self.inside_work_tree:
+            cdup = lines[3] if len(lines) > 3 else ''
+            self.top_dir = os.path.abspath(cdup or '.')
+            lines = lines[4:]
+        else:
+            self.top_dir = None
+            lines = lines[3:]
+        head = lines[0] if head_ok and lines else None
+        if head and not head.startswith('refs/'):
+            # Inside the git dir, git rev-parse takes an unborn HEAD
+            # for the file of that name and echoes it back, so only
+            # trust a detached HEAD outside of it.
+            if head != 'HEAD' or self.inside_git_dir:
+                head = None
+        self.head = head
+
+
+def discover():
+    """Return the L{Discovery} for the current directory, or C{None}
+    if it isn't in a git repository. It takes one C{git rev-parse}, the
+    first time it is asked for the directory or for another directory
+    in the same worktree."""
+    cwd = os.getcwd()
+    env = (environ_get('GIT_DIR'), environ_get('GIT_WORK_TREE'))
+    for d in __discoveries:
+        if d.env == env and cwd in (d.cwd, d.top_dir):
+            return d
+    r = Run('git', 'rev-parse', '--git-dir', '--is-inside-git-dir',
+            '--is-inside-work-tree', '--show-cdup',
+            '--symbolic-full-name', 'HEAD').returns([0, 128]).discard_stderr()
+    try:
+        lines = r.output_lines()
+    except RunException:
+        return None
+    if len(lines) < 3:
+        return None
+    # git rev-parse fails on HEAD if the branch has no commits yet,
+    # after telling all the rest.
+    d = Discovery(cwd, env, lines, r.exitcode == 0)
+    __discoveries.append(d)
+    return d
+
+
+def forget_head():
+    """Forget what C{HEAD} was, after changing it."""
+    for d in __discoveries:
+        d.head = None
+
 
 def get():
     """Return the .git directory location
@@ -39,11 +109,7 @@ def get():
     if not __base_dir:
         __base_dir = environ_get('GIT_DIR')
         if __base_dir is None:
-            try:
-                __base_dir = Run(
-                    'git', 'rev-parse', '--git-dir'
-                ).output_one_line()
-            except RunException:
-                __base_dir = ''
+            d = discover()
+            __base_dir = d.git_dir if d else ''
 
     return __base_dir
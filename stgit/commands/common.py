@@ -12,7 +12,7 @@ import os
 import re
 import sys
 
-from stgit import git, stack, templates
+from stgit import basedir, git, stack, templates
 from stgit.compat import decode_utf8_with_latin1, text
 from stgit.config import config
 from stgit.exception import StgException
@@ -20,7 +20,7 @@ from stgit.lib import git as libgit
 from stgit.lib import log
 from stgit.lib import stack as libstack
 from stgit.out import out
-from stgit.run import Run, RunException
+from stgit.run import RunException
 from stgit.utils import (
     EditorException,
     add_sign_line,
@@ -104,19 +104,17 @@ def git_commit(name, repository, branch_name=None):
     elif patch.startswith('{public}'):
         public_ref = get_public_ref(branch)
         return repository.rev_parse(public_ref +
-                                    strip_prefix('{public}', patch),
-                                    discard_stderr=True)
+                                    strip_prefix('{public}', patch))
 
     # Other combination of branch and patch
     try:
-        return repository.rev_parse('patches/%s/%s' % (branch, patch),
-                                    discard_stderr=True)
+        return repository.rev_parse('patches/%s/%s' % (branch, patch))
     except libgit.RepositoryException:
         pass
 
     # Try a Git commit
     try:
-        return repository.rev_parse(name, discard_stderr=True)
+        return repository.rev_parse(name)
     except libgit.RepositoryException:
         raise CmdException('%s: Unknown patch or revision name' % name)
 
@@ -603,38 +601,27 @@ class _Directory(object):
         self.log = log
 
     @readonly_constant_property
-    def git_dir(self):
-        try:
-            return Run('git', 'rev-parse', '--git-dir'
-                       ).discard_stderr().output_one_line()
-        except RunException:
+    def __discovery(self):
+        d = basedir.discover()
+        if d is None:
             raise DirectoryException('No git repository found')
+        return d
+
+    @readonly_constant_property
+    def git_dir(self):
+        return self.__discovery.git_dir
 
     @readonly_constant_property
     def __topdir_path(self):
-        try:
-            lines = Run('git', 'rev-parse', '--show-cdup'
-                        ).discard_stderr().output_lines()
-            if len(lines) == 0:
-                return '.'
-            elif len(lines) == 1:
-                return lines[0]
-            else:
-                raise RunException('Too much output')
-        except RunException:
-            raise DirectoryException('No git repository found')
+        return self.__discovery.top_dir or '.'
 
     @readonly_constant_property
     def is_inside_git_dir(self):
-        return {'true': True, 'false': False}[
-            Run('git', 'rev-parse', '--is-inside-git-dir').output_one_line()
-        ]
+        return self.__discovery.inside_git_dir
 
     @readonly_constant_property
     def is_inside_worktree(self):
-        return {'true': True, 'false': False}[
-            Run('git', 'rev-parse', '--is-inside-work-tree').output_one_line()
-        ]
+        return self.__discovery.inside_work_tree
 
     def cd_to_topdir(self):
         os.chdir(self.__topdir_path)
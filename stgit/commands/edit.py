@@ -124,7 +124,7 @@ def func(parser, options, args):
     if options.set_tree:
         cd = cd.set_tree(
             stack.repository.rev_parse(
-                options.set_tree, discard_stderr=True, object_type='tree'
+                options.set_tree, object_type='tree'
             )
         )
 
@@ -153,6 +153,15 @@ def func(parser, options, args):
             file=series,
         )
 
+    # compute the diffs and diffstats of all the patches up front, in
+    # one batch
+    cds = [stack.patches.get(p).commit.data for p in patches]
+    diffs = stack.repository.diff_trees(
+        [(cd.parent.data.tree, cd.tree) for cd in cds],
+        options.diff_flags,
+    )
+    diffstats = gitlib.diffstats(diffs)
+
     for patch_no, p in enumerate(patches, 1):
         pname = p
         if options.patch:
@@ -167,7 +176,7 @@ def func(parser, options, args):
 
         # get the patch description
         patch = stack.patches.get(p)
-        cd = patch.commit.data
+        cd = cds[patch_no - 1]
 
         descr = cd.message.strip()
         descr_lines = descr.split('\n')
@@ -175,17 +184,13 @@ def func(parser, options, args):
         short_descr = descr_lines[0].rstrip()
         long_descr = '\n'.join(descr_lines[1:]).strip()
 
-        diff = stack.repository.diff_tree(
-            cd.parent.data.tree,
-            cd.tree,
-            options.diff_flags,
-        )
+        diff = diffs[patch_no - 1]
 
         tmpl_dict = {
             'description': descr,
             'shortdescr': short_descr,
             'longdescr': long_descr,
-            'diffstat': gitlib.diffstat(diff).rstrip(),
+            'diffstat': diffstats[patch_no - 1].rstrip(),
             'authname': cd.author.name,
             'authemail': cd.author.email,
             'authdate': cd.author.date.isoformat(),
@@ -82,11 +82,10 @@ def func(parser, options, args):
         out.stdout_bytes(repository.run(cmd).decoding(None).raw_output())
     else:
         used = set()
-        for dt in repository.diff_tree_files(
+        for fd in repository.diff_tree_files(
             commit.data.parent.data.tree, commit.data.tree
         ):
-            _, _, _, _, status, oldname, newname = dt
-            for filename in [oldname, newname]:
+            for filename in [fd.oldname, fd.newname]:
                 if filename in used:
                     continue
                 else:
@@ -95,4 +94,4 @@ def func(parser, options, args):
                 if options.bare:
                     out.stdout(filename)
                 else:
-                    out.stdout('%s %s' % (status, filename))
+                    out.stdout('%s %s' % (fd.status, filename))
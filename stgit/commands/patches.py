@@ -94,30 +94,31 @@ def func(parser, options, args):
         .output_lines()
     )
 
-    diff_lines = []
-    for name in stack.patchorder.applied:
-        patch = stack.patches.get(name)
-        if patch.commit.sha1 not in revs:
-            continue
-        if options.diff:
-            diff_lines.extend(
-                [
-                    b'-' * 79,
-                    patch.name.encode('utf-8'),
-                    b'-' * 79,
-                    patch.commit.data.message.encode('utf-8'),
-                    b'---',
-                    b'',
-                    repository.diff_tree(
-                        patch.commit.data.parent.data.tree,
-                        patch.commit.data.tree,
-                        pathlimits=files,
-                        diff_opts=options.diff_flags + color_diff_flags(),
-                    )
-                ]
-            )
-        else:
+    patches = [stack.patches.get(name) for name in stack.patchorder.applied]
+    patches = [patch for patch in patches if patch.commit.sha1 in revs]
+    if not options.diff:
+        for patch in patches:
             out.stdout(patch.name)
-
-    if options.diff:
-        pager(b'\n'.join(diff_lines))
+        return
+
+    # Compute the diffs of all the patches in one batch.
+    diffs = repository.diff_trees(
+        [(p.commit.data.parent.data.tree, p.commit.data.tree)
+         for p in patches],
+        pathlimits=files,
+        diff_opts=options.diff_flags + color_diff_flags(),
+    )
+    diff_lines = []
+    for patch, diff in zip(patches, diffs):
+        diff_lines.extend(
+            [
+                b'-' * 79,
+                patch.name.encode('utf-8'),
+                b'-' * 79,
+                patch.commit.data.message.encode('utf-8'),
+                b'---',
+                b'',
+                diff,
+            ]
+        )
+    pager(b'\n'.join(diff_lines))
@@ -162,7 +162,9 @@ def list_files(stack, patch_name, args, index, update, submodules):
         # exclude them if we're explicitly told to include them, or if we're
         # given explicit paths.
         if not args and not submodules:
-            paths -= stack.repository.submodules(stack.head.data.tree)
+            parents = stack.head.data.parents
+            base = parents[0].data.tree if len(parents) == 1 else None
+            paths -= stack.repository.submodules(stack.head.data.tree, base)
     return paths
 
 
@@ -349,14 +351,14 @@ def func(parser, options, args):
 
     # Make sure there are no conflicts in the files we want to
     # refresh.
-    if stack.repository.default_index.conflicts() & paths:
+    iw = stack.repository.default_iw
+    if iw.conflicts() & paths:
         raise common.CmdException(
             'Cannot refresh -- resolve conflicts first')
 
     # Make sure the index is clean before performing a full refresh
     if not options.index and not options.force:
-        if not (stack.repository.default_index.is_clean(stack.head) or
-                stack.repository.default_iw.worktree_clean()):
+        if not (iw.is_clean(stack.head) or iw.worktree_clean()):
             raise common.CmdException(
                 'The index is dirty. Did you mean --index? '
                 'To force a full refresh use --force.'
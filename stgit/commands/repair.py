@@ -113,16 +113,14 @@ def read_commit_dag(branch):
     out.start('Reading commit DAG')
     commits = {}
     patches = set()
-    for line in Run('git', 'rev-list', '--parents', '--all').output_lines():
-        cs = line.split()
+    for cs in Run('git', 'rev-list', '--parents', '--all').iter_records():
         for id in cs:
             if id not in commits:
                 commits[id] = Commit(id)
         for id in cs[1:]:
             commits[cs[0]].parents.add(commits[id])
             commits[id].children.add(commits[cs[0]])
-    for line in Run('git', 'show-ref').output_lines():
-        id, ref = line.split()
+    for id, ref in Run('git', 'show-ref').iter_records():
         m = re.match(r'^refs/patches/%s/(.+)$' % re.escape(branch), ref)
         if m and not m.group(1).endswith('.log'):
             c = commits[id]
@@ -273,6 +273,13 @@ def func(parser, options, args):
     if not patches:
         return
 
+    if options.description or options.author or options.empty:
+        # Read the commits of all the patches in one batch.
+        commits = [stack.patches.get(p).commit for p in patches]
+        stack.repository.load_commits(commits)
+        if options.empty:
+            stack.repository.load_commits(c.data.parent for c in commits)
+
     if options.showbranch:
         branch_str = stack.name + ':'
     else:
@@ -111,7 +111,7 @@ def func(parser, options, args):
                 try:
                     commits.append(
                         repository.rev_parse(
-                            name, object_type='commit', discard_stderr=True
+                            name, object_type='commit'
                         )
                     )
                 except git.RepositoryException:
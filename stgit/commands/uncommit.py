@@ -127,6 +127,18 @@ def func(parser, options, args):
                 % n.sha1)
         return c.append(n)
 
+    # Read all the commits we are about to walk through in one batch.
+    # A single commit is read just as cheaply on its own.
+    if patch_nr != 1:
+        if patch_nr:
+            walk = ['--max-count=%d' % patch_nr, stack.base.sha1]
+        else:
+            walk = [stack.base.sha1, '^%s' % to_commit.sha1]
+        stack.repository.load_commits(
+            stack.repository.get_commit(sha1) for sha1 in
+            stack.repository.run(['git', 'rev-list', '--first-parent'] + walk
+                                 ).output_lines())
+
     commits = []
     next_commit = stack.base
     if patch_nr:
@@ -298,6 +298,11 @@ class DetachedHeadException(GitException):
 def get_head_file():
     """Return the name of the file pointed to by the HEAD symref.
     Throw an exception if HEAD is detached."""
+    d = basedir.discover()
+    if d and d.head and d.git_dir == os.path.abspath(basedir.get()):
+        if d.head == 'HEAD':
+            raise DetachedHeadException()
+        return strip_prefix('refs/heads/', d.head)
     try:
         return strip_prefix(
             'refs/heads/', GRun('symbolic-ref', '-q', 'HEAD'
@@ -312,6 +317,7 @@ def set_head_file(ref):
     # head cache flushing is needed since we might have a different value
     # in the new head
     __clear_head_cache()
+    basedir.forget_head()
     try:
         GRun('symbolic-ref', 'HEAD', 'refs/heads/%s' % ref).run()
     except GitRunException:
@@ -948,4 +954,4 @@ def fetch_head():
 def all_refs():
     """Return a list of all refs in the current repository.
     """
-    return [line.split()[1] for line in GRun('show-ref').output_lines()]
+    return [ref for _, ref in GRun('show-ref').iter_records()]
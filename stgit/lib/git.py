@@ -9,16 +9,27 @@ from __future__ import (
     unicode_literals,
 )
 
+from collections import deque
 from datetime import datetime, timedelta, tzinfo
 import atexit
+import binascii
+import calendar
+import errno
+import hashlib
+import mmap
 import os
 import re
-import signal
+import struct
+import tempfile
+import threading
+import time
+import zlib
 
-from stgit import exception, utils
+from stgit import basedir, exception, utils
 from stgit.compat import environ_get, text
 from stgit.config import config
-from stgit.run import Run, RunException
+from stgit.out import out
+from stgit.run import Run, RunException, run_many
 
 
 class Immutable(object):
@@ -38,6 +49,8 @@ class Immutable(object):
     that is up to the individual immutable subclasses. It just serves
     as documentation."""
 
+    __slots__ = ()
+
 
 class RepositoryException(exception.StgException):
     """Base class for all exceptions due to failed L{Repository}
@@ -83,10 +96,39 @@ def make_defaults(defaults):
     return d
 
 
+_interned = {}
+_max_interned = 10000
+
+
+def _intern(s):
+    """Return the one copy of C{s} we keep around, so that strings that
+    come up over and over, such as names and email addresses, take
+    memory just once. (C{intern()} only takes C{str}.) The copies are
+    all dropped once there are too many of them."""
+    i = _interned.get(s)
+    if i is None:
+        if len(_interned) >= _max_interned:
+            _interned.clear()
+        i = _interned[s] = s
+    return i
+
+
 class TimeZone(tzinfo):
     """A simple time zone class for static offsets from UTC. (We have to
     define our own since Python's standard library doesn't define any
-    time zone classes.)"""
+    time zone classes.) Use L{get} to get the one instance for each
+    time zone."""
+
+    __slots__ = ('__offset', '__name')
+    __zones = {}
+
+    @classmethod
+    def get(cls, tzstring):
+        key = tzstring.replace(':', '')  # +hh:mm is the same as +hhmm
+        tz = cls.__zones.get(key)
+        if tz is None:
+            tz = cls.__zones[key] = cls(tzstring)
+        return tz
 
     def __init__(self, tzstring):
         m = re.match(r'^([+-])(\d{2}):?(\d{2})$', tzstring)
@@ -100,7 +142,7 @@ class TimeZone(tzinfo):
             )
         except OverflowError:
             raise DateException(tzstring, 'time zone')
-        self.__name = tzstring
+        self.__name = ''.join(m.groups())
 
     def utcoffset(self, dt):
         return self.__offset
@@ -115,6 +157,171 @@ class TimeZone(tzinfo):
         return self.__name
 
 
+_months = ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+           'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+
+_zone_re = r'(Z|UTC?|GMT|[+-]\d\d(?::?\d\d)?)'
+_iso_date_re = re.compile(
+    r'^(\d{4})[-./](\d\d?)[-./](\d\d?)'
+    r'(?:(?:T|\s+)(\d\d?):(\d\d)(?::(\d\d)(?:[.,]\d+)?)?)?'
+    r'\s*' + _zone_re + r'?$', re.IGNORECASE)
+# Mail dates may have the obsolete US zone names, and a comment (often
+# the zone name again) at the end.
+_rfc2822_date_re = re.compile(
+    r'^(?:[a-z]{3},\s*)?(\d\d?)\s+([a-z]{3})\s+(\d{4})'
+    r'(?:\s+(\d\d?):(\d\d)(?::(\d\d))?)?'
+    r'(?:\s+([ECMP][SD]T|' + _zone_re[1:] + r')?'
+    r'(?:\s*\([^()]*\))?$', re.IGNORECASE)
+# git's own default format, as in git log: Thu Apr 7 22:13:13 2005 +0200
+_default_date_re = re.compile(
+    r'^(?:[a-z]{3}\s+)?([a-z]{3})\s+(\d\d?)\s+(\d\d?):(\d\d):(\d\d)'
+    r'\s+(\d{4})(?:\s+' + _zone_re + r')?$', re.IGNORECASE)
+_raw_date_re = re.compile(r'^@?(\d+)\s+([+-]\d\d:?\d\d)$')
+_epoch_date_re = re.compile(r'^@(\d+)$')
+_relative_date_re = re.compile(
+    r'^(\d+|an?|one)[\s.]+(second|minute|hour|day|week|month|year)s?'
+    r'[\s.]+ago$', re.IGNORECASE)
+_seconds_per = {'second': 1, 'minute': 60, 'hour': 3600,
+                'day': 86400, 'week': 7 * 86400}
+_obsolete_zones = {'EST': -5, 'EDT': -4, 'CST': -6, 'CDT': -5,
+                   'MST': -7, 'MDT': -6, 'PST': -8, 'PDT': -7}
+
+# Dates parsed by _parse_date(), except the ones relative to now.
+_parsed_dates = {}
+
+
+def _zone(offset):
+    """The L{TimeZone} for an offset from UTC in seconds."""
+    minutes = offset // 60
+    return TimeZone.get('%s%02d%02d' % ('-' if minutes < 0 else '+',
+                                        abs(minutes) // 60,
+                                        abs(minutes) % 60))
+
+
+def _zone_offset(zone):
+    """The offset from UTC in seconds of a time zone written as
+    C{Z}, C{UTC}, C{GMT}, C{+hh}, C{+hhmm}, C{+hh:mm}, or one of the
+    obsolete RFC 2822 names such as C{EST}."""
+    if zone.upper() in ['Z', 'UT', 'UTC', 'GMT']:
+        return 0
+    if zone.upper() in _obsolete_zones:
+        return _obsolete_zones[zone.upper()] * 3600
+    digits = zone[1:].replace(':', '')
+    offset = int(digits[:2]) * 3600 + int(digits[2:] or 0) * 60
+    return -offset if zone[0] == '-' else offset
+
+
+def _local_datetime(timestamp):
+    """The time C{timestamp} as a datetime in the local time zone."""
+    offset = calendar.timegm(time.localtime(timestamp)) - timestamp
+    return datetime.fromtimestamp(timestamp, _zone(offset))
+
+
+def _make_datetime(datestring, fields, zone):
+    """Make a datetime from year, month, day, hour, minute and second
+    (where the time may be C{None}, meaning midnight), in the given
+    time zone or, if there isn't one, the local time zone."""
+    fields = [int(f or 0) for f in fields]
+    try:
+        datetime(*fields)  # check that the fields make sense
+    except ValueError:
+        raise DateException(datestring, 'date')
+    if not 1970 <= fields[0] <= 2099:
+        # Like git, which doesn't do dates outside that range.
+        raise DateException(datestring, 'date')
+    if zone:
+        offset = _zone_offset(zone)
+        return datetime.fromtimestamp(
+            calendar.timegm(tuple(fields) + (0, 0, 0)) - offset, _zone(offset))
+    return _local_datetime(int(time.mktime(tuple(fields) + (0, 0, -1))))
+
+
+def _relative_datetime(datestring):
+    """Parse C{now}, C{yesterday} and C{I{n} I{units} ago}, or return
+    C{None}."""
+    now = int(time.time())
+    s = datestring.lower()
+    if s in ['now', 'today']:
+        return _local_datetime(now)
+    if s == 'yesterday':
+        return _local_datetime(now - 86400)
+    m = _relative_date_re.match(datestring)
+    if not m:
+        return None
+    n = int(m.group(1)) if m.group(1).isdigit() else 1
+    unit = m.group(2).lower()
+    if unit in _seconds_per:
+        return _local_datetime(now - n * _seconds_per[unit])
+    # Months and years are counted on the calendar.
+    tm = time.localtime(now)
+    months = tm.tm_year * 12 + tm.tm_mon - 1
+    months -= n * 12 if unit == 'year' else n
+    year, month = months // 12, months % 12 + 1
+    day = min(tm.tm_mday, calendar.monthrange(year, month)[1])
+    return _make_datetime(datestring, [year, month, day, tm.tm_hour,
+                                       tm.tm_min, tm.tm_sec], None)
+
+
+def _absolute_datetime(datestring):
+    """Parse a date that isn't relative to now, or return C{None}."""
+    m = _raw_date_re.match(datestring)
+    if m:
+        try:
+            return datetime.fromtimestamp(int(m.group(1)),
+                                          TimeZone.get(m.group(2)))
+        except ValueError:
+            raise DateException(datestring, 'date')
+    m = _epoch_date_re.match(datestring)
+    if m:
+        try:
+            return _local_datetime(int(m.group(1)))
+        except (ValueError, OverflowError, EnvironmentError):
+            raise DateException(datestring, 'date')
+    m = _iso_date_re.match(datestring)
+    if m:
+        return _make_datetime(datestring, m.groups()[:6], m.group(7))
+    m = _rfc2822_date_re.match(datestring)
+    if m and m.group(2).lower() in _months:
+        return _make_datetime(
+            datestring,
+            [m.group(3), _months.index(m.group(2).lower()) + 1, m.group(1)]
+            + list(m.groups()[3:6]),
+            m.group(7))
+    m = _default_date_re.match(datestring)
+    if m and m.group(1).lower() in _months:
+        return _make_datetime(
+            datestring,
+            [m.group(6), _months.index(m.group(1).lower()) + 1, m.group(2)]
+            + list(m.groups()[2:5]),
+            m.group(7))
+    return None
+
+
+def _parse_date(datestring):
+    """Parse a date in one of the usual formats git and C{date} accept:
+    git's own C{I{seconds} I{zone}}, C{@I{seconds}}, ISO 8601 and RFC
+    2822 dates, git's default date format, C{now}, C{yesterday} and
+    C{I{n} I{units} ago}. Return a datetime, or C{None} if we don't
+    know the format.
+
+    That leaves out the rest of what git and C{date} make sense of:
+    L{Date} asks C{git var} about dates such as C{7 April 2005 12:00}
+    or C{7/4/2005}, and then C{date} about ones such as C{yesterday
+    12:00} or C{last friday}."""
+    datestring = datestring.strip()
+    t = _parsed_dates.get(datestring)
+    if t is None:
+        t = _relative_datetime(datestring)
+        if t is not None:
+            return t  # not remembered, since now keeps moving
+        t = _absolute_datetime(datestring)
+        if t is not None:
+            if len(_parsed_dates) >= 10000:
+                _parsed_dates.clear()
+            _parsed_dates[datestring] = t
+    return t
+
+
 def system_date(datestring):
     m = re.match(r"^(.+)([+-]\d\d:?\d\d)$", datestring)
     if m:
@@ -137,7 +344,7 @@ def system_date(datestring):
     year, month, day, hour, minute, second = [int(x) for x in t.split("-")]
     try:
         return datetime(year, month, day, hour, minute, second,
-                        tzinfo=TimeZone(z))
+                        tzinfo=TimeZone.get(z))
     except ValueError:
         raise DateException(datestring, "date")
 
@@ -156,53 +363,23 @@ def git_date(datestring=''):
     except RunException:
         return None
     _, _, timestamp, offset = ident.split()
-    return datetime.fromtimestamp(int(timestamp), TimeZone(offset))
+    return datetime.fromtimestamp(int(timestamp), TimeZone.get(offset))
 
 
 class Date(Immutable):
     """Represents a timestamp used in git commits."""
 
-    def __init__(self, datestring):
-        # Try git-formatted date.
-        m = re.match(r'^(\d+)\s+([+-]\d\d:?\d\d)$', datestring)
-        if m:
-            try:
-                self.__time = datetime.fromtimestamp(int(m.group(1)),
-                                                     TimeZone(m.group(2)))
-            except ValueError:
-                raise DateException(datestring, 'date')
-            return
-
-        # Try iso-formatted date.
-        m = re.match(r'^(\d{4})-(\d{2})-(\d{2})\s+(\d{2}):(\d{2}):(\d{2})\s+'
-                     + r'([+-]\d\d:?\d\d)$', datestring)
-        if m:
-            try:
-                self.__time = datetime(
-                    *[int(m.group(i + 1)) for i in range(6)],
-                    **{'tzinfo': TimeZone(m.group(7))})
-            except ValueError:
-                raise DateException(datestring, 'date')
-            return
-
-        if datestring == 'now':
-            self.__time = git_date()
-            assert self.__time
-            return
-
-        # Try parsing with `git var`.
-        gd = git_date(datestring)
-        if gd:
-            self.__time = gd
-            return
-
-        # Try parsing with the system's "date" command.
-        sd = system_date(datestring)
-        if sd:
-            self.__time = sd
-            return
+    __slots__ = ('__time',)
 
-        raise DateException(datestring, 'date')
+    def __init__(self, datestring):
+        t = _parse_date(datestring)
+        if t is None:
+            # Try parsing with `git var`, and then with the system's
+            # "date" command.
+            t = git_date(datestring) or system_date(datestring)
+        if t is None:
+            raise DateException(datestring, 'date')
+        self.__time = t
 
     def __repr__(self):
         return self.isoformat()
@@ -212,6 +389,13 @@ class Date(Immutable):
         return '%s %s' % (self.__time.replace(tzinfo=None).isoformat(str(' ')),
                           self.__time.tzinfo)
 
+    @property
+    def raw(self):
+        """The format git stores dates in: seconds since the epoch, and
+        the time zone offset."""
+        return _raw_date(calendar.timegm(self.__time.utctimetuple()),
+                         self.__time.utcoffset())
+
     @classmethod
     def maybe(cls, datestring):
         """Return a new object initialized with the argument if it contains a
@@ -221,10 +405,33 @@ class Date(Immutable):
         return cls(datestring)
 
 
+def _raw_date(timestamp, offset):
+    minutes = offset.days * 24 * 60 + offset.seconds // 60
+    sign = '-' if minutes < 0 else '+'
+    return '%d %s%02d%02d' % (timestamp, sign, abs(minutes) // 60,
+                              abs(minutes) % 60)
+
+
+def _raw_now():
+    """The current time in git's raw date format."""
+    t = int(time.time())
+    if time.localtime(t).tm_isdst > 0:
+        offset = -time.altzone
+    else:
+        offset = -time.timezone
+    return _raw_date(t, timedelta(seconds=offset))
+
+
 class Person(Immutable):
     """Represents an author or committer in a git commit object. Contains
     name, email and timestamp."""
 
+    __slots__ = ('__name', '__email', '__date')
+
+    # Parsed idents, since the same ones turn up in many commits.
+    __parsed = {}
+    __max_parsed = 10000
+
     def __init__(self, name=NoValue, email=NoValue,
                  date=NoValue, defaults=NoValue):
         d = make_defaults(defaults)
@@ -263,12 +470,17 @@ class Person(Immutable):
 
     @classmethod
     def parse(cls, s):
-        m = re.match(r'^([^<]*)<([^>]*)>\s+(\d+\s+[+-]\d{4})$', s)
-        assert m
-        name = m.group(1).strip()
-        email = m.group(2)
-        date = Date(m.group(3))
-        return cls(name, email, date)
+        p = cls.__parsed.get(s)
+        if p is None:
+            m = re.match(r'^([^<]*)<([^>]*)>\s+(\d+\s+[+-]\d{4})$', s)
+            assert m
+            name = _intern(m.group(1).strip())
+            email = _intern(m.group(2))
+            date = Date(m.group(3))
+            if len(cls.__parsed) >= cls.__max_parsed:
+                cls.__parsed.clear()
+            p = cls.__parsed[s] = cls(name, email, date)
+        return p
 
     @classmethod
     def user(cls):
@@ -304,10 +516,14 @@ class GitObject(Immutable):
     using normal Python object comparison; it also ensures we don't
     waste more memory than necessary."""
 
+    __slots__ = ()
+
 
 class BlobData(Immutable):
     """Represents the data contents of a git blob object."""
 
+    __slots__ = ('__bytes',)
+
     def __init__(self, data):
         assert isinstance(data, bytes)
         self.__bytes = data
@@ -320,6 +536,9 @@ class BlobData(Immutable):
         """Commit the blob.
         @return: The committed blob
         @rtype: L{Blob}"""
+        writer = repository.object_writer
+        if writer:
+            return repository.get_blob(writer.write(Blob.typename, self.bytes))
         runner = repository.run(['git', 'hash-object', '-w', '--stdin'])
         sha1 = runner.encoding(None).raw_input(self.bytes).output_one_line()
         return repository.get_blob(sha1)
@@ -332,6 +551,7 @@ class Blob(GitObject):
 
     typename = 'blob'
     default_perm = '100644'
+    __slots__ = ('__repository', '__sha1')
 
     def __init__(self, repository, sha1):
         self.__repository = repository
@@ -346,7 +566,12 @@ class Blob(GitObject):
 
     @property
     def data(self):
-        return BlobData(self.__repository.cat_object(self.sha1, encoding=None))
+        return self.__repository.object_caches[self.typename].get_data(
+            self.sha1, self.__load)
+
+    def __load(self):
+        s = self.__repository.cat_object(self.sha1, encoding=None)
+        return BlobData(s), len(s)
 
 
 class ImmutableDict(dict):
@@ -367,6 +592,8 @@ class ImmutableDict(dict):
 class TreeData(Immutable):
     """Represents the data contents of a git tree object."""
 
+    __slots__ = ('__entries',)
+
     @staticmethod
     def __x(po):
         if isinstance(po, GitObject):
@@ -386,28 +613,67 @@ class TreeData(Immutable):
     def entries(self):
         return self.__entries
 
+    def __raw(self):
+        """The tree the way git stores it: for each entry, sorted by name
+        (but with subtrees sorted as if their names ended with a
+        slash), the octal mode, a space, the name, a NUL byte and the
+        binary sha1."""
+        def key(entry):
+            name, (mode, obj) = entry
+            if mode == Tree.default_perm:
+                return name.encode('utf-8') + b'/'
+            return name.encode('utf-8')
+        return b''.join(
+            ('%o %s\0' % (int(mode, 8), name)).encode('utf-8')
+            + binascii.unhexlify(obj.sha1)
+            for name, (mode, obj) in sorted(self.entries.items(), key=key))
+
+    @property
+    def sha1(self):
+        """The sha1 the tree has once it is written."""
+        raw = self.__raw()
+        return hashlib.sha1(('%s %d\0' % (Tree.typename, len(raw))
+                             ).encode('ascii') + raw).hexdigest()
+
+    def mktree_input(self):
+        """The tree the way C{git mktree -z} reads it."""
+        return ''.join('%s %s %s\t%s\0' % (mode, obj.typename, obj.sha1, name)
+                       for (name, (mode, obj)) in self.entries.items())
+
     def commit(self, repository):
         """Commit the tree.
         @return: The committed tree
         @rtype: L{Tree}"""
-        listing = ['%s %s %s\t%s' % (mode, obj.typename, obj.sha1, name)
-                   for (name, (mode, obj)) in self.entries.items()]
-        sha1 = repository.run(['git', 'mktree', '-z']
-                              ).input_nulterm(listing).output_one_line()
+        writer = repository.object_writer
+        if writer:
+            return repository.get_tree(writer.write(Tree.typename,
+                                                    self.__raw()))
+        sha1 = repository.run(['git', 'mktree', '-z']).raw_input(
+            self.mktree_input()).output_one_line()
         return repository.get_tree(sha1)
 
+    # The types of the objects in tree entries with these modes; all
+    # other entries are blobs.
+    __types = {'040000': 'tree', '160000': 'commit'}
+
     @classmethod
-    def parse(cls, repository, lines):
-        """Parse a raw git tree description.
+    def parse(cls, repository, s):
+        """Parse a raw git tree object: a sequence of entries, each one
+        an octal mode, a space, a name, a NUL byte, and a binary sha1.
 
         @return: A new L{TreeData} object
         @rtype: L{TreeData}"""
         entries = {}
-        for line in lines:
-            m = re.match(r'^([0-7]{6}) ([a-z]+) ([0-9a-f]{40})\t(.*)$', line)
-            assert m
-            perm, type, sha1, name = m.groups()
-            entries[name] = (perm, repository.get_object(type, sha1))
+        pos = 0
+        while pos < len(s):
+            space = s.index(b' ', pos)
+            nul = s.index(b'\0', space)
+            perm = s[pos:space].decode('ascii').zfill(6)
+            name = s[space + 1:nul].decode('utf-8')
+            sha1 = binascii.hexlify(s[nul + 1:nul + 21]).decode('ascii')
+            entries[name] = (perm, repository.get_object(
+                cls.__types.get(perm, Blob.typename), sha1))
+            pos = nul + 21
         return cls(entries)
 
 
@@ -418,11 +684,11 @@ class Tree(GitObject):
 
     typename = 'tree'
     default_perm = '040000'
+    __slots__ = ('__repository', '__sha1')
 
     def __init__(self, repository, sha1):
         self.__sha1 = sha1
         self.__repository = repository
-        self.__data = None
 
     @property
     def sha1(self):
@@ -430,12 +696,12 @@ class Tree(GitObject):
 
     @property
     def data(self):
-        if self.__data is None:
-            self.__data = TreeData.parse(
-                self.__repository,
-                self.__repository.run(['git', 'ls-tree', '-z', self.sha1]
-                                      ).output_lines('\0'))
-        return self.__data
+        return self.__repository.object_caches[self.typename].get_data(
+            self.sha1, self.__load)
+
+    def __load(self):
+        s = self.__repository.cat_object(self.sha1, encoding=None)
+        return TreeData.parse(self.__repository, s), len(s)
 
     def __repr__(self):
         return 'Tree<sha1: %s>' % self.sha1
@@ -444,6 +710,9 @@ class Tree(GitObject):
 class CommitData(Immutable):
     """Represents the data contents of a git commit object."""
 
+    __slots__ = ('__tree', '__parents', '__author', '__committer',
+                 '__message', '__raw_author', '__raw_committer')
+
     def __init__(self, tree=NoValue, parents=NoValue, author=NoValue,
                  committer=NoValue, message=NoValue, defaults=NoValue):
         d = make_defaults(defaults)
@@ -452,6 +721,8 @@ class CommitData(Immutable):
         self.__author = d(author, 'author', Person.author)
         self.__committer = d(committer, 'committer', Person.committer)
         self.__message = d(message, 'message')
+        # Unparsed author and committer lines, from L{parse}.
+        self.__raw_author = self.__raw_committer = None
 
     @property
     def env(self):
@@ -485,10 +756,16 @@ class CommitData(Immutable):
 
     @property
     def author(self):
+        if self.__raw_author is not None:
+            self.__author = Person.parse(self.__raw_author)
+            self.__raw_author = None
         return self.__author
 
     @property
     def committer(self):
+        if self.__raw_committer is not None:
+            self.__committer = Person.parse(self.__raw_committer)
+            self.__raw_committer = None
         return self.__committer
 
     @property
@@ -533,10 +810,68 @@ class CommitData(Immutable):
                 ' committer: %s, message: "%s">'
                 ) % (tree, parents, self.author, self.committer, self.message)
 
+    # Characters git strips from the ends of names and email addresses.
+    __crud = ''.join(chr(i) for i in range(33)) + '.,:;<>"\\\''
+
+    # Config that git takes idents from, and that Person doesn't.
+    __ident_keys = ['author.name', 'author.email', 'committer.name',
+                    'committer.email', 'user.useconfigonly']
+
+    @classmethod
+    def __raw_ident(cls, person, default):
+        """Return C{person} the way git writes it in a commit object, with
+        the fields it leaves out taken from C{default} (the way git
+        takes them from the environment or config), or C{None} if git
+        might write it differently."""
+        fields = []
+        for attr in ['name', 'email', 'date']:
+            value = getattr(person, attr, None)
+            if value is None:
+                value = getattr(default, attr)
+            fields.append(value)
+        name, email, date = fields
+        for s in [name, email]:
+            if (not s or s != s.strip(cls.__crud)
+                    or any(c in s for c in '<>\n')):
+                return None
+        if date is None:
+            date = _raw_now()
+        else:
+            date = date.raw
+            if date.startswith('-'):
+                return None  # git refuses dates before the epoch
+        return '%s <%s> %s' % (name, email, date)
+
+    def __raw(self):
+        """The commit the way C{git commit-tree} would write it, or
+        C{None} if we can't be sure of that."""
+        if (
+            config.getbool('commit.gpgsign')
+            or (config.get('i18n.commitencoding') or 'utf-8').lower()
+            not in ['utf-8', 'utf8']
+            or any(config.get(k) is not None for k in self.__ident_keys)
+        ):
+            return None
+        author = self.__raw_ident(self.author, Person.author())
+        committer = self.__raw_ident(self.committer, Person.committer())
+        if not author or not committer:
+            return None
+        lines = ['tree %s' % self.tree.sha1]
+        lines.extend('parent %s' % p.sha1 for p in self.parents)
+        lines.append('author %s' % author)
+        lines.append('committer %s' % committer)
+        lines.append('')
+        lines.append(self.message)
+        return '\n'.join(lines).encode('utf-8')
+
     def commit(self, repository):
         """Commit the commit.
         @return: The committed commit
         @rtype: L{Commit}"""
+        writer = repository.object_writer
+        raw = writer and self.__raw()
+        if raw:
+            return repository.get_commit(writer.write(Commit.typename, raw))
         c = ['git', 'commit-tree', self.tree.sha1]
         for p in self.parents:
             c.append('-p')
@@ -550,33 +885,34 @@ class CommitData(Immutable):
 
     @classmethod
     def parse(cls, repository, s):
-        """Parse a raw git commit description.
+        """Parse a raw git commit description. The author and committer
+        are only parsed when they are first asked for, since most of
+        the time only the tree and parents are needed.
         @return: A new L{CommitData} object
         @rtype: L{CommitData}"""
-        cd = cls(parents=[])
-        lines = []
-        raw_lines = s.split('\n')
-        # Collapse multi-line header lines
-        for i, line in enumerate(raw_lines):
-            if not line:
-                cd = cd.set_message('\n'.join(raw_lines[i + 1:]))
-                break
-            if line.startswith(' '):
-                # continuation line
-                lines[-1] += '\n' + line[1:]
-            else:
-                lines.append(line)
-        for line in lines:
-            if ' ' in line:
-                key, value = line.split(' ', 1)
-                if key == 'tree':
-                    cd = cd.set_tree(repository.get_tree(value))
-                elif key == 'parent':
-                    cd = cd.add_parent(repository.get_commit(value))
-                elif key == 'author':
-                    cd = cd.set_author(Person.parse(value))
-                elif key == 'committer':
-                    cd = cd.set_committer(Person.parse(value))
+        if '\n\n' in s:
+            header, message = s.split('\n\n', 1)
+        else:
+            header, message = s.rstrip('\n'), NoValue
+        tree = NoValue
+        parents = []
+        idents = {}
+        for line in header.split('\n'):
+            # Continuation lines (starting with a space) only belong to
+            # headers we don't read, such as gpgsig.
+            key, _, value = line.partition(' ')
+            if key == 'tree':
+                tree = repository.get_tree(value)
+            elif key == 'parent':
+                parents.append(repository.get_commit(value))
+            elif key in ('author', 'committer'):
+                idents[key] = value
+        cd = cls(tree=tree, parents=parents,
+                 author=None if 'author' in idents else NoValue,
+                 committer=None if 'committer' in idents else NoValue,
+                 message=message)
+        cd.__raw_author = idents.get('author')
+        cd.__raw_committer = idents.get('committer')
         return cd
 
 
@@ -586,57 +922,249 @@ class Commit(GitObject):
     L{CommitData} object."""
 
     typename = 'commit'
+    __slots__ = ('__repository', '__sha1')
 
     def __init__(self, repository, sha1):
         self.__sha1 = sha1
         self.__repository = repository
-        self.__data = None
 
     @property
     def sha1(self):
         return self.__sha1
 
+    @property
+    def __cache(self):
+        return self.__repository.object_caches[self.typename]
+
     @property
     def data(self):
-        if self.__data is None:
-            self.__data = CommitData.parse(
-                self.__repository,
-                self.__repository.cat_object(self.sha1))
-        return self.__data
+        return self.__cache.get_data(self.sha1, self.__load)
+
+    def __load(self):
+        s = self.__repository.cat_object(self.sha1)
+        return CommitData.parse(self.__repository, s), len(s)
+
+    @property
+    def has_data(self):
+        return self.__cache.has_data(self.sha1)
+
+    def set_raw_data(self, s):
+        """Set the data from the raw commit description, when it has
+        been read by L{Repository.load_commits}."""
+        self.__cache.set_data(
+            self.sha1, CommitData.parse(self.__repository, s), len(s))
 
     def __repr__(self):
-        return 'Commit<sha1: %s, data: %s>' % (self.sha1, self.__data)
+        return 'Commit<sha1: %s, data: %s>' % (
+            self.sha1, self.data if self.has_data else None)
 
 
-class Refs(object):
-    """Accessor for the refs stored in a git repository. Will
-    transparently cache the values of all refs."""
+class RefTransaction(object):
+    """A set of ref updates that are written together, atomically, by
+    C{git update-ref --stdin} when L{commit} is called. Created by
+    L{Refs.transaction}; while it is open, L{Refs.set} and
+    L{Refs.delete} queue their updates in it instead of writing them
+    right away.
 
-    def __init__(self, repository):
+    L{prepare} locks the refs and checks their old values before
+    anything else is touched, so that a failure to write them can be
+    handled while it is still cheap to back out; L{commit} then writes
+    them. Refs with different reflog messages need a C{git update-ref}
+    process each, but all of them are prepared before any of them is
+    committed.
+
+    Other writes that must only happen if the refs are written, such as
+    the files StGit keeps next to its refs, can be queued with
+    L{defer}."""
+
+    def __init__(self, repository, msg, done):
         self.__repository = repository
-        self.__refs = None
+        self.__msg = msg
+        self.__done = done
+        self.__old = {}  # ref -> sha1 before the transaction, or None
+        self.__new = {}  # ref -> sha1 after the transaction, or None
+        self.__msgs = {}  # ref -> reflog message
+        self.__deferred = []  # (do, undo) pairs
+        self.__procs = None  # the prepared update-ref processes
+        self.__ended = False
+
+    def defer(self, do, undo=None):
+        """Call C{do} once the refs have been written. If they aren't,
+        call C{undo} instead (if given)."""
+        self.__deferred.append((do, undo))
+
+    def __queue(self, ref, old_sha1, new_sha1, msg):
+        assert self.__procs is None
+        self.__old.setdefault(ref, old_sha1)
+        self.__new[ref] = new_sha1
+        self.__msgs[ref] = msg or self.__msg
+
+    def create(self, ref, sha1, msg=None):
+        """Create a ref that doesn't exist yet."""
+        self.__queue(ref, None, sha1, msg)
+
+    def update(self, ref, new_sha1, old_sha1, msg=None):
+        """Change a ref from C{old_sha1} to C{new_sha1}."""
+        self.__queue(ref, old_sha1, new_sha1, msg)
+
+    def delete(self, ref, old_sha1, msg=None):
+        """Delete a ref that currently points to C{old_sha1}."""
+        self.__queue(ref, old_sha1, None, msg)
+
+    def __commands(self):
+        """The queued updates, as lists of C{update-ref --stdin}
+        commands grouped by their reflog message."""
+        groups = {}
+        for ref in sorted(self.__new):
+            old_sha1, new_sha1 = self.__old[ref], self.__new[ref]
+            if old_sha1 == new_sha1:
+                continue
+            elif old_sha1 is None:
+                c = 'create %s %s' % (ref, new_sha1)
+            elif new_sha1 is None:
+                c = 'delete %s %s' % (ref, old_sha1)
+            else:
+                c = 'update %s %s %s' % (ref, new_sha1, old_sha1)
+            groups.setdefault(self.__msgs[ref], []).append(c)
+        return sorted(groups.items())
+
+    def __update_ref(self, msg):
+        return self.__repository.run(
+            ['git', 'update-ref', '-m', msg, '--stdin'])
 
-    def __cache_refs(self):
-        """(Re-)Build the cache of all refs in the repository."""
-        self.__refs = {}
-        runner = self.__repository.run(['git', 'show-ref'])
+    @staticmethod
+    def __send(p, commands, replies):
+        """Send C{commands} to a C{git update-ref --stdin} process, and
+        check that it answers C{I{reply}: ok} for each of C{replies}."""
+        done = p.exchange()
+        writer = _write_requests(p, commands)
+        bytes_out = 0
         try:
-            lines = runner.output_lines()
+            for reply in replies:
+                line = p.stdout.readline()
+                bytes_out += len(line)
+                if line != ('%s: ok\n' % reply).encode():
+                    p.stdin.close()
+                    p.wait()
+                    out.err_bytes(p.stderr.read())
+                    raise RunException('git update-ref failed')
+        finally:
+            if writer:
+                writer.join()
+        done(len(commands), sum(len(c) + 1 for c in commands), bytes_out)
+
+    def prepare(self):
+        """Lock all the queued refs and check that they still have the
+        old values we expect, without writing them yet. If that fails,
+        the transaction is aborted and a L{RunException} raised. Git
+        versions older than 2.27 can't do this, and only check the refs
+        when they are written."""
+        if self.__procs is not None:
+            return
+        self.__procs = []
+        if git_version() < (2, 27):
+            return
+        try:
+            for msg, commands in self.__commands():
+                p = self.__update_ref(msg).run_background()
+                self.__procs.append(p)
+                self.__send(p, ['start'] + commands + ['prepare'],
+                            ['start', 'prepare'])
         except RunException:
-            # as this happens both in non-git trees and empty git
-            # trees, we silently ignore this error
+            self.abort()
+            raise
+
+    def commit(self):
+        """Write all the queued updates. Either all of them succeed, or
+        none of them are made and an exception is raised."""
+        self.prepare()
+        try:
+            if git_version() < (2, 27):
+                for msg, commands in self.__commands():
+                    self.__update_ref(msg).raw_input(
+                        ''.join(c + '\n' for c in commands)).no_output()
+            for p in self.__procs:
+                self.__send(p, ['commit'], ['commit'])
+                p.stdin.close()
+                p.wait()
+        except RunException:
+            self.__end(False)
+            raise
+        self.__procs = []
+        self.__end(True)
+
+    def abort(self):
+        """Throw away all the queued updates, and release the locks
+        taken by L{prepare}. Does nothing if the transaction has
+        already been committed or aborted."""
+        self.__end(False)
+
+    def __end(self, success):
+        if self.__ended:
             return
-        for line in lines:
-            m = re.match(r'^([0-9a-f]{40})\s+(\S+)$', line)
-            sha1, ref = m.groups()
-            self.__refs[ref] = sha1
+        self.__ended = True
+        # A prepared update-ref that sees the end of its input without
+        # a commit rolls back, and releases its locks.
+        for p in self.__procs or []:
+            try:
+                p.stdin.close()
+            except (IOError, OSError):
+                pass
+            p.wait()
+        self.__done(success)
+        deferred, self.__deferred = self.__deferred, []
+        for do, undo in deferred:
+            if success:
+                do()
+            elif undo is not None:
+                undo()
+
+
+class Refs(object):
+    """Accessor for the refs stored in a git repository. Will
+    transparently cache the values of the refs, one namespace (the
+    directory a ref is in, such as C{refs/patches/I{branch}/}) at a
+    time, so that looking up a few refs doesn't mean reading all of
+    them."""
+
+    def __init__(self, repository):
+        self.__repository = repository
+        self.__namespaces = {}  # namespace -> {ref: sha1}
+        self.__transaction = None
+        self.__touched = set()  # namespaces written in the transaction
+
+    @staticmethod
+    def __namespace(ref):
+        return ref[:ref.rfind('/') + 1]
+
+    def __refs(self, ref):
+        """The cached refs of the namespace C{ref} is in. (Re-)Build
+        the cache of that namespace if we don't have it."""
+        namespace = self.__namespace(ref)
+        refs = self.__namespaces.get(namespace)
+        if refs is None:
+            refs = self.__namespaces[namespace] = {}
+            # Old gits let C{*} match slashes too, so check that we
+            # only keep the refs directly in the namespace.
+            runner = self.__repository.run(
+                ['git', 'for-each-ref', '--format=%(objectname) %(refname)',
+                 namespace + '*'])
+            try:
+                for sha1, r in runner.iter_records():
+                    if self.__namespace(r) == namespace:
+                        refs[r] = sha1
+            except RunException:
+                # as this happens both in non-git trees and empty git
+                # trees, we silently ignore this error
+                pass
+        if self.__transaction:
+            self.__touched.add(namespace)
+        return refs
 
     def get(self, ref):
         """Get the Commit the given ref points to. Throws KeyError if ref
         doesn't exist."""
-        if self.__refs is None:
-            self.__cache_refs()
-        return self.__repository.get_commit(self.__refs[ref])
+        return self.__repository.get_commit(self.__refs(ref)[ref])
 
     def exists(self, ref):
         """Check if the given ref exists."""
@@ -650,32 +1178,90 @@ class Refs(object):
     def set(self, ref, commit, msg):
         """Write the sha1 of the given Commit to the ref. The ref may or may
         not already exist."""
-        if self.__refs is None:
-            self.__cache_refs()
-        old_sha1 = self.__refs.get(ref, '0' * 40)
+        refs = self.__refs(ref)
+        old_sha1 = refs.get(ref)
         new_sha1 = commit.sha1
-        if old_sha1 != new_sha1:
+        if old_sha1 == new_sha1:
+            return
+        if self.__transaction:
+            if old_sha1 is None:
+                self.__transaction.create(ref, new_sha1, msg)
+            else:
+                self.__transaction.update(ref, new_sha1, old_sha1, msg)
+        else:
             self.__repository.run(['git', 'update-ref', '-m', msg,
-                                   ref, new_sha1, old_sha1]).no_output()
-            self.__refs[ref] = new_sha1
+                                   ref, new_sha1, old_sha1 or '0' * 40]
+                                  ).no_output()
+        refs[ref] = new_sha1
 
     def delete(self, ref):
         """Delete the given ref. Throws KeyError if ref doesn't exist."""
-        if self.__refs is None:
-            self.__cache_refs()
-        self.__repository.run(['git', 'update-ref',
-                               '-d', ref, self.__refs[ref]]).no_output()
-        del self.__refs[ref]
+        refs = self.__refs(ref)
+        if self.__transaction:
+            self.__transaction.delete(ref, refs[ref])
+        else:
+            self.__repository.run(['git', 'update-ref',
+                                   '-d', ref, refs[ref]]).no_output()
+        del refs[ref]
+
+    def forget(self, ref):
+        """Drop the cached refs of the namespace C{ref} is in, after it
+        has been written to behind our back, so that they are read
+        again the next time they are needed."""
+        self.__namespaces.pop(self.__namespace(ref), None)
+
+    def after_commit(self, do, undo=None):
+        """Call C{do} when the open L{RefTransaction} is committed, or
+        C{undo} (if given) if it is aborted. Without an open
+        transaction, call C{do} right away."""
+        if self.__transaction:
+            self.__transaction.defer(do, undo)
+        else:
+            do()
+
+    def transaction(self, msg):
+        """Start a L{RefTransaction}, and queue all ref updates in it
+        until it is committed or aborted. The cached ref values are
+        updated right away, so reading refs back works as usual."""
+        assert self.__transaction is None
+        self.__transaction = RefTransaction(
+            self.__repository, msg, self.__end_transaction)
+        return self.__transaction
+
+    def __end_transaction(self, success):
+        self.__transaction = None
+        if not success:
+            # Forget the updates we made to the cache.
+            for namespace in self.__touched:
+                self.__namespaces.pop(namespace, None)
+        self.__touched = set()
 
 
 class ObjectCache(object):
     """Cache for Python objects, for making sure that we create only one
     Python object per git object. This reduces memory consumption and
-    makes object comparison very cheap."""
+    makes object comparison very cheap.
+
+    The objects can keep the data they read from git here too, with
+    L{get_data}. That part is bounded: once more than C{max_entries}
+    objects have data, or their data is more than C{max_bytes} bytes,
+    the data of the least recently used ones is dropped, to be read
+    again if it is needed. The objects themselves are kept, so there is
+    still just one Python object per git object. C{hits}, C{misses}
+    and C{evictions} count what happens to the data."""
 
-    def __init__(self, create):
+    def __init__(self, create, max_entries=None, max_bytes=None):
         self.__objects = {}
         self.__create = create
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # The data, in a circular doubly linked list of [prev, next,
+        # name, data, size] links, least recently used first.
+        self.__links = {}
+        self.__root = []
+        self.__root[:] = [self.__root, self.__root, None, None, 0]
+        self.__bytes = 0
+        self.hits = self.misses = self.evictions = 0
 
     def __getitem__(self, name):
         if name not in self.__objects:
@@ -689,6 +1275,70 @@ class ObjectCache(object):
         assert name not in self.__objects
         self.__objects[name] = val
 
+    def __unlink(self, link):
+        prev, next_ = link[0], link[1]
+        prev[1] = next_
+        next_[0] = prev
+
+    def __append(self, link):
+        last = self.__root[0]
+        link[0], link[1] = last, self.__root
+        last[1] = self.__root[0] = link
+
+    def has_data(self, name):
+        return name in self.__links
+
+    def get_data(self, name, load):
+        """Return the data of the named object. If it isn't in the cache,
+        C{load} is called to read it, and should return the data and
+        its size in bytes."""
+        link = self.__links.get(name)
+        if link is not None:
+            self.hits += 1
+            self.__unlink(link)
+            self.__append(link)
+            return link[3]
+        self.misses += 1
+        data, size = load()
+        self.set_data(name, data, size)
+        return data
+
+    def set_data(self, name, data, size):
+        """Put the data of the named object in the cache."""
+        link = self.__links.pop(name, None)
+        if link is not None:
+            self.__unlink(link)
+            self.__bytes -= link[4]
+        link = [None, None, name, data, size]
+        self.__links[name] = link
+        self.__append(link)
+        self.__bytes += size
+        self.__evict()
+
+    def __evict(self):
+        while self.__links and (
+            (self.max_entries is not None
+             and len(self.__links) > self.max_entries)
+            or (self.max_bytes is not None and self.__bytes > self.max_bytes)
+        ):
+            link = self.__root[1]
+            self.__unlink(link)
+            del self.__links[link[2]]
+            self.__bytes -= link[4]
+            self.evictions += 1
+
+    @property
+    def stats(self):
+        """A dict with the number of objects, the number and total size
+        of those that have their data in the cache, and the hit, miss
+        and eviction counts."""
+        return dict(objects=len(self.__objects),
+                    entries=len(self.__links),
+                    bytes=self.__bytes,
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions)
+
 
 class RunWithEnv(object):
     def run(self, args, env={}):
@@ -722,6 +1372,395 @@ class RunWithEnvCwd(RunWithEnv):
         return RunWithEnv.run(self, args, self.env_in_cwd)
 
 
+class ObjectWriter(object):
+    """Writes git objects straight into the object database, as zlib
+    compressed loose objects, without running git. In C{pack} mode,
+    the objects written are put in a pack when the program exits.
+    Enabled by setting C{stgit.objectwriter} to C{loose} or C{pack}."""
+
+    __writers = {}
+
+    def __init__(self, repo, pack=False):
+        self.__repo = repo
+        self.__dir = os.path.join(repo.common_directory, 'objects')
+        self.__written = []
+        try:
+            self.__level = int(config.get('core.loosecompression')
+                               or config.get('core.compression') or 1)
+        except ValueError:
+            self.__level = 1
+        if pack:
+            atexit.register(self.__pack)
+
+    @classmethod
+    def create(cls, repo):
+        """Return an L{ObjectWriter} for the repository, or C{None} if
+        objects should be written by git: because C{stgit.objectwriter}
+        doesn't ask for it, or because the repository is set up in a
+        way we don't handle."""
+        mode = config.get('stgit.objectwriter')
+        if mode not in ['loose', 'pack']:
+            return None
+        if (
+            config.get('core.repositoryformatversion') not in [None, '0', '1']
+            or config.get('extensions.objectformat') not in [None, 'sha1']
+            or config.get('core.sharedrepository') not in [None, 'false',
+                                                           'umask']
+            or environ_get('GIT_OBJECT_DIRECTORY')
+        ):
+            return None
+        # Share one writer between all Repository objects for the same
+        # repository, so that they all end up in the same pack.
+        key = (os.path.abspath(repo.common_directory), mode)
+        if key not in cls.__writers:
+            cls.__writers[key] = cls(repo, pack=(mode == 'pack'))
+        return cls.__writers[key]
+
+    def __path(self, sha1):
+        return os.path.join(self.__dir, sha1[:2], sha1[2:])
+
+    def write(self, type_, body):
+        """Write an object, unless it already exists as a loose object,
+        and return its sha1."""
+        data = ('%s %d\0' % (type_, len(body))).encode('ascii') + body
+        sha1 = binascii.hexlify(hashlib.sha1(data).digest()).decode('ascii')
+        assert isinstance(sha1, text)
+        path = self.__path(sha1)
+        if os.path.exists(path):
+            return sha1
+        try:
+            os.mkdir(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(prefix='tmp_obj_',
+                                   dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(zlib.compress(data, self.__level))
+            os.chmod(tmp, 0o444)
+            os.rename(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.__written.append(sha1)
+        return sha1
+
+    def __pack(self):
+        """Move the objects we have written into a new pack."""
+        if not self.__written:
+            return
+        try:
+            self.__repo.run(
+                ['git', 'pack-objects', '-q',
+                 os.path.join(self.__dir, 'pack', 'pack')]
+            ).raw_input(''.join('%s\n' % sha1 for sha1 in self.__written)
+                        ).discard_output()
+        except RunException:
+            return  # keep the loose objects, then
+        for sha1 in self.__written:
+            try:
+                os.remove(self.__path(sha1))
+            except OSError:
+                pass
+        self.__written = []
+
+
+def _mmap_file(path):
+    """Map the whole of a file into memory, read-only."""
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _delta_size(delta, i):
+    """Read one of the size varints at the start of a delta."""
+    size = shift = 0
+    while True:
+        c = delta[i]
+        i += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return size, i
+
+
+def _apply_delta(base, delta):
+    """Apply a git delta to the contents of its base object."""
+    delta = bytearray(delta)
+    src_size, i = _delta_size(delta, 0)
+    dst_size, i = _delta_size(delta, i)
+    if src_size != len(base):
+        raise ValueError('Delta base has the wrong size')
+    out = bytearray()
+    while i < len(delta):
+        c = delta[i]
+        i += 1
+        if c & 0x80:
+            # Copy from the base.
+            offset = size = 0
+            for bit in range(4):
+                if c & (1 << bit):
+                    offset |= delta[i] << (8 * bit)
+                    i += 1
+            for bit in range(3):
+                if c & (0x10 << bit):
+                    size |= delta[i] << (8 * bit)
+                    i += 1
+            out += base[offset:offset + (size or 0x10000)]
+        elif c:
+            # Insert from the delta.
+            out += delta[i:i + c]
+            i += c
+        else:
+            raise ValueError('Bad delta opcode')
+    if len(out) != dst_size:
+        raise ValueError('Delta result has the wrong size')
+    return bytes(out)
+
+
+class _Pack(object):
+    """A pack in the object database, with its (version 2) index, both
+    mapped into memory."""
+
+    OBJ_OFS_DELTA = 6
+    OBJ_REF_DELTA = 7
+
+    def __init__(self, idx_path):
+        self.__idx = idx = _mmap_file(idx_path)
+        self.__pack = _mmap_file(idx_path[:-len('.idx')] + '.pack')
+        if idx[:8] != b'\377tOc\0\0\0\2' or self.__pack[:4] != b'PACK':
+            raise ValueError('Unsupported pack format')
+        self.__fanout = struct.unpack_from('>256I', idx, 8)
+        count = self.__fanout[255]
+        self.__names = 8 + 256 * 4
+        self.__offsets = self.__names + 24 * count  # past names and CRCs
+        self.__large_offsets = self.__offsets + 4 * count
+
+    def find(self, binsha):
+        """Return the offset in the pack of the object with the given
+        binary sha1, or C{None} if it isn't in this pack."""
+        idx = self.__idx
+        first = bytearray(binsha[:1])[0]
+        lo = self.__fanout[first - 1] if first else 0
+        hi = self.__fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.__names + 20 * mid
+            name = idx[pos:pos + 20]
+            if name < binsha:
+                lo = mid + 1
+            elif name > binsha:
+                hi = mid
+            else:
+                (offset,) = struct.unpack_from(
+                    '>I', idx, self.__offsets + 4 * mid)
+                if offset & 0x80000000:
+                    (offset,) = struct.unpack_from(
+                        '>Q', idx,
+                        self.__large_offsets + 8 * (offset & 0x7fffffff))
+                return offset
+        return None
+
+    def entry(self, offset):
+        """Parse the header of the pack entry at the given offset, and
+        return its type number, its (inflated) size, its delta base --
+        an offset for OFS deltas, a binary sha1 for REF deltas -- and
+        where its compressed data starts."""
+        header = bytearray(self.__pack[offset:offset + 32])
+        c = header[0]
+        kind = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        i = 1
+        while c & 0x80:
+            c = header[i]
+            i += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        base = None
+        if kind == self.OBJ_OFS_DELTA:
+            c = header[i]
+            i += 1
+            distance = c & 0x7f
+            while c & 0x80:
+                c = header[i]
+                i += 1
+                distance = ((distance + 1) << 7) | (c & 0x7f)
+            base = offset - distance
+        elif kind == self.OBJ_REF_DELTA:
+            base = bytes(header[i:i + 20])
+            i += 20
+        return kind, size, base, offset + i
+
+    def inflate(self, pos, size):
+        """Inflate the C{size} bytes of data starting at C{pos}."""
+        d = zlib.decompressobj()
+        parts = []
+        got = 0
+        step = max(size + 64, 4096)
+        while got < size:
+            chunk = self.__pack[pos:pos + step]
+            if not chunk:
+                raise ValueError('Truncated pack')
+            pos += len(chunk)
+            part = d.decompress(chunk)
+            parts.append(part)
+            got += len(part)
+        if got != size:
+            raise ValueError('Pack entry has the wrong size')
+        return b''.join(parts)
+
+
+class PackReader(object):
+    """Reads objects straight from the packs in the object database,
+    which are mapped into memory, without asking git. Objects that
+    aren't in a pack, or that are stored in a way we don't handle,
+    are left for C{git cat-file}. Enabled by setting
+    C{stgit.packreader} to true."""
+
+    __types = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+
+    # Delta bases are kept around, since objects close to each other
+    # in history often share them.
+    __cache_size = 16 * 1024 * 1024
+
+    def __init__(self, repo):
+        self.__dir = os.path.join(repo.common_directory, 'objects', 'pack')
+        self.__packs = {}
+        self.__cache = {}
+        self.__cache_order = deque()
+        self.__cached = 0
+        self.__scan()
+
+    @classmethod
+    def create(cls, repo):
+        """Return a L{PackReader} for the repository, or C{None} if
+        objects should be read by git."""
+        if not config.getbool('stgit.packreader'):
+            return None
+        if (
+            config.get('extensions.objectformat') not in [None, 'sha1']
+            or environ_get('GIT_OBJECT_DIRECTORY')
+        ):
+            return None
+        return cls(repo)
+
+    def __scan(self):
+        """Open the packs we haven't seen before. Return true if
+        there were any."""
+        try:
+            names = os.listdir(self.__dir)
+        except OSError:
+            return False
+        new = False
+        for name in names:
+            if name.endswith('.idx') and name not in self.__packs:
+                try:
+                    pack = _Pack(os.path.join(self.__dir, name))
+                except (EnvironmentError, ValueError, struct.error):
+                    pack = None
+                self.__packs[name] = pack
+                new = True
+        return new
+
+    def __find(self, binsha):
+        for pack in self.__packs.values():
+            if pack is not None:
+                offset = pack.find(binsha)
+                if offset is not None:
+                    return pack, offset
+        return None
+
+    def __remember(self, key, obj):
+        size = len(obj[1])
+        if key in self.__cache or size > self.__cache_size // 4:
+            return
+        self.__cache[key] = obj
+        self.__cache_order.append(key)
+        self.__cached += size
+        while self.__cached > self.__cache_size:
+            _, data = self.__cache.pop(self.__cache_order.popleft())
+            self.__cached -= len(data)
+
+    def __read(self, key):
+        # Walk down the delta chain until we get to a full object, or
+        # one we have in the cache; then apply the deltas on the way
+        # back up.
+        chain = []
+        while True:
+            obj = self.__cache.get(key)
+            if obj is not None:
+                break
+            pack, offset = key
+            kind, size, base, pos = pack.entry(offset)
+            if kind in self.__types:
+                obj = (self.__types[kind], pack.inflate(pos, size))
+                break
+            elif kind == _Pack.OBJ_OFS_DELTA:
+                chain.append((key, pack.inflate(pos, size)))
+                key = (pack, base)
+            elif kind == _Pack.OBJ_REF_DELTA:
+                chain.append((key, pack.inflate(pos, size)))
+                key = self.__find(base)
+                if key is None:
+                    raise ValueError('Delta base not in any pack')
+            else:
+                raise ValueError('Unknown pack entry type %d' % kind)
+            if len(chain) > 10000:
+                raise ValueError('Delta chain too long')
+        type_, data = obj
+        for delta_key, delta in reversed(chain):
+            self.__remember(key, (type_, data))
+            data = _apply_delta(data, delta)
+            key = delta_key
+        return type_, data
+
+    def read(self, sha1):
+        """Return the (type, contents) of an object, or C{None} if we
+        can't read it."""
+        try:
+            binsha = binascii.unhexlify(sha1)
+        except (TypeError, ValueError):
+            return None
+        if len(binsha) != 20:
+            return None
+        key = self.__find(binsha)
+        if key is None and self.__scan():
+            # Maybe it was packed after we started.
+            key = self.__find(binsha)
+        if key is None:
+            return None
+        try:
+            return self.__read(key)
+        except (ValueError, IndexError, struct.error, zlib.error):
+            return None
+
+
+def _write_requests(p, requests):
+    """Write the given lines to the stdin of the background process
+    C{p}. Anything but a short request is written from another thread,
+    so that git doesn't block on a full output pipe while we block on
+    a full input pipe; that thread is returned, to be joined once all
+    the responses have been read."""
+    request = ''.join('%s\n' % r for r in requests)
+
+    def write():
+        try:
+            p.stdin.write(request)
+            p.stdin.flush()
+        except (IOError, OSError):
+            pass  # the reader will notice that git went away
+
+    if len(request) <= 4096:
+        # Small enough to fit in the pipe buffer in one go.
+        write()
+        return None
+    writer = threading.Thread(target=write)
+    writer.daemon = True
+    writer.start()
+    return writer
+
+
 class CatFileProcess(object):
     def __init__(self, repo):
         self.__repo = repo
@@ -738,35 +1777,117 @@ class CatFileProcess(object):
         p = self.__proc
         if p:
             p.stdin.close()
-            os.kill(p.pid(), signal.SIGTERM)
+            p.terminate()
             p.wait()
 
-    def cat_file(self, sha1, encoding):
-        p = self.__get_process()
-        p.stdin.write('%s\n' % sha1)
-        p.stdin.flush()
-
-        # Read until we have the entire status line.
-        s = b''
-        while b'\n' not in s:
-            s += os.read(p.stdout.fileno(), 4096)
-        h, b = s.split(b'\n', 1)
-        header = h.decode('utf-8')
+    @staticmethod
+    def __read_exactly(p, size):
+        """Read C{size} bytes into a buffer allocated up front."""
+        buf = bytearray(size)
+        # A blocking, buffered readinto() only stops short at EOF.
+        if p.stdout.readinto(buf) != size:
+            raise RepositoryException('git cat-file exited unexpectedly')
+        return buf
+
+    def __read_object(self, p, sha1, encoding):
+        header = p.stdout.readline()
+        if not header.endswith(b'\n'):
+            raise RepositoryException('git cat-file exited unexpectedly')
+        header = header[:-1].decode('utf-8')
         if header == '%s missing' % sha1:
-            raise RepositoryException('Cannot cat %s' % sha1)
+            return None
         name, type_, size = header.split()
         assert name == sha1
-        size = int(size)
-
-        # Read until we have the entire object plus the trailing
-        # newline.
-        while len(b) < size + 1:
-            b += os.read(p.stdout.fileno(), 4096)
-        content = b[:size]
+        # The object contents are followed by a newline.
+        content = self.__read_exactly(p, int(size) + 1)
+        del content[-1:]
         if encoding:
             return type_, content.decode(encoding)
         else:
-            return type_, content
+            return type_, bytes(content)
+
+    def cat_file_many(self, sha1s, encoding):
+        """Return a list of (type, contents) of the given objects. All
+        the requests are sent to C{git cat-file} before the responses
+        are read back, so the cost is about one round-trip no matter
+        how many objects there are."""
+        sha1s = list(sha1s)
+        if not sha1s:
+            return []
+        p = self.__get_process()
+        done = p.exchange()
+        writer = _write_requests(p, sha1s)
+        try:
+            objects = [self.__read_object(p, sha1, encoding)
+                       for sha1 in sha1s]
+        finally:
+            if writer:
+                writer.join()
+        done(len(sha1s), sum(len(sha1) + 1 for sha1 in sha1s),
+             sum(len(obj[1]) for obj in objects if obj is not None))
+        for sha1, obj in zip(sha1s, objects):
+            if obj is None:
+                raise RepositoryException('Cannot cat %s' % sha1)
+        return objects
+
+    def cat_file(self, sha1, encoding):
+        return self.cat_file_many([sha1], encoding)[0]
+
+
+class CatFileCheckProcess(object):
+    """Answers questions about objects -- whether they exist, and what
+    their type and size are -- with a long-lived C{git cat-file
+    --batch-check} process, without reading the object contents."""
+
+    def __init__(self, repo):
+        self.__repo = repo
+        self.__proc = None
+        atexit.register(self.__shutdown)
+
+    def __get_process(self):
+        if not self.__proc:
+            self.__proc = self.__repo.run(['git', 'cat-file', '--batch-check']
+                                          ).run_background()
+        return self.__proc
+
+    def __shutdown(self):
+        p = self.__proc
+        if p:
+            p.stdin.close()
+            p.terminate()
+            p.wait()
+
+    @staticmethod
+    def __read_info(p):
+        line = p.stdout.readline()
+        if not line.endswith(b'\n'):
+            raise RepositoryException('git cat-file exited unexpectedly')
+        fields = line[:-1].decode('utf-8').split(' ')
+        if len(fields) != 3 or not fields[2].isdigit():
+            # "<name> missing", or "<name> ambiguous".
+            return None
+        sha1, type_, size = fields
+        return sha1, type_, int(size)
+
+    def object_info_many(self, names):
+        """Return a list with the (sha1, type, size) of each of the
+        named objects, or C{None} for those that don't exist. Like
+        L{CatFileProcess.cat_file_many}, all the requests are sent
+        before any response is read."""
+        names = list(names)
+        if not names:
+            return []
+        assert not any('\n' in name for name in names)
+        p = self.__get_process()
+        done = p.exchange()
+        writer = _write_requests(p, names)
+        try:
+            infos = [self.__read_info(p) for _ in names]
+        finally:
+            if writer:
+                writer.join()
+        done(len(names), sum(len(name) + 1 for name in names), 0)
+        return infos
 
 
 class DiffTreeProcesses(object):
@@ -785,21 +1906,234 @@ class DiffTreeProcesses(object):
 
     def __shutdown(self):
         for p in self.__procs.values():
-            os.kill(p.pid(), signal.SIGTERM)
+            p.terminate()
             p.wait()
 
-    def diff_trees(self, args, sha1a, sha1b):
+    # Sent after each pair of trees. It's not a pair of tree names, so
+    # diff-tree just echoes it, which marks the end of the diff.
+    __end = b'EOF\n'
+
+    def diff_trees_many(self, args, pairs):
+        """Return a list of the output of C{git diff-tree} with the given
+        arguments for each (C{sha1a}, C{sha1b}) in C{pairs}. All the
+        pairs are sent to the same C{--stdin} process before the
+        output is read back."""
+        pairs = list(pairs)
+        if not pairs:
+            return []
         p = self.__get_process(args)
-        query = ('%s %s\n' % (sha1a, sha1b)).encode('utf-8')
-        end = b'EOF\n'  # arbitrary string that's not a 40-digit hex number
-        os.write(p.stdin.fileno(), query + end)
-        p.stdin.flush()
-        data = bytes()
-        while not (data.endswith(b'\n' + end) or data.endswith(b'\0' + end)):
-            data += os.read(p.stdout.fileno(), 4096)
-        assert data.startswith(query)
-        assert data.endswith(end)
-        return data[len(query):-len(end)]
+        done = p.exchange()
+        queries = [('%s %s\n' % pair).encode('utf-8') for pair in pairs]
+        writer = _write_requests(
+            p, [line for pair in pairs for line in ['%s %s' % pair, 'EOF']])
+        try:
+            diffs = self.__read_diffs(p, queries)
+        finally:
+            if writer:
+                writer.join()
+        done(len(pairs), sum(len(q) + len(self.__end) for q in queries),
+             sum(len(d) for d in diffs))
+        return diffs
+
+    def __read_diffs(self, p, queries):
+        end = self.__end
+        fd = p.stdout.fileno()
+        buf = bytearray()
+        pos = 0
+        diffs = []
+        for query in queries:
+            # Each response is the echoed query, the diff, and the
+            # echoed end marker on a line (or -z record) of its own.
+            start = pos + len(query)
+            scan = start
+            while True:
+                i = buf.find(end, scan)
+                if i < 0:
+                    scan = max(start, len(buf) - len(end) + 1)
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        raise RepositoryException(
+                            'git diff-tree exited unexpectedly')
+                    buf += chunk
+                elif buf[i - 1:i] in (b'\n', b'\0'):
+                    break
+                else:
+                    scan = i + 1
+            assert buf[pos:start] == query
+            diffs.append(bytes(buf[start:i]))
+            pos = i + len(end)
+        assert pos == len(buf)
+        return diffs
+
+    def diff_trees(self, args, sha1a, sha1b):
+        return self.diff_trees_many(args, [(sha1a, sha1b)])[0]
+
+
+class SubmoduleCache(object):
+    """The sets of submodule paths of the L{Tree}s most recently asked
+    about, by tree sha1. They are kept in a file in the git directory
+    of each worktree, so that they last from one command to the next,
+    and the tree last asked about is the one of that worktree."""
+
+    max_trees = 32
+
+    def __init__(self, filename):
+        self.__filename = filename
+        self.__sets = None
+        self.__order = deque()
+
+    def __read(self):
+        """Read the file: for each tree, its sha1 and then its
+        submodule paths, each ended by a NUL, and another NUL after
+        the paths. Return the sets by sha1, and the sha1s from the
+        least to the most recently used."""
+        sets, order = {}, deque()
+        try:
+            with open(self.__filename, 'rb') as f:
+                fields = f.read().decode('utf-8').split('\0')
+        except (IOError, OSError, UnicodeDecodeError):
+            fields = []
+        i = iter(fields)
+        for sha1 in i:
+            if not re.match(r'^[0-9a-f]{40}$', sha1):
+                break
+            paths = set()
+            for path in i:
+                if not path:
+                    break
+                paths.add(path)
+            if sha1 not in sets:
+                order.append(sha1)
+            sets[sha1] = frozenset(paths)
+        return sets, order
+
+    def __load(self):
+        if self.__sets is None:
+            self.__sets, self.__order = self.__read()
+        return self.__sets
+
+    def __touch(self, sha1):
+        self.__order.remove(sha1)
+        self.__order.append(sha1)
+
+    def get_paths(self, sha1):
+        """The set of submodule paths of the tree C{sha1}, or C{None}
+        if we don't know it."""
+        paths = self.__load().get(sha1)
+        if paths is not None:
+            self.__touch(sha1)
+        return paths
+
+    def latest(self):
+        """The sha1 of the tree we last learned or were asked about,
+        or C{None} if there is none."""
+        self.__load()
+        return self.__order[-1] if self.__order else None
+
+    def set_paths(self, sha1, paths):
+        """Remember that C{paths} are the submodule paths of the tree
+        C{sha1}, forgetting the least recently used trees if there
+        are too many."""
+        sets = self.__load()
+        if sha1 in sets:
+            self.__touch(sha1)
+        else:
+            self.__order.append(sha1)
+        sets[sha1] = frozenset(paths)
+        self.__save()
+
+    def __save(self):
+        # Like git, take a lock by creating the .lock file, write the
+        # new contents there, and rename it over the file. The sets
+        # of a tree never change, so if another stg holds the lock,
+        # or the repository is read-only, we just don't save them.
+        lock = self.__filename + '.lock'
+        try:
+            fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL
+                         | getattr(os, 'O_BINARY', 0), 0o666)
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                # Keep the trees other stg commands saved since we read
+                # the file, as less recently used than ours.
+                sets, order = self.__read()
+                for s in reversed(order):
+                    if s not in self.__sets:
+                        self.__sets[s] = sets[s]
+                        self.__order.appendleft(s)
+                while len(self.__order) > self.max_trees:
+                    del self.__sets[self.__order.popleft()]
+                f.write(''.join(
+                    '%s\0%s\0' % (s, ''.join(
+                        p + '\0' for p in sorted(self.__sets[s])))
+                    for s in self.__order).encode('utf-8'))
+            if os.path.exists(self.__filename) and os.name == 'nt':
+                os.remove(self.__filename)
+            os.rename(lock, self.__filename)
+        except BaseException:
+            os.remove(lock)
+            raise
+
+
+class FileDiff(object):
+    """One file that differs between two L{Tree}s, as told by
+    L{Repository.diff_tree_files}: the old and the new mode, sha1 and
+    file name, and the status letter (with the similarity score, for
+    a copy or a rename). The L{Blob}s are only made when asked for."""
+
+    __slots__ = ('__repository', 'omode', 'nmode', 'osha1', 'nsha1',
+                 'status', 'oldname', 'newname')
+
+    null_sha1 = '0' * 40
+
+    def __init__(self, repository, omode, nmode, osha1, nsha1, status,
+                 oldname, newname):
+        self.__repository = repository
+        self.omode = omode
+        self.nmode = nmode
+        self.osha1 = osha1
+        self.nsha1 = nsha1
+        self.status = status
+        self.oldname = oldname
+        self.newname = newname
+
+    def __blob(self, sha1):
+        if sha1 == self.null_sha1:
+            return None
+        return self.__repository.get_blob(sha1)
+
+    @property
+    def oblob(self):
+        """The old L{Blob}, or C{None} if the file is new."""
+        return self.__blob(self.osha1)
+
+    @property
+    def nblob(self):
+        """The new L{Blob}, or C{None} if the file is gone."""
+        return self.__blob(self.nsha1)
+
+    def __repr__(self):
+        return 'FileDiff<%s %s %s>' % (self.status, self.oldname,
+                                       self.newname)
+
+
+_git_version = None
+
+
+def git_version():
+    """The version of git, as a tuple of numbers such as C{(2, 45, 1)},
+    or C{(0,)} if we can't tell. It is asked for once per process."""
+    global _git_version
+    if _git_version is None:
+        try:
+            v = Run('git', 'version').output_one_line()
+        except RunException:
+            v = ''
+        m = re.match(r'^git version (\d+(?:\.\d+)*)', v)
+        _git_version = (tuple(int(n) for n in m.group(1).split('.'))
+                        if m else (0,))
+    return _git_version
 
 
 class Repository(RunWithEnv):
@@ -809,14 +2143,28 @@ class Repository(RunWithEnv):
         self.__git_dir = directory
         self.__git_common_dir = utils.get_common_dir(directory)
         self.__refs = Refs(self)
-        self.__blobs = ObjectCache(lambda sha1: Blob(self, sha1))
-        self.__trees = ObjectCache(lambda sha1: Tree(self, sha1))
-        self.__commits = ObjectCache(lambda sha1: Commit(self, sha1))
+        self.__blobs = ObjectCache(lambda sha1: Blob(self, sha1),
+                                   max_entries=1000, max_bytes=32 << 20)
+        self.__trees = ObjectCache(lambda sha1: Tree(self, sha1),
+                                   max_entries=10000, max_bytes=32 << 20)
+        self.__commits = ObjectCache(lambda sha1: Commit(self, sha1),
+                                     max_entries=10000, max_bytes=16 << 20)
+        self.__caches = {
+            Blob.typename: self.__blobs,
+            Tree.typename: self.__trees,
+            Commit.typename: self.__commits,
+        }
         self.__default_index = None
         self.__default_worktree = None
         self.__default_iw = None
         self.__catfile = CatFileProcess(self)
+        self.__catfile_check = CatFileCheckProcess(self)
+        self.__objwriter = NoValue
+        self.__packreader = NoValue
         self.__difftree = DiffTreeProcesses(self)
+        self.__merge_tree_ok = config.get('stgit.mergebackend') != 'index'
+        self.__submodule_cache = SubmoduleCache(
+            os.path.join(self.__git_dir, 'stgit-submodules'))
 
     @property
     def env(self):
@@ -825,10 +2173,19 @@ class Repository(RunWithEnv):
     @classmethod
     def default(cls):
         """Return the default repository."""
-        try:
-            return cls(Run('git', 'rev-parse', '--git-dir').output_one_line())
-        except RunException:
+        d = basedir.discover()
+        if d is None:
             raise RepositoryException('Cannot find git repository')
+        return cls(d.git_dir)
+
+    @property
+    def __discovery(self):
+        """The L{basedir.Discovery} of the current directory, if it is
+        about this repository."""
+        d = basedir.discover()
+        if d and d.git_dir == os.path.abspath(self.__git_dir):
+            return d
+        return None
 
     @property
     def current_branch_name(self):
@@ -855,6 +2212,9 @@ class Repository(RunWithEnv):
         """A L{Worktree} object representing the default work tree."""
         if self.__default_worktree is None:
             path = environ_get('GIT_WORK_TREE', None)
+            d = self.__discovery
+            if not path and d and d.top_dir:
+                path = d.top_dir
             if not path:
                 o = Run('git', 'rev-parse', '--show-cdup').output_lines()
                 o = o or ['.']
@@ -872,6 +2232,12 @@ class Repository(RunWithEnv):
                                                  self.default_worktree)
         return self.__default_iw
 
+    def forget_status(self):
+        """Make the default L{IndexAndWorktree} look at the index and
+        the worktree again the next time it is asked about them."""
+        if self.__default_iw is not None:
+            self.__default_iw.forget_status()
+
     @property
     def directory(self):
         return self.__git_dir
@@ -884,20 +2250,87 @@ class Repository(RunWithEnv):
     def refs(self):
         return self.__refs
 
-    def cat_object(self, sha1, encoding='utf-8'):
-        return self.__catfile.cat_file(sha1, encoding)[1]
+    @property
+    def object_caches(self):
+        """The L{ObjectCache}s of the L{Blob}s, L{Tree}s and L{Commit}s,
+        by type name; for tuning their limits and reading their
+        statistics."""
+        return self.__caches
+
+    @property
+    def object_writer(self):
+        """The L{ObjectWriter} that new objects are written with, or
+        C{None} if they are written by git."""
+        if self.__objwriter is NoValue:
+            self.__objwriter = ObjectWriter.create(self)
+        return self.__objwriter
+
+    @property
+    def pack_reader(self):
+        """The L{PackReader} that objects are read with before asking
+        git, or C{None} if they are all read by git."""
+        if self.__packreader is NoValue:
+            self.__packreader = PackReader.create(self)
+        return self.__packreader
 
-    def rev_parse(self, rev, discard_stderr=False, object_type='commit'):
+    def cat_object(self, sha1, encoding='utf-8'):
+        return self.cat_objects([sha1], encoding)[0]
+
+    def cat_objects(self, sha1s, encoding='utf-8'):
+        """Like L{cat_object}, but for a list of objects, which are all
+        read in one batch."""
+        reader = self.pack_reader
+        if reader is None:
+            return [content for _, content
+                    in self.__catfile.cat_file_many(sha1s, encoding)]
+        sha1s = list(sha1s)
+        objects = [reader.read(sha1) for sha1 in sha1s]
+        fetched = iter(self.__catfile.cat_file_many(
+            [sha1 for sha1, obj in zip(sha1s, objects) if obj is None],
+            encoding))
+        contents = []
+        for obj in objects:
+            if obj is None:
+                contents.append(next(fetched)[1])
+            elif encoding:
+                contents.append(obj[1].decode(encoding))
+            else:
+                contents.append(obj[1])
+        return contents
+
+    def load_commits(self, commits):
+        """Read the data of all the given L{Commit}s that haven't got it
+        yet in one batch, instead of one commit at a time when each
+        C{data} is first used."""
+        todo = []
+        seen = set()
+        for c in commits:
+            if not c.has_data and c not in seen:
+                todo.append(c)
+                seen.add(c)
+        for c, s in zip(todo, self.cat_objects(c.sha1 for c in todo)):
+            c.set_raw_data(s)
+
+    def object_info(self, name):
+        """Return the (sha1, type, size) of the named object, or C{None}
+        if there is no such object. C{name} may be anything C{git
+        rev-parse} understands."""
+        return self.object_info_many([name])[0]
+
+    def object_info_many(self, names):
+        """Like L{object_info}, but for a list of objects, which are all
+        looked up in one batch."""
+        return self.__catfile_check.object_info_many(names)
+
+    def rev_parse(self, rev, object_type='commit'):
         assert object_type in ('commit', 'tree', 'blob')
         getter = getattr(self, 'get_' + object_type)
-        try:
-            return getter(
-                self.run(
-                    ['git', 'rev-parse', '%s^{%s}' % (rev, object_type)]
-                ).discard_stderr(discard_stderr).output_one_line()
-            )
-        except RunException:
+        info = None
+        if '\n' not in rev:
+            info = self.object_info('%s^{%s}' % (rev, object_type))
+        if info is None:
             raise RepositoryException('%s: No such %s' % (rev, object_type))
+        return getter(info[0])
 
     def get_blob(self, sha1):
         return self.__blobs[sha1]
@@ -920,6 +2353,11 @@ class Repository(RunWithEnv):
 
     @property
     def head_ref(self):
+        d = self.__discovery
+        if d and d.head:
+            if d.head == 'HEAD':
+                raise DetachedHeadException()
+            return d.head
         try:
             return self.run(['git', 'symbolic-ref', '-q', 'HEAD']
                             ).output_one_line()
@@ -927,6 +2365,7 @@ class Repository(RunWithEnv):
             raise DetachedHeadException()
 
     def set_head_ref(self, ref, msg):
+        basedir.forget_head()
         self.run(['git', 'symbolic-ref', '-m', msg, 'HEAD', ref]).no_output()
 
     def get_merge_bases(self, commit1, commit2):
@@ -941,7 +2380,148 @@ class Repository(RunWithEnv):
             ['git', 'describe', '--all', commit.sha1]
         ).discard_stderr().discard_exitcode().raw_output()
 
+    def merge_trees(self, base, ours, theirs):
+        """Do a three-way merge of the L{Tree}s C{base}, C{ours} and
+        C{theirs} without an index, if it can be done at the tree
+        level. The trees are walked together, and subtrees that are the
+        same on two sides are taken as they are without being read.
+        Return the resulting L{Tree}, or C{None} if a file has to have
+        its contents merged, or the merge needs more than this, such as
+        a file changed on one side and deleted on the other; L{merge_tree}
+        or L{Index.merge} can then be tried instead, which know about
+        merge drivers and the like. The new trees are written together
+        at the end."""
+        assert isinstance(base, Tree)
+        assert isinstance(ours, Tree)
+        assert isinstance(theirs, Tree)
+        new_trees = []
+        try:
+            tree = self.__merge_trees(base, ours, theirs, new_trees)
+        except MergeException:
+            return None
+        if tree is None:
+            return TreeData({}).commit(self)
+        self.commit_trees(new_trees)
+        return tree
+
+    def __merge_trees(self, base, ours, theirs, new_trees):
+        """Merge three trees, any of which may be C{None} for a tree
+        that isn't there. Return the merged tree, or C{None} if it is
+        empty. The L{TreeData} of the trees that have to be written are
+        added to C{new_trees}, subtrees first."""
+        if ours == theirs or base == theirs:
+            return ours
+        if base == ours:
+            return theirs
+        b = base.data.entries if base else {}
+        o = ours.data.entries if ours else {}
+        t = theirs.data.entries if theirs else {}
+        entries = {}
+        for name in set(b) | set(o) | set(t):
+            be, oe, te = b.get(name), o.get(name), t.get(name)
+            if oe == te or be == te:
+                e = oe
+            elif be == oe:
+                e = te
+            else:
+                e = self.__merge_entries(be, oe, te, new_trees)
+            if e is not None:
+                entries[name] = e
+        if not entries:
+            return None
+        treedata = TreeData(entries)
+        new_trees.append(treedata)
+        return self.get_tree(treedata.sha1)
+
+    __file_perms = ('100644', '100755')
+
+    def __merge_entries(self, base, ours, theirs, new_trees):
+        """Merge three different (I{permission}, I{object}) tree
+        entries, or C{None}s for entries that aren't there. Raise
+        L{MergeException} if we can't without merging the contents of
+        a file."""
+        perms = [e[0] for e in [base, ours, theirs] if e]
+        if ours and theirs and all(p == Tree.default_perm for p in perms):
+            tree = self.__merge_trees(base and base[1], ours[1], theirs[1],
+                                      new_trees)
+            return tree and (Tree.default_perm, tree)
+        if len(perms) == 3 and all(p in self.__file_perms for p in perms):
+            # One side changed the permissions, the other the contents.
+            if base[0] == ours[0] and base[1] == theirs[1]:
+                return (theirs[0], ours[1])
+            if base[0] == theirs[0] and base[1] == ours[1]:
+                return (ours[0], theirs[1])
+        raise MergeException('Changed on both sides')
+
+    def commit_trees(self, treedatas):
+        """Write the given L{TreeData}s, where the subtrees of each one
+        come before it, and return their L{Tree}s. Without the
+        L{object_writer}, they are all written by one C{git mktree}."""
+        writer = self.object_writer
+        if writer or len(treedatas) < 2:
+            return [td.commit(self) for td in treedatas]
+        sha1s = self.run(['git', 'mktree', '-z', '--batch']).raw_input(
+            ''.join(td.mktree_input() + '\0' for td in treedatas)
+        ).output_lines()
+        if sha1s != [td.sha1 for td in treedatas]:
+            raise RepositoryException('git mktree wrote unexpected trees')
+        return [self.get_tree(sha1) for sha1 in sha1s]
+
+    def merge_tree(self, base, ours, theirs):
+        """Do a three-way merge of the L{Tree}s C{base}, C{ours} and
+        C{theirs} with C{git merge-tree --write-tree}, which detects
+        renames and needs no index. Return the resulting L{Tree}, or
+        raise L{MergeConflictException} if there are conflicts; its
+        C{tree} then has the conflict markers in the conflicted files,
+        and C{unmerged} is their index entries, so that
+        L{IndexAndWorktree.checkout_conflicts} can check the merge out
+        without doing it again.
+
+        Return C{None} if git's C{merge-tree} can't do this (it only
+        takes trees for C{--merge-base} since git 2.45) or if
+        C{stgit.mergebackend} is set to C{index}; L{Index.merge} is
+        the one to use then."""
+        assert isinstance(base, Tree)
+        assert isinstance(ours, Tree)
+        assert isinstance(theirs, Tree)
+        if not self.__merge_tree_ok or git_version() < (2, 45):
+            return None
+        r = self.run(['git', 'merge-tree', '--write-tree', '-z',
+                      '--merge-base=%s' % base.sha1, ours.sha1, theirs.sha1]
+                     ).returns([0, 1])
+        fields = r.decoding(None).raw_output().split(b'\0')
+        tree = self.get_tree(fields[0].decode('utf-8'))
+        if not r.exitcode:
+            return tree
+        # The conflicted files ("mode sha1 stage\tpath"), an empty
+        # field, and the messages: each is the number of paths it is
+        # about, the paths, the kind of message and the message.
+        end = fields.index(b'', 1)
+        unmerged = [f.decode('utf-8') for f in fields[1:end]]
+        messages = []
+        i = end + 1
+        while i < len(fields) and fields[i]:
+            i += int(fields[i]) + 1
+            messages.append(fields[i + 1].decode('utf-8').rstrip('\n'))
+            i += 2
+        raise MergeConflictException(
+            [m for m in messages if m.startswith('CONFLICT')] or messages,
+            tree=tree, unmerged=unmerged)
+
     def simple_merge(self, base, ours, theirs):
+        """Do a three-way merge of the L{Tree}s C{base}, C{ours} and
+        C{theirs} in memory, with C{git merge-tree} or with a temporary
+        index, whichever works first. Return the resulting L{Tree}, or
+        C{None} if the merge has conflicts."""
+        result = self.merge_trees(base, ours, theirs)
+        if result is not None:
+            return result
+        try:
+            result = self.merge_tree(base, ours, theirs)
+        except MergeConflictException:
+            return None
+        if result is not None:
+            return result
         index = self.temp_index()
         try:
             result, index_tree = index.merge(base, ours, theirs)
@@ -958,26 +2538,73 @@ class Repository(RunWithEnv):
             return tree
         index = self.temp_index()
         try:
-            index.read_tree(tree)
+            if index.sparse:
+                entries = index.read_paths(
+                    tree, self.__patch_paths(patch_bytes))
+            else:
+                index.read_tree(tree)
             try:
                 index.apply(patch_bytes, quiet)
+                if index.sparse:
+                    return index.splice_tree(tree, entries)
                 return index.write_tree()
             except MergeException:
                 return None
         finally:
             index.delete()
 
-    def submodules(self, tree):
-        """Given a L{Tree}, return list of paths which are submodules."""
+    def __patch_paths(self, patch_bytes):
+        """The paths a patch touches, as C{git apply} sees them."""
+        fields = self.run(['git', 'apply', '--numstat', '-z']).encoding(
+            None).raw_input(patch_bytes).output_lines('\0')
+        paths = set()
+        i = iter(fields)
+        for f in i:
+            if not f:
+                continue
+            path = f.split('\t', 2)[2]
+            if path:
+                paths.add(path)
+            else:
+                # A rename or copy: the old and the new path follow.
+                paths.add(next(i))
+                paths.add(next(i))
+        return paths
+
+    def submodules(self, tree, base=None):
+        """Given a L{Tree}, return set of paths which are submodules.
+
+        The sets are cached on disk by tree. If the one of C{tree}
+        isn't, but the one of C{base} (a L{Tree}, such as the one of
+        the parent commit) or of the tree last asked about is, it is
+        worked out from the files that differ between the two trees."""
         assert isinstance(tree, Tree)
-        # A simple regex to match submodule entries
-        regex = re.compile(r'160000 commit [0-9a-f]{40}\t(.*)$')
-        # First, use ls-tree to get all the trees and links
-        files = self.run(
-            ['git', 'ls-tree', '-d', '-r', '-z', tree.sha1]
-        ).output_lines('\0')
-        # Then extract the paths of any submodules
-        return set(m.group(1) for m in map(regex.match, files) if m)
+        assert base is None or isinstance(base, Tree)
+        cache = self.__submodule_cache
+        paths = cache.get_paths(tree.sha1)
+        if paths is not None:
+            return set(paths)
+        for sha1 in [base and base.sha1, cache.latest()]:
+            paths = sha1 and cache.get_paths(sha1)
+            if paths is not None:
+                paths = set(paths)
+                for fd in self.diff_tree_files(self.get_tree(sha1), tree):
+                    if fd.omode == '160000' and fd.status[0] != 'C':
+                        paths.discard(fd.oldname)
+                    if fd.nmode == '160000':
+                        paths.add(fd.newname)
+                break
+        else:
+            # A simple regex to match submodule entries
+            regex = re.compile(r'160000 commit [0-9a-f]{40}\t(.*)$')
+            # First, use ls-tree to get all the trees and links
+            files = self.run(
+                ['git', 'ls-tree', '-d', '-r', '-z', tree.sha1]
+            ).output_lines('\0')
+            # Then extract the paths of any submodules
+            paths = set(m.group(1) for m in map(regex.match, files) if m)
+        cache.set_paths(tree.sha1, paths)
+        return paths
 
     def diff_tree(
         self, t1, t2, diff_opts, pathlimits=(), binary=True, stat=False
@@ -991,6 +2618,25 @@ class Repository(RunWithEnv):
         @return: Patch text"""
         assert isinstance(t1, Tree)
         assert isinstance(t2, Tree)
+        args = self.__diff_tree_args(diff_opts, pathlimits, binary, stat)
+        return self.__difftree.diff_trees(args, t1.sha1, t2.sha1)
+
+    def diff_trees(
+        self, pairs, diff_opts, pathlimits=(), binary=True, stat=False
+    ):
+        """Like L{diff_tree}, but for a list of (C{t1}, C{t2}) pairs of
+        L{Tree}s. The diffs are all computed by one C{git diff-tree}
+        process, and returned in the same order as C{pairs}."""
+        args = self.__diff_tree_args(diff_opts, pathlimits, binary, stat)
+        pairs = list(pairs)
+        for t1, t2 in pairs:
+            assert isinstance(t1, Tree)
+            assert isinstance(t2, Tree)
+        return self.__difftree.diff_trees_many(
+            args, [(t1.sha1, t2.sha1) for t1, t2 in pairs])
+
+    @staticmethod
+    def __diff_tree_args(diff_opts, pathlimits, binary, stat):
         if stat:
             args = ['--stat', '--summary']
             args.extend(o for o in diff_opts if o != '--binary')
@@ -1002,34 +2648,103 @@ class Repository(RunWithEnv):
         if pathlimits:
             args.append('--')
             args.extend(pathlimits)
-        return self.__difftree.diff_trees(args, t1.sha1, t2.sha1)
+        return args
 
     def diff_tree_files(self, t1, t2):
         """Given two L{Tree}s C{t1} and C{t2}, iterate over all files for
-        which they differ. For each file, yield a tuple with the old
-        file mode, the new file mode, the old blob, the new blob, the
-        status, the old filename, and the new filename. Except in case
-        of a copy or a rename, the old and new filenames are
+        which they differ. For each file, yield a L{FileDiff}. Except in
+        case of a copy or a rename, the old and new filenames are
         identical."""
         assert isinstance(t1, Tree)
         assert isinstance(t2, Tree)
         dt = self.__difftree.diff_trees(['-r', '-z'], t1.sha1, t2.sha1)
-        i = iter(dt.decode('utf-8').split('\0'))
-        try:
-            while True:
-                x = next(i)
-                if not x:
-                    continue
-                omode, nmode, osha1, nsha1, status = x[1:].split(' ')
-                fn1 = next(i)
-                if status[0] in ['C', 'R']:
-                    fn2 = next(i)
-                else:
-                    fn2 = fn1
-                yield (omode, nmode, self.get_blob(osha1),
-                       self.get_blob(nsha1), status, fn1, fn2)
-        except StopIteration:
-            pass
+        # Walk the NUL separated fields in place: a ":omode nmode osha1
+        # nsha1 status" field, and one file name after it, or two for a
+        # copy or a rename.
+        find = dt.find
+        pos = 0
+        while True:
+            i = find(b'\0', pos)
+            if i < 0:
+                break
+            if i == pos:
+                pos += 1
+                continue
+            omode, nmode, osha1, nsha1, status = dt[pos + 1:i].decode(
+                'ascii').split(' ')
+            pos = find(b'\0', i + 1)
+            fn1 = dt[i + 1:pos].decode('utf-8')
+            if status[0] in 'CR':
+                i, pos = pos, find(b'\0', pos + 1)
+                fn2 = dt[i + 1:pos].decode('utf-8')
+            else:
+                fn2 = fn1
+            pos += 1
+            yield FileDiff(self, omode, nmode, osha1, nsha1, status, fn1, fn2)
+
+
+def _tree_entries(tree, paths):
+    """The files in C{tree} at or under each of C{paths}, and the ones
+    that are where one of their parent directories would be, as a
+    mapping from path to (I{mode}, I{sha1})."""
+    entries = {}
+
+    def add_all(t, prefix):
+        for name, (mode, obj) in t.data.entries.items():
+            if mode == Tree.default_perm:
+                add_all(obj, prefix + name + '/')
+            else:
+                entries[prefix + name] = (mode, obj.sha1)
+
+    for path in paths:
+        t, prefix = tree, ''
+        names = path.split('/')
+        for i, name in enumerate(names):
+            e = t.data.entries.get(name)
+            if e is None:
+                break
+            mode, obj = e
+            if mode != Tree.default_perm:
+                entries[prefix + name] = (mode, obj.sha1)
+                break
+            if i == len(names) - 1:
+                add_all(obj, prefix + name + '/')
+            t, prefix = obj, prefix + name + '/'
+    return entries
+
+
+def _splice_tree(repository, tree, changes):
+    """Return C{tree} (which may be C{None} for no tree) with the files
+    in C{changes}, a mapping from path to (I{mode}, I{sha1}), or to
+    C{None} for a file that should be removed, replaced. Only the
+    directories that have changes are read and written again; the
+    result is C{None} if no files are left."""
+    entries = dict(tree.data.entries) if tree else {}
+    subchanges = {}
+    for path, e in changes.items():
+        name, slash, rest = path.partition('/')
+        if slash:
+            subchanges.setdefault(name, {})[rest] = e
+        elif e is None:
+            entries.pop(name, None)
+        else:
+            mode, sha1 = e
+            entries[name] = (mode, repository.get_object(
+                Commit.typename if mode == '160000' else Blob.typename, sha1))
+    for name, c in subchanges.items():
+        old = entries.get(name)
+        if old and old[0] == Tree.default_perm:
+            subtree = old[1]
+        else:
+            subtree = None
+        new = _splice_tree(repository, subtree, c)
+        if new is not None:
+            entries[name] = (Tree.default_perm, new)
+        elif subtree is not None:
+            del entries[name]
+    if not entries:
+        return None
+    return TreeData(entries).commit(repository)
 
 
 class MergeException(exception.StgException):
@@ -1037,25 +2752,188 @@ class MergeException(exception.StgException):
 
 
 class MergeConflictException(MergeException):
-    """Exception raised when a merge fails due to conflicts."""
+    """Exception raised when a merge fails due to conflicts. If the
+    merge was done without an index, C{tree} is the merged L{Tree},
+    with conflict markers, and C{unmerged} has the index entries of
+    the conflicted files, in C{git update-index --index-info}
+    format."""
 
-    def __init__(self, conflicts):
+    def __init__(self, conflicts, tree=None, unmerged=()):
         MergeException.__init__(self)
         self.conflicts = conflicts
+        self.tree = tree
+        self.unmerged = unmerged
+
+
+def _index_varint(data, i):
+    """Read one of the path prefix lengths of a version 4 index."""
+    c = data[i]
+    i += 1
+    n = c & 0x7f
+    while c & 0x80:
+        c = data[i]
+        i += 1
+        n = ((n + 1) << 7) | (c & 0x7f)
+    return n, i
+
+
+def _parse_index(data):
+    """Parse the contents of an index file, of version 2, 3 or 4.
+    Return the set of paths that have unmerged entries, and the sha1
+    of the tree the whole index would be written as, if the root of
+    its cache-tree is valid, or C{None}."""
+    signature, version, count = struct.unpack_from('>4sLL', data, 0)
+    if signature != b'DIRC' or version not in (2, 3, 4):
+        raise ValueError('Unsupported index file')
+    conflicts = set()
+    path = b''
+    i = 12
+    for _ in range(count):
+        start = i
+        flags, = struct.unpack_from('>H', data, i + 60)
+        i += 62
+        if flags & 0x4000:
+            # Extended flags
+            i += 2
+        if version == 4:
+            strip, i = _index_varint(data, i)
+            end = data.index(b'\0', i)
+            path = path[:len(path) - strip] + data[i:end]
+            i = end + 1
+        else:
+            end = data.index(b'\0', i)
+            path = data[i:end]
+            # Padded with NULs to a multiple of 8 bytes.
+            i = start + ((end - start + 8) & ~7)
+        if flags & 0x3000:
+            conflicts.add(path.decode('utf-8'))
+    tree = None
+    end = len(data) - 20
+    while i + 8 <= end:
+        signature = bytes(data[i:i + 4])
+        size, = struct.unpack_from('>L', data, i + 4)
+        i += 8
+        if signature == b'link':
+            # A split index; the entries are somewhere else too.
+            raise ValueError('Split index file')
+        if signature == b'TREE' and data[i:i + 1] == b'\0':
+            # The root comes first: an empty path, the number of
+            # entries it covers (-1 if it is invalid) and of subtrees,
+            # and its sha1.
+            nl = data.index(b'\n', i)
+            entries = int(bytes(data[i + 1:nl]).split(b' ')[0])
+            if entries >= 0:
+                tree = binascii.hexlify(
+                    bytes(data[nl + 1:nl + 21])).decode('ascii')
+        i += size
+    return conflicts, tree
+
+
+class IndexReader(object):
+    """Reads what L{Index} needs to know from an index file without
+    asking git: the paths with unmerged entries, and the tree the
+    whole index would be written as, when its cache-tree knows that.
+    The file is read again when its inode, mtime or size changes.
+    Enabled by setting C{stgit.indexreader} to true."""
+
+    def __init__(self, filename):
+        self.__filename = filename
+        self.__stamp = None
+        self.__conflicts = None
+        self.__tree = None
+
+    @classmethod
+    def create(cls, filename):
+        """Return an L{IndexReader} for the index file, or C{None} if
+        git should read it."""
+        if not config.getbool('stgit.indexreader'):
+            return None
+        if config.get('extensions.objectformat') not in [None, 'sha1']:
+            return None
+        return cls(filename)
+
+    def __load(self):
+        """Parse the file, unless it hasn't changed since the last
+        time. Return true if we know what is in it."""
+        try:
+            st = os.stat(self.__filename)
+        except OSError:
+            return False
+        stamp = (st.st_ino, getattr(st, 'st_mtime_ns', st.st_mtime),
+                 st.st_size)
+        if stamp != self.__stamp:
+            self.__stamp = stamp
+            try:
+                with open(self.__filename, 'rb') as f:
+                    data = bytearray(f.read())
+                self.__conflicts, self.__tree = _parse_index(data)
+            except (EnvironmentError, ValueError, struct.error,
+                    IndexError, UnicodeDecodeError):
+                self.__conflicts = self.__tree = None
+        return self.__conflicts is not None
+
+    def conflicts(self):
+        """The set of paths with unmerged entries, or C{None} if we
+        can't tell."""
+        if not self.__load():
+            return None
+        return set(self.__conflicts)
+
+    def is_clean(self, tree):
+        """Whether the index is the same as the L{Tree} C{tree}, or
+        C{None} if the cache-tree can't tell."""
+        if not self.__load():
+            return None
+        if self.__conflicts:
+            return False
+        if self.__tree is None:
+            return None
+        return self.__tree == tree.sha1
 
 
 class Index(RunWithEnv):
-    """Represents a git index file."""
+    """Represents a git index file.
+
+    A temporary index normally gets the whole tree it merges into read
+    into it. With C{stgit.tempindex} set to C{sparse}, it only gets the
+    entries for the paths the merge or patch touches instead, and the
+    result is spliced back into the full tree, so that the I/O doesn't
+    grow with the size of the repository."""
 
     def __init__(self, repository, filename):
         self.__repository = repository
+        self.__sparse = False
         if os.path.isdir(filename):
             # Create a temp index in the given directory.
             self.__filename = os.path.join(
                 filename, 'index.temp-%d-%x' % (os.getpid(), id(self)))
             self.delete()
+            self.__sparse = config.get('stgit.tempindex') == 'sparse'
         else:
             self.__filename = filename
+        self.__reader = NoValue
+
+    @property
+    def sparse(self):
+        """Whether this is a temporary index that only gets the entries
+        that are needed."""
+        return self.__sparse
+
+    @property
+    def repository(self):
+        return self.__repository
+
+    @property
+    def filename(self):
+        return self.__filename
+
+    @property
+    def reader(self):
+        """The L{IndexReader} for the index file, or C{None} if it is
+        read by git."""
+        if self.__reader is NoValue:
+            self.__reader = IndexReader.create(self.__filename)
+        return self.__reader
 
     @property
     def env(self):
@@ -1065,6 +2943,41 @@ class Index(RunWithEnv):
     def read_tree(self, tree):
         self.run(['git', 'read-tree', tree.sha1]).no_output()
 
+    def read_paths(self, tree, paths):
+        """Replace the contents of the index with just the entries of
+        C{tree} that C{paths} need: the files at or under each path,
+        and any file where one of its parent directories would be, so
+        that git still sees file/directory conflicts. Return those
+        entries, as a mapping from path to (I{mode}, I{sha1})."""
+        entries = _tree_entries(tree, paths)
+        self.delete()
+        self.run(['git', 'update-index', '-z', '--index-info']).input_nulterm(
+            '%s %s\t%s' % (mode, sha1, path)
+            for path, (mode, sha1) in sorted(entries.items())).no_output()
+        return entries
+
+    def splice_tree(self, tree, entries):
+        """Write the index contents, read with L{read_paths} as the
+        C{entries} of C{tree} and changed since, into C{tree}: replace
+        the entries that have changed, add the new ones and remove the
+        ones that are gone, and write new trees for just the
+        directories that change.
+        @return: The resulting L{Tree}
+        @rtype: L{Tree}"""
+        now = {}
+        for line in self.run(['git', 'ls-files', '-z', '-s']
+                             ).output_lines('\0'):
+            info, path = line.split('\t', 1)
+            mode, sha1, stage = info.split(' ')
+            if stage != '0':
+                raise MergeException('Conflicting merge')
+            now[path] = (mode, sha1)
+        changes = dict((path, e) for path, e in now.items()
+                       if entries.get(path) != e)
+        changes.update((path, None) for path in entries if path not in now)
+        return (_splice_tree(self.__repository, tree, changes)
+                or TreeData({}).commit(self.__repository))
+
     def write_tree(self):
         """Write the index contents to the repository.
         @return: The resulting L{Tree}
@@ -1080,6 +2993,9 @@ class Index(RunWithEnv):
 
     def is_clean(self, tree):
         """Check whether the index is clean relative to the given treeish."""
+        clean = self.cached_is_clean(tree)
+        if clean is not None:
+            return clean
         try:
             self.run(
                 ['git', 'diff-index', '--quiet', '--cached', tree.sha1]
@@ -1089,6 +3005,17 @@ class Index(RunWithEnv):
         else:
             return True
 
+    def cached_is_clean(self, tree):
+        """Check whether the index is clean relative to the given
+        treeish with the L{reader}, if there is one, and the index
+        file's cache-tree is valid. Return C{None} if it can't tell."""
+        reader = self.reader
+        if reader is None:
+            return None
+        if isinstance(tree, Commit):
+            tree = tree.data.tree
+        return reader.is_clean(tree)
+
     def apply(self, patch_bytes, quiet):
         """In-index patch application, no worktree involved."""
         try:
@@ -1122,7 +3049,13 @@ class Index(RunWithEnv):
         and C{theirs}) into the index if it's already there. The
         second half of the return value is the tree now stored in the
         index, or C{None} if unknown. If the merge succeeded, this is
-        often the merge result."""
+        often the merge result.
+
+        A sparse index never holds a whole tree: each merge replaces its
+        contents with just the entries of C{ours} that the merge touches,
+        which costs no more than the merge itself. So C{current} is of
+        no use there, and the second half of the return value is
+        C{None} unless the merge was trivial."""
         assert isinstance(base, Tree)
         assert isinstance(ours, Tree)
         assert isinstance(theirs, Tree)
@@ -1136,6 +3069,18 @@ class Index(RunWithEnv):
         if ours == theirs:
             return (ours, current)
 
+        if self.__sparse:
+            paths = set()
+            for fd in self.__repository.diff_tree_files(base, theirs):
+                paths.add(fd.oldname)
+                paths.add(fd.newname)
+            entries = self.read_paths(ours, paths)
+            try:
+                self.apply_treediff(base, theirs, quiet=True)
+                return (self.splice_tree(ours, entries), None)
+            except MergeException:
+                return (None, None)
+
         if current == theirs:
             # Swap the trees. It doesn't matter since merging is
             # symmetric, and will allow us to avoid the read_tree()
@@ -1156,6 +3101,10 @@ class Index(RunWithEnv):
 
     def conflicts(self):
         """The set of conflicting paths."""
+        reader = self.reader
+        paths = reader and reader.conflicts()
+        if paths is not None:
+            return paths
         paths = set()
         for line in self.run(['git', 'ls-files', '-z', '--unmerged']
                              ).output_lines('\0'):
@@ -1187,6 +3136,85 @@ class CheckoutException(exception.StgException):
     """Exception raised when a checkout fails."""
 
 
+class Status(object):
+    """A snapshot of how the index differs from C{HEAD}, and the
+    worktree from the index, made from the output of one C{git status
+    --porcelain=v2 -z --branch --no-renames}."""
+
+    __slots__ = ('__repository', 'head', 'staged', 'unstaged',
+                 'unstaged_submodules', 'conflicts')
+
+    def __init__(self, repository, fields):
+        self.__repository = repository
+        self.head = None
+        self.staged = set()
+        self.unstaged = set()
+        self.unstaged_submodules = set()
+        self.conflicts = set()
+        i = iter(fields)
+        for f in i:
+            if f.startswith('# branch.oid '):
+                oid = f.split(' ')[2]
+                if oid != '(initial)':
+                    self.head = oid
+                continue
+            kind = f[:2]
+            if kind == 'u ':
+                self.conflicts.add(f.split(' ', 10)[10])
+                continue
+            elif kind == '1 ':
+                path = f.split(' ', 8)[8]
+            elif kind == '2 ':
+                path = f.split(' ', 9)[9]
+                self.staged.add(next(i))
+            else:
+                continue
+            xy, sub = f[2:4], f[5:9]
+            if xy[0] != '.':
+                self.staged.add(path)
+            if xy[1] != '.':
+                if sub[0] != 'S':
+                    self.unstaged.add(path)
+                elif sub[1] == 'C' or sub[2] == 'M':
+                    # Untracked files alone don't make a submodule
+                    # changed.
+                    self.unstaged_submodules.add(path)
+
+    def is_head(self, treeish):
+        """Whether C{treeish}, a L{Commit} or a L{Tree}, is C{HEAD}
+        (or its tree) as it was for this snapshot."""
+        if self.head is None:
+            return False
+        if isinstance(treeish, Commit):
+            return treeish.sha1 == self.head
+        return self.__repository.get_commit(self.head).data.tree == treeish
+
+    def is_clean(self, treeish):
+        """Whether the index is clean relative to C{treeish}, or
+        C{None} if this snapshot can't tell."""
+        if not self.is_head(treeish):
+            return None
+        return not (self.staged or self.conflicts)
+
+    @property
+    def worktree_clean(self):
+        """Whether the worktree is clean relative to the index, not
+        counting submodules."""
+        return not (self.unstaged or self.conflicts)
+
+    def changed_files(self, treeish):
+        """The set of files that C{git diff-index I{treeish}} would
+        list, or C{None} if this snapshot can't tell: the ones changed
+        in the index or in the worktree. Like with diff-index, that is
+        an upper bound on the files whose contents differ from
+        C{treeish}, since it includes files that were changed in the
+        index and then changed back in the worktree."""
+        if not self.is_head(treeish):
+            return None
+        return (self.staged | self.unstaged | self.unstaged_submodules
+                | self.conflicts)
+
+
 class IndexAndWorktree(RunWithEnvCwd):
     """Represents a git index and a worktree. Anything that an index or
     worktree can do on their own are handled by the L{Index} and
@@ -1196,6 +3224,8 @@ class IndexAndWorktree(RunWithEnvCwd):
     def __init__(self, index, worktree):
         self.__index = index
         self.__worktree = worktree
+        self.__status = NoValue
+        self.__status_stamp = None
 
     @property
     def index(self):
@@ -1213,8 +3243,65 @@ class IndexAndWorktree(RunWithEnvCwd):
     def cwd(self):
         return self.__worktree.directory
 
+    def __index_stamp(self):
+        try:
+            st = os.stat(self.__index.filename)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def status(self):
+        """A L{Status} snapshot of the index and the worktree, made
+        with one C{git status} and kept until the index file changes, we
+        change the worktree, or L{forget_status} is called (as it is at
+        the start and end of each L{StackTransaction
+        <stgit.lib.transaction.StackTransaction>}); or C{None} if git
+        can't make one."""
+        stamp = self.__index_stamp()
+        if self.__status is NoValue or stamp != self.__status_stamp:
+            try:
+                fields = self.run(
+                    ['git', 'status', '--porcelain=v2', '-z', '--branch',
+                     '--no-renames', '--untracked-files=no',
+                     '--ignore-submodules=none']
+                ).discard_stderr().output_lines('\0')
+            except RunException:
+                self.__status = None
+            else:
+                self.__status = Status(self.__index.repository, fields)
+            # git status may have refreshed the index.
+            self.__status_stamp = self.__index_stamp()
+        return self.__status
+
+    def forget_status(self):
+        """Make the next L{status} look at the index and the worktree
+        again."""
+        self.__status = NoValue
+
+    def conflicts(self):
+        """The set of conflicting paths."""
+        if self.__index.reader is not None:
+            return self.__index.conflicts()
+        st = self.status()
+        if st is None:
+            return self.__index.conflicts()
+        return set(st.conflicts)
+
+    def is_clean(self, treeish):
+        """Check whether the index is clean relative to the given
+        treeish."""
+        clean = self.__index.cached_is_clean(treeish)
+        if clean is not None:
+            return clean
+        st = self.status()
+        clean = st and st.is_clean(treeish)
+        if clean is None:
+            return self.__index.is_clean(treeish)
+        return clean
+
     def checkout_hard(self, tree):
         assert isinstance(tree, Tree)
+        self.forget_status()
         self.run(['git', 'read-tree', '--reset', '-u', tree.sha1]
                  ).discard_output()
 
@@ -1223,6 +3310,7 @@ class IndexAndWorktree(RunWithEnvCwd):
         # have a problem. Or maybe we should stash changes in a patch?
         assert isinstance(old_tree, Tree)
         assert isinstance(new_tree, Tree)
+        self.forget_status()
         try:
             self.run(['git', 'read-tree', '-u', '-m',
                       '--exclude-per-directory=.gitignore',
@@ -1235,6 +3323,7 @@ class IndexAndWorktree(RunWithEnvCwd):
         assert isinstance(base, Tree)
         assert isinstance(ours, Tree)
         assert isinstance(theirs, Tree)
+        self.forget_status()
         try:
             r = self.run(
                 [
@@ -1263,14 +3352,46 @@ class IndexAndWorktree(RunWithEnvCwd):
         except RunException:
             raise MergeException('Index/worktree dirty')
 
+    def checkout_conflicts(self, old_tree, conflict, interactive=False):
+        """Check out the result of a merge that had conflicts, but was
+        done without this index and worktree (see
+        L{Repository.merge_tree}): the merged tree, with the conflicted
+        files as unmerged index entries. Then raise C{conflict}, or let
+        the user resolve the conflicts if C{interactive}, like
+        L{merge}."""
+        assert isinstance(old_tree, Tree)
+        assert conflict.tree is not None
+        try:
+            self.checkout(old_tree, conflict.tree)
+        except CheckoutException:
+            raise MergeException('Index/worktree dirty')
+        # The merged entries of the conflicted paths have to go before
+        # the unmerged ones can be added.
+        paths = []
+        for entry in conflict.unmerged:
+            path = entry.split('\t', 1)[1]
+            if path not in paths:
+                paths.append(path)
+        null = '0' * len(conflict.tree.sha1)
+        self.run(['git', 'update-index', '-z', '--index-info']).raw_input(
+            ''.join(['0 %s\t%s\0' % (null, path) for path in paths]
+                    + [entry + '\0' for entry in conflict.unmerged])
+        ).discard_output()
+        self.forget_status()
+        if interactive:
+            self.mergetool()
+        else:
+            raise conflict
+
     def mergetool(self, files=()):
         """Invoke 'git mergetool' on the current IndexAndWorktree to resolve
         any outstanding conflicts. If 'not files', all the files in an
         unmerged state will be processed."""
+        self.forget_status()
         self.run(['git', 'mergetool'] + list(files)).returns([0, 1]).run()
         # check for unmerged entries (prepend 'CONFLICT ' for consistency with
         # merge())
-        conflicts = ['CONFLICT ' + f for f in self.index.conflicts()]
+        conflicts = ['CONFLICT ' + f for f in self.conflicts()]
         if conflicts:
             raise MergeConflictException(conflicts)
 
@@ -1315,12 +3436,19 @@ class IndexAndWorktree(RunWithEnvCwd):
     def changed_files(self, tree, pathlimits=[]):
         """Return the set of files in the worktree that have changed with
         respect to C{tree}. The listing is optionally restricted to
-        those files that match any of the path limiters given.
+        those files that match any of the path limiters given. Files
+        changed in the index and back in the worktree are included, as
+        C{git diff-index} includes them; refreshing such a file just
+        puts it back in the index as it is.
 
         The path limiters are relative to the current working
         directory; the returned file names are relative to the
         repository root."""
         assert isinstance(tree, Tree)
+        st = None if pathlimits else self.status()
+        changed = st and st.changed_files(tree)
+        if changed is not None:
+            return changed
         return set(
             self.run_in_cwd(
                 ['git', 'diff-index', tree.sha1, '--name-only', '-z', '--']
@@ -1331,12 +3459,16 @@ class IndexAndWorktree(RunWithEnvCwd):
     def update_index(self, paths):
         """Update the index with files from the worktree. C{paths} is an
         iterable of paths relative to the root of the repository."""
+        self.forget_status()
         cmd = ['git', 'update-index', '--remove']
         self.run(cmd + ['-z', '--stdin']
                  ).input_nulterm(paths).discard_output()
 
     def worktree_clean(self):
         """Check whether the worktree is clean relative to index."""
+        st = self.status()
+        if st is not None:
+            return st.worktree_clean
         try:
             self.run(
                 ['git', 'update-index', '--ignore-submodules', '--refresh']
@@ -1400,15 +3532,25 @@ class Branch(object):
         if create_at:
             cmd.append(create_at.sha1)
         repository.run(['git', 'branch', create_at.sha1]).discard_output()
+        repository.refs.forget('refs/heads/%s' % name)
 
         return cls(repository, name)
 
 
-def diffstat(diff):
-    """Return the diffstat of the supplied diff."""
+def _diffstat_run(diff):
     return (Run('git', 'apply', '--stat', '--summary')
             .encoding(None).raw_input(diff)
-            .decoding('utf-8').raw_output())
+            .decoding('utf-8'))
+
+
+def diffstat(diff):
+    """Return the diffstat of the supplied diff."""
+    return _diffstat_run(diff).raw_output()
+
+
+def diffstats(diffs):
+    """Return the diffstats of a list of diffs, computed in parallel."""
+    return run_many(_diffstat_run(diff) for diff in diffs)
 
 
 def clone(remote, local):
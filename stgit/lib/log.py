@@ -125,20 +125,27 @@ class LogParseException(LogException):
     pass
 
 
-def patch_file(repo, cd):
-    metadata = '\n'.join([
-        'Bottom: %s' % cd.parent.data.tree.sha1,
-        'Top:    %s' % cd.tree.sha1,
-        'Author: %s' % cd.author.name_email,
-        'Date:   %s' % cd.author.date,
-        '',
-        cd.message,
-        '',
-        '---',
-        '',
-    ]).encode('utf-8')
-    diff = repo.diff_tree(cd.parent.data.tree, cd.tree, ['-M']).strip()
-    return repo.commit(git.BlobData(metadata + diff + b'\n'))
+def patch_files(repo, cds):
+    """Return the patch file blobs for a list of L{CommitData} objects;
+    their diffs are computed in one batch."""
+    diffs = repo.diff_trees(
+        [(cd.parent.data.tree, cd.tree) for cd in cds], ['-M'])
+    blobs = []
+    for cd, diff in zip(cds, diffs):
+        metadata = '\n'.join([
+            'Bottom: %s' % cd.parent.data.tree.sha1,
+            'Top:    %s' % cd.tree.sha1,
+            'Author: %s' % cd.author.name_email,
+            'Date:   %s' % cd.author.date,
+            '',
+            cd.message,
+            '',
+            '---',
+            '',
+        ]).encode('utf-8')
+        blobs.append(
+            repo.commit(git.BlobData(metadata + diff.strip() + b'\n')))
+    return blobs
 
 
 def log_ref(branch):
@@ -255,10 +262,11 @@ class LogEntry(object):
     def from_commit(cls, repo, commit):
         """Parse a (full or simplified) stack log commit."""
         message = commit.data.message
-        try:
-            perm, meta = commit.data.tree.data.entries['meta']
-        except KeyError:
+        # Look up the metadata blob without listing the whole tree.
+        info = repo.object_info('%s:meta' % commit.sha1)
+        if info is None or info[1] != git.Blob.typename:
             raise LogParseException('Not a stack log')
+        meta = repo.get_blob(info[0])
         (
             prev, head, applied, unapplied, hidden, patches
         ) = cls.__parse_metadata(repo, meta.data.bytes.decode('utf-8'))
@@ -298,23 +306,23 @@ class LogEntry(object):
 
     def __tree(self, metadata):
         if self.prev is None:
-            def pf(c):
-                return patch_file(self.__repo, c.data)
+            c2b = {}
         else:
             prev_top_tree = self.prev.commit.data.tree
             perm, prev_patch_tree = prev_top_tree.data.entries['patches']
-            # Map from Commit object to patch_file() results taken
+            # Map from Commit object to patch_files() results taken
             # from the previous log entry.
             c2b = dict((self.prev.patches[pn], pf) for pn, pf
                        in prev_patch_tree.data.entries.items())
 
-            def pf(c):
-                r = c2b.get(c, None)
-                if not r:
-                    r = patch_file(self.__repo, c.data)
-                return r
-
-        patches = dict((pn, pf(c)) for pn, c in self.patches.items())
+        # Make patch files for all the commits not in the previous log
+        # entry in one go, so that their diffs are computed in one batch.
+        new = list(set(c for c in self.patches.values() if c not in c2b))
+        self.__repo.load_commits(new)
+        self.__repo.load_commits(c.data.parent for c in new)
+        c2b.update(zip(new, patch_files(self.__repo,
+                                        [c.data for c in new])))
+        patches = dict((pn, c2b[c]) for pn, c in self.patches.items())
         return self.__repo.commit(
             git.TreeData(
                 {
@@ -55,12 +55,18 @@ class Patch(object):
 
     def __write_compat_files(self, new_commit, msg):
         """Write files used by the old infrastructure."""
+        files = []
+
         def write(name, val, multiline=False):
-            fn = os.path.join(self.__compat_dir, name)
-            if val:
-                utils.write_string(fn, val, multiline)
-            elif os.path.isfile(fn):
-                os.remove(fn)
+            files.append((name, val, multiline))
+
+        def write_files():
+            for name, val, multiline in files:
+                fn = os.path.join(self.__compat_dir, name)
+                if val:
+                    utils.write_string(fn, val, multiline)
+                elif os.path.isfile(fn):
+                    os.remove(fn)
 
         def write_patchlog():
             try:
@@ -94,12 +100,16 @@ class Patch(object):
             old_bottom_sha1 = None
         write('top.old', old_top_sha1)
         write('bottom.old', old_bottom_sha1)
+        self.__stack.repository.refs.after_commit(write_files)
 
     def __delete_compat_files(self):
-        if os.path.isdir(self.__compat_dir):
-            for f in os.listdir(self.__compat_dir):
-                os.remove(os.path.join(self.__compat_dir, f))
-            os.rmdir(self.__compat_dir)
+        def delete_files():
+            if os.path.isdir(self.__compat_dir):
+                for f in os.listdir(self.__compat_dir):
+                    os.remove(os.path.join(self.__compat_dir, f))
+                os.rmdir(self.__compat_dir)
+
+        self.__stack.repository.refs.after_commit(delete_files)
         try:
             # this compatibility log ref might not exist
             self.__stack.repository.refs.delete(self.__log_ref)
@@ -123,12 +133,11 @@ class Patch(object):
     def files(self):
         """Return the set of files this patch touches."""
         fs = set()
-        for dt in self.__stack.repository.diff_tree_files(
+        for fd in self.__stack.repository.diff_tree_files(
             self.commit.data.parent.data.tree, self.commit.data.tree,
         ):
-            _, _, _, _, _, oldname, newname = dt
-            fs.add(oldname)
-            fs.add(newname)
+            fs.add(fd.oldname)
+            fs.add(fd.newname)
         return fs
 
 
@@ -156,7 +165,10 @@ class PatchOrder(object):
         val = tuple(val)
         if val != self.__lists.get(name, None):
             self.__lists[name] = val
-            self.__write_file(name, val)
+            self.__stack.repository.refs.after_commit(
+                lambda: self.__write_file(name, val),
+                lambda: self.__lists.pop(name, None),
+            )
 
     @property
     def applied(self):
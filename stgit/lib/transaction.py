@@ -16,6 +16,7 @@ from stgit import exception, utils
 from stgit.config import config
 from stgit.lib import git, log
 from stgit.out import out
+from stgit.run import RunException
 
 
 class TransactionException(exception.StgException):
@@ -123,6 +124,10 @@ class StackTransaction(object):
         else:
             self.__allow_conflicts = allow_conflicts
         self.__temp_index = self.temp_index_tree = None
+        # The worktree may have been edited since we last looked.
+        self.__stack.repository.forget_status()
+        if check_clean_iw:
+            check_clean_iw.forget_status()
         if not allow_bad_head:
             self.__assert_head_top_equal()
         if check_clean_iw:
@@ -210,7 +215,7 @@ class StackTransaction(object):
     def __assert_index_worktree_clean(self, iw):
         if not iw.worktree_clean():
             self.__halt('Worktree not clean. Use "refresh" or "reset --hard"')
-        if not iw.index.is_clean(self.stack.head):
+        if not iw.is_clean(self.stack.head):
             self.__halt('Index not clean. Use "refresh" or "reset --hard"')
 
     def __checkout(self, tree, iw, allow_bad_head):
@@ -224,7 +229,7 @@ class StackTransaction(object):
             if (
                 self.__allow_conflicts(self)
                 or iw is None
-                or not iw.index.conflicts()
+                or not iw.conflicts()
             ):
                 return
             out.error('Need to resolve conflicts first')
@@ -265,26 +270,23 @@ class StackTransaction(object):
         self.__check_consistency()
         log.log_external_mods(self.__stack)
         new_head = self.head
+        if not self.__conflicts:
+            msg = self.__msg
+        else:
+            msg = self.__msg + ' (CONFLICT)'
 
-        # Set branch head.
-        if set_head:
-            if iw:
-                try:
-                    self.__checkout(new_head.data.tree, iw, allow_bad_head)
-                except git.CheckoutException:
-                    # We have to abort the transaction.
-                    self.abort(iw)
-                    self.__abort()
-            self.__stack.set_head(new_head, self.__msg)
-
-        if self.__error:
-            if self.__conflicts:
-                out.error(*([self.__error] + self.__conflicts))
-            else:
-                out.error(self.__error)
+        # All the refs -- branch head, patches and stack log -- are
+        # queued and locked before the worktree is touched, and
+        # written together at the end; the stack's files only after
+        # that.
+        if set_head and iw and not allow_bad_head:
+            self.__assert_head_top_equal()
+        ref_trans = self.__stack.repository.refs.transaction(msg)
+        try:
+            if set_head:
+                self.__stack.set_head(new_head, self.__msg)
 
-        # Write patches.
-        def write(msg):
+            # Write patches.
             for pn, commit in self.__patches.items():
                 if self.__stack.patches.exists(pn):
                     p = self.__stack.patches.get(pn)
@@ -294,16 +296,48 @@ class StackTransaction(object):
                         p.set_commit(commit, msg)
                 else:
                     self.__stack.patches.new(pn, commit, msg)
+            old_applied = self.__stack.patchorder.applied
             self.__stack.patchorder.applied = self.__applied
             self.__stack.patchorder.unapplied = self.__unapplied
             self.__stack.patchorder.hidden = self.__hidden
             log.log_entry(self.__stack, msg)
 
-        old_applied = self.__stack.patchorder.applied
-        if not self.__conflicts:
-            write(self.__msg)
-        else:
-            write(self.__msg + ' (CONFLICT)')
+            try:
+                ref_trans.prepare()
+            except RunException:
+                self.__abort()
+
+            # Set branch head.
+            if set_head and iw:
+                try:
+                    self.__checkout(new_head.data.tree, iw, True)
+                except git.CheckoutException:
+                    # We have to abort the transaction.
+                    ref_trans.abort()
+                    self.abort(iw)
+                    self.__abort()
+
+            # The patch order and the patches' compat files were queued
+            # too, and are written only if the refs are.
+            try:
+                ref_trans.commit()
+            except RunException:
+                if set_head:
+                    self.abort(iw)
+                self.__abort()
+        except BaseException:
+            ref_trans.abort()
+            raise
+        finally:
+            self.__stack.repository.forget_status()
+            if iw:
+                iw.forget_status()
+
+        if self.__error:
+            if self.__conflicts:
+                out.error(*([self.__error] + self.__conflicts))
+            else:
+                out.error(self.__error)
         if print_current_patch:
             _print_current_patch(old_applied, self.__applied)
 
@@ -364,6 +398,22 @@ class StackTransaction(object):
                     out.info('Deleted %s%s' % (pn, s))
         return popped
 
+    def __merge(self, base, ours, theirs):
+        """Merge the trees in memory, with git merge-tree, or with the
+        temporary index, whichever works first. Return the resulting
+        tree, or C{None} if there are conflicts. If git merge-tree
+        found the conflicts, raise its L{git.MergeConflictException}
+        instead, since it already has the merge result."""
+        repository = self.__stack.repository
+        tree = repository.merge_trees(base, ours, theirs)
+        if tree is not None:
+            return tree
+        tree = repository.merge_tree(base, ours, theirs)
+        if tree is None:
+            tree, self.temp_index_tree = self.temp_index.merge(
+                base, ours, theirs, self.temp_index_tree)
+        return tree
+
     def push_patch(self, pn, iw=None, allow_interactive=False,
                    already_merged=False):
         """Attempt to push the named patch. If this results in conflicts,
@@ -374,6 +424,7 @@ class StackTransaction(object):
         cd = orig_cd.set_committer(None)
         oldparent = cd.parent
         cd = cd.set_parent(self.top)
+        conflict = None
         if already_merged:
             # the resulting patch is empty
             tree = cd.parent.data.tree
@@ -381,8 +432,11 @@ class StackTransaction(object):
             base = oldparent.data.tree
             ours = cd.parent.data.tree
             theirs = cd.tree
-            tree, self.temp_index_tree = self.temp_index.merge(
-                base, ours, theirs, self.temp_index_tree)
+            try:
+                tree = self.__merge(base, ours, theirs)
+            except git.MergeConflictException as e:
+                tree = None
+                conflict = e
         s = ''
         merge_conflict = False
         if not tree:
@@ -395,7 +449,11 @@ class StackTransaction(object):
             try:
                 interactive = (allow_interactive and
                                config.getbool('stgit.autoimerge'))
-                iw.merge(base, ours, theirs, interactive=interactive)
+                if conflict is None:
+                    iw.merge(base, ours, theirs, interactive=interactive)
+                else:
+                    iw.checkout_conflicts(ours, conflict,
+                                          interactive=interactive)
                 tree = iw.index.write_tree()
                 self.__current_tree = tree
                 s = 'modified'
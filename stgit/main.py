@@ -163,6 +163,7 @@ def _main():
 
     # re-build the command line arguments
     cmd = commands.canonical_cmd(cmd)
+    run.set_budget_command(cmd)
     sys.argv[0] += ' %s' % cmd
     del sys.argv[1]
 
@@ -228,3 +229,6 @@ def main():
         _main()
     finally:
         run.finish_logging()
+        out.flush()
+        if run.budget_exceeded():
+            sys.exit(utils.STGIT_COMMAND_ERROR)
@@ -122,6 +122,14 @@ class MessagePrinter(object):
         """Write encoded byte data to the error output."""
         self.__stderr.write_bytes(byte_data)
 
+    def flush(self):
+        """Write out what is buffered for stdout and the error output.
+        Bytes go straight to the buffer under the text layer, which
+        would otherwise only be flushed if the file object happened to
+        be finalized before the process exits."""
+        self.__stdout.flush()
+        self.__stderr.flush()
+
     def info(self, *msgs):
         for msg in msgs:
             self.__out.single_line(msg)
@@ -6,9 +6,19 @@ from __future__ import (
     unicode_literals,
 )
 
+import base64
+import codecs
 import datetime
+import hashlib
 import io
+import json
+import multiprocessing
+import os
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 from stgit.compat import (
     environ_copy,
@@ -44,16 +54,27 @@ class RunException(StgException):
     pass
 
 
+class SubprocessBudgetException(StgException):
+    """Thrown when running a subprocess would go over the budget set in
+    $STGIT_SUBPROCESS_BUDGET. (Deliberately not a L{RunException}, so
+    that code prepared for a failing command doesn't swallow it.)"""
+
+    pass
+
+
 def get_log_mode(spec):
     if ':' not in spec:
         spec += ':'
     (log_mode, outfile) = spec.split(':', 1)
-    all_log_modes = ['debug', 'profile']
+    all_log_modes = ['debug', 'profile', 'trace']
     if log_mode and log_mode not in all_log_modes:
         out.warn(('Unknown log mode "%s" specified in $STGIT_SUBPROCESS_LOG.'
                   % log_mode),
                  'Valid values are: %s' % ', '.join(all_log_modes))
-    if outfile:
+    if log_mode == 'trace':
+        # The trace file is JSON, written in one go by finish_logging().
+        f = outfile or None
+    elif outfile:
         f = MessagePrinter(io.open(outfile, 'a', encoding='utf-8'))
     else:
         f = out
@@ -64,6 +85,14 @@ _log_mode, _logfile = get_log_mode(environ_get('STGIT_SUBPROCESS_LOG', ''))
 if _log_mode == 'profile':
     _log_starttime = datetime.datetime.now()
     _log_subproctime = 0.0
+elif _log_mode == 'trace':
+    _trace_starttime = time.time()
+    _trace_events = []
+    _trace_lock = threading.Lock()
+
+# Commands started with Run.start() finish, and are logged, in threads
+# of their own.
+_log_lock = threading.Lock()
 
 
 def duration(t1, t2):
@@ -75,7 +104,94 @@ def duration(t1, t2):
     )
 
 
+def _trace_us(t):
+    """Convert a time.time() value to trace microseconds."""
+    return int(round((t - _trace_starttime) * 1e6))
+
+
+def trace_group(cmd):
+    """Return the name a command is grouped under in the trace summary:
+    the subcommand for git, the program name for anything else."""
+    if cmd[0] == 'git' and len(cmd) > 1:
+        return 'git %s' % cmd[1]
+    return cmd[0]
+
+
+def _trace_span(cmd, cat, starttime, args):
+    """Record a span of the given category, from C{starttime} until
+    now, for the command C{cmd}."""
+    n = time.time()
+    args = dict(args, argv=cmd)
+    event = {
+        'name': trace_group(cmd),
+        'cat': cat,
+        'ph': 'X',
+        'ts': _trace_us(starttime),
+        'dur': int(round((n - starttime) * 1e6)),
+        'pid': os.getpid(),
+        'tid': threading.current_thread().ident,
+        'args': args,
+    }
+    with _trace_lock:
+        _trace_events.append(event)
+
+
+def _percentile(values, p):
+    """Nearest-rank percentile of a sorted, non-empty list."""
+    return values[max((len(values) * p + 99) // 100 - 1, 0)]
+
+
+def _trace_summary(events, total):
+    groups = {}
+    for e in events:
+        groups.setdefault(e['name'], []).append(e['dur'] * 1e-6)
+    rows = [(name, len(ds), sum(ds), _percentile(sorted(ds), 50),
+             _percentile(sorted(ds), 99))
+            for name, ds in groups.items()]
+    rows.sort(key=lambda r: r[2], reverse=True)
+    python = total - sum(r[2] for r in rows)
+    width = max([len('(python)')] + [len(r[0]) for r in rows])
+    lines = ['%-*s %7s %9s %9s %9s %6s' % (
+        width, 'command', 'count', 'total', 'p50', 'p99', '%')]
+    for name, count, tot, p50, p99 in rows:
+        lines.append('%-*s %7d %8.3fs %8.3fs %8.3fs %5.1f%%' % (
+            width, name, count, tot, p50, p99, 100 * tot / total))
+    lines.append('%-*s %7s %8.3fs %9s %9s %5.1f%%' % (
+        width, '(python)', '', python, '', '', 100 * python / total))
+    lines.append('%-*s %7s %8.3fs' % (width, 'total', '', total))
+    return '\n'.join(lines) + '\n'
+
+
+def _finish_trace():
+    end = time.time()
+    total = end - _trace_starttime
+    with _trace_lock:
+        events = list(_trace_events)
+    if _logfile:
+        process = {
+            'name': 'stg',
+            'cat': 'stgit',
+            'ph': 'X',
+            'ts': 0,
+            'dur': _trace_us(end),
+            'pid': os.getpid(),
+            'tid': 0,
+            'args': {'argv': sys.argv},
+        }
+        with io.open(_logfile, 'w', encoding='utf-8') as f:
+            f.write(text(json.dumps(
+                {'traceEvents': [process] + events,
+                 'displayTimeUnit': 'ms'},
+                indent=1, sort_keys=True)))
+            f.write('\n')
+    out.err_raw(_trace_summary(events, total))
+
+
 def finish_logging():
+    _finish_budget()
+    if _log_mode == 'trace':
+        _finish_trace()
+        return
     if _log_mode != 'profile':
         return
     ttime = duration(_log_starttime, datetime.datetime.now())
@@ -88,6 +204,400 @@ def finish_logging():
             rtime, 100 * rtime / ttime))
 
 
+def _env_delta(env):
+    """Return the variables in C{env} that differ from our own
+    environment."""
+    if env is None:
+        return {}
+    return dict((k, v) for k, v in env.items() if environ_get(k) != v)
+
+
+def _b64(data):
+    if data is None:
+        return None
+    return base64.b64encode(data).decode('ascii')
+
+
+def _unb64(data):
+    if data is None:
+        return b''
+    return base64.b64decode(data.encode('ascii'))
+
+
+class _Recorder(object):
+    """Writes one JSON object per finished command to the file named by
+    $STGIT_RECORD, for L{_Replayer} to serve later. The file is
+    overwritten, so record one StGit command per file."""
+
+    def __init__(self, filename):
+        self.__filename = filename
+        self.__file = None
+        self.__lock = threading.Lock()
+
+    def __write(self, entry):
+        with self.__lock:
+            if self.__file is None:
+                self.__file = io.open(self.__filename, 'w', encoding='utf-8')
+            self.__file.write(text(json.dumps(entry, sort_keys=True)))
+            self.__file.write('\n')
+            self.__file.flush()
+
+    def record(self, cmd, cwd, env, indata, outdata, errdata, exitcode):
+        self.__write({
+            'argv': cmd,
+            'cwd': cwd,
+            'env': _env_delta(env),
+            'stdin': _b64(indata),
+            'stdout': _b64(outdata),
+            'stderr': _b64(errdata),
+            'exitcode': exitcode,
+        })
+
+    def record_exchange(self, cmd, cwd, env, exchange, exitcode):
+        """Record a long-lived process, such as C{git cat-file --batch},
+        as the sequence of (C{'in'} or C{'out'}, bytes) chunks that
+        went to and came from it."""
+        self.__write({
+            'argv': cmd,
+            'cwd': cwd,
+            'env': _env_delta(env),
+            'exchange': [(d, _b64(data)) for d, data in exchange],
+            'exitcode': exitcode,
+        })
+
+    def background(self, p, cmd, cwd, env):
+        return _RecordedProcess(self, p, cmd, cwd, env)
+
+
+class _RecordedProcess(object):
+    """Stands in for the C{Popen} object of a background process while
+    recording: relays its stdin and stdout through pipes of our own,
+    noting every chunk that passes, and records the exchange when the
+    process is waited for."""
+
+    def __init__(self, recorder, p, cmd, cwd, env):
+        self.__recorder = recorder
+        self.__p = p
+        self.__args = (cmd, cwd, env)
+        self.__exchange = []
+        self.__lock = threading.Lock()
+        self.pid = p.pid
+        self.stderr = p.stderr
+        in_r, in_w = os.pipe()
+        out_r, out_w = os.pipe()
+        self.stdin = os.fdopen(in_w, 'wb')
+        self.stdout = os.fdopen(out_r, 'rb')
+
+        def relay(src, dst, direction, close):
+            while True:
+                data = os.read(src, 65536)
+                if not data:
+                    break
+                with self.__lock:
+                    self.__exchange.append((direction, data))
+                try:
+                    os.write(dst, data)
+                except OSError:
+                    break
+            close()
+
+        def close_stdin():
+            os.close(in_r)
+            p.stdin.close()
+
+        self.__threads = [
+            threading.Thread(target=relay, args=(
+                in_r, p.stdin.fileno(), 'in', close_stdin)),
+            threading.Thread(target=relay, args=(
+                p.stdout.fileno(), out_w, 'out', lambda: os.close(out_w))),
+        ]
+        for t in self.__threads:
+            t.daemon = True
+            t.start()
+
+    def terminate(self):
+        self.__p.terminate()
+
+    def wait(self):
+        exitcode = self.__p.wait()
+        # The stdin relay is left alone, since our user need not have
+        # closed its end of the pipe.
+        self.__threads[1].join()
+        with self.__lock:
+            exchange = list(self.__exchange)
+        cmd, cwd, env = self.__args
+        self.__recorder.record_exchange(cmd, cwd, env, exchange, exitcode)
+        return exitcode
+
+
+class _Replayer(object):
+    """Serves the commands recorded by L{_Recorder} from the file named
+    by $STGIT_REPLAY, without running them. Commands are matched on
+    their argument vector and input; repeated commands get the
+    recorded responses in order, and the last one is reused once
+    those run out."""
+
+    def __init__(self, filename):
+        self.__entries = {}
+        self.__lock = threading.Lock()
+        with io.open(filename, encoding='utf-8') as f:
+            for line in f:
+                e = json.loads(line)
+                key = self.__key(e['argv'], _unb64(e.get('stdin')))
+                self.__entries.setdefault(key, []).append(e)
+
+    @staticmethod
+    def __key(cmd, indata):
+        return (tuple(cmd), hashlib.sha1(indata or b'').hexdigest())
+
+    def process(self, cmd, indata):
+        """Return a L{_ReplayedProcess} for the command, or C{None} if it
+        wasn't recorded."""
+        with self.__lock:
+            entries = self.__entries.get(self.__key(cmd, indata))
+            if not entries:
+                return None
+            if len(entries) > 1:
+                return _ReplayedProcess(entries.pop(0))
+            return _ReplayedProcess(entries[0])
+
+
+class _ReplayedProcess(object):
+    """Stands in for a C{Popen} object while replaying."""
+
+    def __init__(self, entry):
+        self.pid = None
+        self.returncode = entry['exitcode']
+        self.__stdout = _unb64(entry.get('stdout'))
+        self.__stderr = _unb64(entry.get('stderr'))
+        self.__exchange = entry.get('exchange')
+        self.__stdin_f = self.__stdout_f = None
+        if self.__exchange is not None:
+            self.__start_exchange()
+
+    def __start_exchange(self):
+        """Feed the recorded output of a background process to our user
+        chunk by chunk, each as soon as the input that preceded it
+        when it was recorded has arrived."""
+        in_r, in_w = os.pipe()
+        out_r, out_w = os.pipe()
+        self.__stdin_f = os.fdopen(in_w, 'wb')
+        self.__stdout_f = os.fdopen(out_r, 'rb')
+
+        def feed():
+            try:
+                for direction, data in self.__exchange:
+                    data = _unb64(data)
+                    if direction == 'out':
+                        os.write(out_w, data)
+                        continue
+                    got = b''
+                    while len(got) < len(data):
+                        chunk = os.read(in_r, len(data) - len(got))
+                        if not chunk:
+                            return
+                        got += chunk
+                    if got != data:
+                        # Not what was recorded; all we can do is stop.
+                        return
+            except OSError:
+                pass
+            finally:
+                os.close(in_r)
+                os.close(out_w)
+
+        t = threading.Thread(target=feed)
+        t.daemon = True
+        t.start()
+
+    @property
+    def stdin(self):
+        if self.__stdin_f is None:
+            self.__stdin_f = io.open(os.devnull, 'wb')
+        return self.__stdin_f
+
+    @property
+    def stdout(self):
+        if self.__stdout_f is None:
+            self.__stdout_f = tempfile.TemporaryFile()
+            self.__stdout_f.write(self.__stdout)
+            self.__stdout_f.seek(0)
+        return self.__stdout_f
+
+    @property
+    def stderr(self):
+        return io.BytesIO(self.__stderr)
+
+    def communicate(self, indata=None):
+        return self.__stdout, self.__stderr
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        return self.returncode
+
+    def kill(self):
+        pass
+
+    terminate = kill
+
+
+if environ_get('STGIT_REPLAY'):
+    _recorder = None
+    _replayer = _Replayer(environ_get('STGIT_REPLAY'))
+elif environ_get('STGIT_RECORD'):
+    _recorder = _Recorder(environ_get('STGIT_RECORD'))
+    _replayer = None
+else:
+    _recorder = _replayer = None
+
+
+def get_budget(spec):
+    """Parse $STGIT_SUBPROCESS_BUDGET: an optional C{warn:} (the
+    default) or C{fail:} prefix, then a comma separated list of spawn
+    budgets -- a plain number for the total, and
+    C{I{subcommand}=I{number}} for a single git subcommand. A budget
+    prefixed with C{I{stg-command}:} only applies when that stg command
+    runs, in place of the one without a prefix. Return the action, and
+    a dict from the stg command (or C{None}) to its total budget and
+    its budgets per git subcommand."""
+    if not spec:
+        return (None, {})
+    action = 'warn'
+    for a in ['warn', 'fail']:
+        if spec.startswith(a + ':'):
+            action, spec = a, spec[len(a) + 1:]
+    budgets = {}
+    try:
+        for item in spec.split(','):
+            command = None
+            if ':' in item:
+                command, item = item.split(':', 1)
+                command = command.strip()
+            budget = budgets.setdefault(command, [None, {}])
+            if '=' in item:
+                name, n = item.split('=', 1)
+                budget[1]['git %s' % name.strip()] = int(n)
+            elif item.strip():
+                budget[0] = int(item)
+    except ValueError:
+        out.warn('Bad $STGIT_SUBPROCESS_BUDGET: "%s"' % spec,
+                 'Expected e.g. "fail:100,rev-parse=2,series:10"')
+        return (None, {})
+    return (action, budgets)
+
+
+_budget_action, _budgets = get_budget(
+    environ_get('STGIT_SUBPROCESS_BUDGET', ''))
+_budget_total, _budget_groups = _budgets.get(None, (None, {}))
+_budget_exceeded = False
+_spawns = {}
+_spawns_lock = threading.Lock()
+
+
+def _budget_breakdown():
+    total = sum(_spawns.values())
+    lines = ['%d subprocesses spawned%s' % (
+        total, '' if _budget_total is None
+        else ' (budget %d)' % _budget_total)]
+    for name, n in sorted(_spawns.items(), key=lambda x: (-x[1], x[0])):
+        budget = _budget_groups.get(name)
+        lines.append('  %s: %d%s' % (
+            name, n, '' if budget is None else ' (budget %d)' % budget))
+    return lines
+
+
+def _over_budget():
+    """Return what is over budget, if anything."""
+    over = []
+    if _budget_total is not None and sum(_spawns.values()) > _budget_total:
+        over.append('total')
+    for name, budget in sorted(_budget_groups.items()):
+        if _spawns.get(name, 0) > budget:
+            over.append(name)
+    return over
+
+
+def _count_spawn(cmd):
+    """Count a subprocess spawn, and fail if that makes us go over the
+    budget in $STGIT_SUBPROCESS_BUDGET in C{fail} mode."""
+    global _budget_action, _budget_exceeded
+    if not _budget_action:
+        return
+    with _spawns_lock:
+        group = trace_group(cmd)
+        _spawns[group] = _spawns.get(group, 0) + 1
+        over = _budget_action == 'fail' and _over_budget()
+        if over:
+            # Only fail once; whatever cleanup follows may spawn more.
+            _budget_action = None
+            _budget_exceeded = True
+            out.warn(*_budget_breakdown(), title='Subprocess budget')
+    if over:
+        raise SubprocessBudgetException(
+            'Subprocess budget exceeded: %s' % ', '.join(over))
+
+
+def set_budget_command(command):
+    """Apply the budgets in $STGIT_SUBPROCESS_BUDGET that are for the
+    stg command about to run."""
+    global _budget_total, _budget_groups
+    if command not in _budgets:
+        return
+    total, groups = _budgets[command]
+    if total is not None:
+        _budget_total = total
+    _budget_groups = dict(_budget_groups)
+    _budget_groups.update(groups)
+
+
+def budget_exceeded():
+    """Whether we have failed because of $STGIT_SUBPROCESS_BUDGET."""
+    return _budget_exceeded
+
+
+def _finish_budget():
+    if _budget_action == 'warn':
+        with _spawns_lock:
+            if _over_budget():
+                out.warn(*_budget_breakdown(), title='Subprocess budget')
+
+
+def default_jobs():
+    """Number of commands L{run_many} runs at the same time, unless
+    told otherwise."""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def run_many(runs, output=lambda r: r.raw_output(), jobs=None):
+    """Run independent L{Run} objects in parallel, with at most C{jobs}
+    of them running at any one time, and return the list of their
+    results in the same order as C{runs}. Each result is what
+    C{output} returns when called on a finished L{Run}; exceptions are
+    raised just like when the commands are run one after another."""
+    runs = list(runs)
+    jobs = max(jobs or default_jobs(), 1)
+    started = []
+    results = []
+    try:
+        for r in runs[:jobs]:
+            started.append(r.start())
+        for i, r in enumerate(runs):
+            results.append(output(r))
+            if i + jobs < len(runs):
+                started.append(runs[i + jobs].start())
+    finally:
+        # If one of them failed, wait for the others we started, so
+        # that none are left running behind our caller's back.
+        for r in started[len(results):]:
+            r.join()
+    return results
+
+
 class Run(object):
     exc = RunException
 
@@ -102,6 +612,7 @@ class Run(object):
         self.__in_encoding = 'utf-8'
         self.__out_encoding = 'utf-8'
         self.__discard_stderr = False
+        self.__thread = None
 
     def __prep_cmd(self):
         return [fsencode_utf8(c) for c in self.__cmd]
@@ -114,6 +625,10 @@ class Run(object):
             return self.__env
 
     def __log_start(self):
+        with _log_lock:
+            self.__log_start_locked()
+
+    def __log_start_locked(self):
         if _log_mode == 'debug':
             _logfile.start('Running subprocess %s' % self.__cmd)
             if self.__cwd is not None:
@@ -126,8 +641,14 @@ class Run(object):
         elif _log_mode == 'profile':
             _logfile.start('Running subprocess %s' % self.__cmd)
             self.__starttime = datetime.datetime.now()
+        elif _log_mode == 'trace':
+            self.__starttime = time.time()
 
-    def __log_end(self, retcode):
+    def __log_end(self, retcode, bytes_in=0, bytes_out=0):
+        with _log_lock:
+            self.__log_end_locked(retcode, bytes_in, bytes_out)
+
+    def __log_end_locked(self, retcode, bytes_in, bytes_out):
         global _log_subproctime, _log_starttime
         if _log_mode == 'debug':
             _logfile.done('return code: %d' % retcode)
@@ -138,6 +659,31 @@ class Run(object):
             _log_subproctime += d
             _logfile.info('Time since program start: %1.3f s'
                           % duration(_log_starttime, n))
+        elif _log_mode == 'trace':
+            _trace_span(self.__cmd, 'subprocess', self.__starttime, {
+                'cwd': self.__cwd or os.getcwd(),
+                'exitcode': retcode,
+                'bytes_in': bytes_in,
+                'bytes_out': bytes_out,
+            })
+
+    def exchange(self):
+        """Start timing one exchange of requests and responses with a
+        process started by L{run_background}. Returns a function to
+        call with the number of requests and of bytes sent and received
+        once the responses are read; in trace mode, it records the
+        exchange as a span of the command's own."""
+        if _log_mode != 'trace':
+            return lambda requests, bytes_in, bytes_out: None
+        starttime = time.time()
+
+        def done(requests, bytes_in, bytes_out):
+            _trace_span(self.__cmd, 'exchange', starttime, {
+                'requests': requests,
+                'bytes_in': bytes_in,
+                'bytes_out': bytes_out,
+            })
+        return done
 
     def __check_exitcode(self):
         if self.__good_retvals is None:
@@ -146,55 +692,112 @@ class Run(object):
             raise self.exc('%s failed with code %d'
                            % (self.__cmd[0], self.exitcode))
 
-    def __run_io(self):
-        """Run with captured IO."""
-        self.__log_start()
+    def __popen(self, captured=True):
+        _count_spawn(self.__cmd)
+        if _replayer:
+            p = _replayer.process(self.__cmd, self.__indata)
+            if p is None:
+                raise self.exc('%s: no recorded response to replay'
+                               % ' '.join(self.__cmd))
+            return p
+        if captured:
+            pipes = dict(stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+        else:
+            pipes = {}
+        try:
+            return subprocess.Popen(self.__prep_cmd(),
+                                    env=self.__prep_env(),
+                                    cwd=self.__cwd,
+                                    **pipes)
+        except OSError as e:
+            raise self.exc('%s failed: %s' % (self.__cmd[0], e))
+
+    def __record(self, outdata, errdata):
+        if _recorder:
+            _recorder.record(self.__cmd, self.__cwd, self.__env,
+                             self.__indata, outdata, errdata, self.exitcode)
+
+    def __communicate(self, p):
         try:
-            p = subprocess.Popen(self.__prep_cmd(),
-                                 env=self.__prep_env(),
-                                 cwd=self.__cwd,
-                                 stdin=subprocess.PIPE,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
             outdata, errdata = p.communicate(self.__indata)
             self.exitcode = p.returncode
         except OSError as e:
             raise self.exc('%s failed: %s' % (self.__cmd[0], e))
+        self.__log_end(self.exitcode, len(self.__indata or b''),
+                       len(outdata))
+        self.__record(outdata, errdata)
+        return outdata, errdata
+
+    def __run_io(self):
+        """Run with captured IO."""
+        if self.__thread is None:
+            self.__log_start()
+            outdata, errdata = self.__communicate(self.__popen())
+        else:
+            self.__thread.join()
+            self.__thread = None
+            if isinstance(self.__result, BaseException):
+                raise self.__result
+            outdata, errdata = self.__result
         if errdata and not self.__discard_stderr:
             out.err_bytes(errdata)
-            self.__log_end(self.exitcode)
         self.__check_exitcode()
         if self.__out_encoding:
             return outdata.decode(self.__out_encoding)
         else:
             return outdata
 
+    def start(self):
+        """Start running with captured IO, without waiting for the
+        command to finish. The output methods (L{raw_output},
+        L{output_lines}, etc.) then wait for it and return its output
+        as usual."""
+        assert self.__thread is None
+        self.__log_start()
+        p = self.__popen()
+
+        def communicate():
+            # Whatever goes wrong is raised again, in the caller's
+            # thread, by the output method that waits for us.
+            try:
+                self.__result = self.__communicate(p)
+            except BaseException as e:
+                self.__result = e
+
+        self.__thread = threading.Thread(target=communicate)
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def join(self):
+        """Wait for a command started with L{start} to finish, and throw
+        away its output and exit code."""
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+            self.__result = None
+
     def __run_noio(self):
         """Run without captured IO."""
         assert self.__indata is None
         self.__log_start()
+        p = self.__popen(captured=False)
         try:
-            p = subprocess.Popen(self.__prep_cmd(),
-                                 env=self.__prep_env(),
-                                 cwd=self.__cwd)
             self.exitcode = p.wait()
         except OSError as e:
             raise self.exc('%s failed: %s' % (self.__cmd[0], e))
         self.__log_end(self.exitcode)
+        self.__record(None, None)
         self.__check_exitcode()
 
     def run_background(self):
         """Run as a background process."""
         assert self.__indata is None
-        try:
-            p = subprocess.Popen(self.__prep_cmd(),
-                                 env=self.__prep_env(),
-                                 cwd=self.__cwd,
-                                 stdin=subprocess.PIPE,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-        except OSError as e:
-            raise self.exc('%s failed: %s' % (self.__cmd[0], e))
+        p = self.__popen()
+        if _recorder:
+            p = _recorder.background(p, self.__cmd, self.__cwd, self.__env)
         if self.__in_encoding:
             if hasattr(p.stdin, 'readable'):
                 self.stdin = io.TextIOWrapper(
@@ -208,6 +811,7 @@ class Run(object):
         self.stdout = p.stdout
         self.stderr = p.stderr
         self.wait = p.wait
+        self.terminate = p.terminate
         self.pid = lambda: p.pid
         return self
 
@@ -270,6 +874,77 @@ class Run(object):
         else:
             return []
 
+    def iter_lines(self, sep='\n'):
+        """Run with captured IO, and yield the lines of the output (like
+        L{output_lines}) as they are read from the pipe, without
+        holding the whole output in memory. Exit code errors are
+        raised once the output has been consumed."""
+        self.__log_start()
+        p = self.__popen()
+        errdata = []
+
+        def feed():
+            try:
+                if self.__indata:
+                    p.stdin.write(self.__indata)
+                p.stdin.close()
+            except (IOError, OSError):
+                pass  # the command quit without reading all its input
+
+        threads = [threading.Thread(target=feed),
+                   threading.Thread(target=lambda: errdata.append(
+                       p.stderr.read()))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        if self.__out_encoding:
+            decoder = codecs.getincrementaldecoder(self.__out_encoding)()
+            buf = ''
+        else:
+            decoder = None
+            buf = b''
+        bytes_out = 0
+        chunks = []
+        fd = p.stdout.fileno()
+        try:
+            while True:
+                data = os.read(fd, 65536)
+                if decoder:
+                    buf += decoder.decode(data, not data)
+                else:
+                    buf += data
+                if not data:
+                    break
+                bytes_out += len(data)
+                if _recorder:
+                    chunks.append(data)
+                lines = buf.split(sep)
+                buf = lines.pop()
+                for line in lines:
+                    yield line
+            if buf:
+                yield buf
+        finally:
+            if p.poll() is None:
+                # We were interrupted before reading all the output.
+                p.kill()
+            self.exitcode = p.wait()
+            p.stdout.close()
+            for t in threads:
+                t.join()
+        self.__log_end(self.exitcode, len(self.__indata or b''),
+                       bytes_out)
+        self.__record(b''.join(chunks), errdata[0])
+        if errdata[0] and not self.__discard_stderr:
+            out.err_bytes(errdata[0])
+        self.__check_exitcode()
+
+    def iter_records(self, sep='\n', fieldsep=None, maxsplit=-1):
+        """Like L{iter_lines}, but yield each line split into fields on
+        C{fieldsep} (whitespace by default)."""
+        for line in self.iter_lines(sep):
+            yield line.split(fieldsep, maxsplit)
+
     def output_one_line(self, sep='\n'):
         outlines = self.output_lines(sep)
         if len(outlines) == 1:
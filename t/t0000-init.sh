@@ -22,4 +22,15 @@ test_expect_success \
     'check stgit duplicated initialization' \
     'command_error stg init'
 
+test_expect_success \
+    'check an unborn branch is not taken for a detached HEAD in the git dir' '
+    git init unborn &&
+    (
+        cd unborn/.git &&
+        command_error stg init 2>err &&
+        grep "master: no such branch" err &&
+        ! grep "Not on any branch" err
+    )
+'
+
 test_done
@@ -0,0 +1,67 @@
+#!/bin/sh
+
+test_description='Test the $STGIT_SUBPROCESS_LOG modes and $STGIT_RECORD'
+
+. ./test-lib.sh
+
+test_expect_success 'Create some patches' '
+    stg init &&
+    for x in aaa bbb ccc; do
+        stg new -m patch-$x &&
+        echo "$x" >> foo.txt &&
+        stg add foo.txt &&
+        stg refresh
+    done
+'
+
+test_expect_success 'Trace mode writes trace events' '
+    STGIT_SUBPROCESS_LOG=trace:trace.json stg pop -a 2>summary.txt &&
+    "$PYTHON" -c "
+import json, sys
+events = json.load(open(\"trace.json\"))[\"traceEvents\"]
+assert events[0][\"name\"] == \"stg\", events[0]
+spans = [e for e in events if e[\"cat\"] == \"subprocess\"]
+assert spans, events
+for e in spans:
+    assert e[\"ph\"] == \"X\" and e[\"dur\"] >= 0, e
+    assert e[\"name\"] == \" \".join(e[\"args\"][\"argv\"][:2]), e
+    for k in [\"cwd\", \"exitcode\", \"bytes_in\", \"bytes_out\"]:
+        assert k in e[\"args\"], e
+exchanges = [e for e in events if e[\"cat\"] == \"exchange\"]
+for e in exchanges:
+    assert e[\"ph\"] == \"X\" and e[\"dur\"] >= 0, e
+    assert e[\"args\"][\"requests\"] > 0, e
+assert \"git cat-file\" in set(e[\"name\"] for e in exchanges)
+assert \"git update-ref\" in set(e[\"name\"] for e in exchanges)
+"
+'
+
+test_expect_success 'Trace mode prints a per-command summary' '
+    grep -E "^command +count +total +p50 +p99" summary.txt &&
+    grep -E "^git update-ref +[0-9]+ " summary.txt &&
+    grep -E "^git cat-file +[0-9]+ " summary.txt &&
+    grep -E "^\(python\) " summary.txt &&
+    grep -E "^total " summary.txt
+'
+
+test_expect_success 'Record and replay without running git' '
+    stg push -a &&
+    STGIT_RECORD=record.jsonl stg series -d >expected.txt &&
+    STGIT_RECORD=record-show.jsonl stg show patch-bbb >expected-show.txt &&
+    mkdir fakebin &&
+    printf "#!/bin/sh\nexit 1\n" >fakebin/git &&
+    chmod +x fakebin/git &&
+    PATH="$(pwd)/fakebin:$PATH" STGIT_REPLAY=record.jsonl \
+        stg series -d >output.txt &&
+    test_cmp expected.txt output.txt &&
+    PATH="$(pwd)/fakebin:$PATH" STGIT_REPLAY=record-show.jsonl \
+        stg show patch-bbb >output-show.txt &&
+    test_cmp expected-show.txt output-show.txt
+'
+
+test_expect_success 'Replay fails for commands that were not recorded' '
+    PATH="$(pwd)/fakebin:$PATH" STGIT_REPLAY=record.jsonl \
+        command_error stg show patch-aaa
+'
+
+test_done
@@ -0,0 +1,90 @@
+#!/bin/sh
+
+test_description='Test $STGIT_SUBPROCESS_BUDGET
+
+Check that the number of git processes some commands spawn does not
+grow (or grows only linearly) with the number of patches.'
+
+. ./test-lib.sh
+
+test_expect_success 'Initialize the StGit repository' '
+    echo base >base.txt &&
+    stg add base.txt &&
+    git commit -m base &&
+    stg init
+'
+
+test_expect_success 'Fail when going over the total budget' '
+    STGIT_SUBPROCESS_BUDGET=fail:1 command_error stg series 2>err.txt &&
+    grep "Subprocess budget exceeded: total" err.txt &&
+    grep "subprocesses spawned (budget 1)" err.txt
+'
+
+test_expect_success 'Fail when going over a subcommand budget' '
+    STGIT_SUBPROCESS_BUDGET=fail:for-each-ref=0 \
+        command_error stg series 2>err.txt &&
+    grep "Subprocess budget exceeded: git for-each-ref" err.txt &&
+    grep "git for-each-ref: 1 (budget 0)" err.txt
+'
+
+test_expect_success 'Budgets for one stg command' '
+    STGIT_SUBPROCESS_BUDGET=fail:series:1 command_error stg series \
+        2>err.txt &&
+    grep "Subprocess budget exceeded: total" err.txt &&
+    STGIT_SUBPROCESS_BUDGET=fail:series:1 stg id &&
+    STGIT_SUBPROCESS_BUDGET=fail:1,series:10 stg series &&
+    STGIT_SUBPROCESS_BUDGET=fail:series:for-each-ref=0 \
+        command_error stg series 2>err.txt &&
+    grep "git for-each-ref: 1 (budget 0)" err.txt
+'
+
+test_expect_success 'Only warn by default' '
+    STGIT_SUBPROCESS_BUDGET=1 stg series 2>err.txt &&
+    grep "subprocesses spawned (budget 1)" err.txt
+'
+
+test_expect_success 'Create 20 patches' '
+    for i in $(test_seq 20); do
+        stg new -m p$i &&
+        echo "$i" >f$i.txt &&
+        stg add f$i.txt &&
+        stg refresh || return 1
+    done
+'
+
+test_expect_success 'Series spawns a constant number of processes' '
+    STGIT_SUBPROCESS_BUDGET=fail:10 stg series &&
+    STGIT_SUBPROCESS_BUDGET=fail:10 stg series -d
+'
+
+test_expect_success 'Push spawns a linear number of processes' '
+    stg pop -a &&
+    echo more >>base.txt &&
+    git commit -a -m "change base" &&
+    # About 5 per patch: 102 in all when this was written.
+    STGIT_SUBPROCESS_BUDGET=fail:$((10 + 5 * 20)) stg push -a
+'
+
+test_expect_success 'Revisions are looked up without git rev-parse' '
+    STGIT_SUBPROCESS_BUDGET=fail:rev-parse=1 stg id p3^ >id.txt &&
+    test "$(cat id.txt)" = "$(git rev-parse refs/patches/master/p2)" &&
+    STGIT_SUBPROCESS_BUDGET=fail:rev-parse=1 command_error stg id nosuchrev
+'
+
+test_expect_success 'Pop and push write all refs in one update-ref' '
+    STGIT_SUBPROCESS_BUDGET=fail:update-ref=1 stg pop -a &&
+    STGIT_SUBPROCESS_BUDGET=fail:update-ref=1 stg push -a &&
+    test "$(stg series --applied -c)" = 20
+'
+
+test_expect_success 'Only the namespaces of the refs used are read' '
+    for i in $(test_seq 20); do
+        git tag t$i || return 1
+    done &&
+    STGIT_SUBPROCESS_LOG=debug:log.txt stg show p3 >/dev/null &&
+    grep "for-each-ref.*refs/patches/master/\*" log.txt &&
+    ! grep "show-ref" log.txt &&
+    ! grep "refs/tags/" log.txt
+'
+
+test_done
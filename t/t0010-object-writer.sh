@@ -0,0 +1,97 @@
+#!/bin/sh
+
+test_description='Test the in-process object writer (stgit.objectwriter)
+
+Build the same stack with git writing the objects, and with StGit
+writing them itself, and check that the objects are identical.'
+
+. ./test-lib.sh
+
+make_stack () {
+    git init -q "$1" &&
+    (
+        cd "$1" &&
+        if test -n "$2"; then git config stgit.objectwriter "$2"; fi &&
+        test_tick=1112911993 &&
+        GIT_COMMITTER_DATE="$test_tick -0700" &&
+        GIT_AUTHOR_DATE="$test_tick -0700" &&
+        export GIT_COMMITTER_DATE GIT_AUTHOR_DATE &&
+        echo base >base.txt &&
+        mkdir dir &&
+        echo sub >dir/sub.txt &&
+        git add base.txt dir/sub.txt &&
+        git commit -q -m base &&
+        stg init &&
+        for i in 1 2 3; do
+            test_tick &&
+            stg new -m "patch $i" &&
+            echo "$i" >>base.txt &&
+            echo "$i" >dir.txt &&
+            echo "$i" >dir/f$i.txt &&
+            stg add base.txt dir.txt dir/f$i.txt &&
+            stg refresh || return 1
+        done &&
+        test_tick &&
+        stg pop -a &&
+        echo more >>dir/sub.txt &&
+        git commit -q -a -m "change base" &&
+        test_tick &&
+        if test -n "$2"; then
+            budget=${3:-hash-object=0,mktree=0,commit-tree=0} &&
+            STGIT_SUBPROCESS_BUDGET=fail:$budget &&
+            export STGIT_SUBPROCESS_BUDGET
+        fi &&
+        stg push -a &&
+        # The stack log is left out, since the order of its parents
+        # is not fixed.
+        git for-each-ref --format="%(objectname) %(refname)" |
+            grep -v "refs/heads/master.stgit\$" >../refs-"$1"
+    )
+}
+
+test_expect_success 'Build a stack with git writing the objects' '
+    make_stack git
+'
+
+test_expect_success 'Loose objects are identical to those git writes' '
+    make_stack loose loose &&
+    test_cmp refs-git refs-loose &&
+    (cd loose && git fsck --strict)
+'
+
+test_expect_success 'Pack mode leaves no new loose objects behind' '
+    make_stack pack pack &&
+    test_cmp refs-git refs-pack &&
+    (
+        cd pack &&
+        git fsck --strict &&
+        git count-objects -v >before.txt &&
+        stg edit -m "new message" patch-2 &&
+        git count-objects -v >after.txt &&
+        test "$(grep "^count:" after.txt)" = "$(grep "^count:" before.txt)" &&
+        test "$(grep "^packs:" after.txt)" != "$(grep "^packs:" before.txt)"
+    )
+'
+
+test_expect_success 'Git writes the commits when ident config is set' '
+    test_when_finished "git config --global --unset user.name" &&
+    test_when_finished "git config --global --unset author.name" &&
+    test_when_finished "git config --global --unset committer.name" &&
+    git config --global user.name "U Ser" &&
+    git config --global author.name "Con Figured" &&
+    git config --global committer.name "Con Figured" &&
+    (
+        sane_unset GIT_AUTHOR_NAME GIT_COMMITTER_NAME &&
+        make_stack ident-git &&
+        make_stack ident-loose loose hash-object=0,mktree=0
+    ) &&
+    test_cmp refs-ident-git refs-ident-loose &&
+    (
+        cd ident-loose &&
+        git fsck --strict &&
+        test "$(git log -1 --pretty=format:%cn $(stg id patch-1))" = \
+            "Con Figured"
+    )
+'
+
+test_done
@@ -0,0 +1,69 @@
+#!/bin/sh
+
+test_description='Test the pack reader (stgit.packreader)
+
+Read a stack whose objects are all packed, with and without StGit
+reading the packs itself, and check that the output is the same, and
+that git cat-file is only run to look up the stack log (with
+--batch-check), not to read objects.'
+
+. ./test-lib.sh
+
+test_expect_success 'Initialize the StGit repository' '
+    for i in $(test_seq 20); do
+        test_seq $((i * 20)) >a.txt &&
+        echo "$i" >>b.txt &&
+        git add a.txt b.txt &&
+        git commit -q -m "commit $i" || return 1
+    done &&
+    stg init &&
+    for i in 1 2 3 4 5; do
+        stg new -m "patch $i" &&
+        echo "patch $i" >>a.txt &&
+        stg refresh || return 1
+    done
+'
+
+read_stack () {
+    stg series -d &&
+    stg show patch-3 &&
+    stg log -f &&
+    git log -p master.stgit
+}
+
+read_stack_in_budget () {
+    STGIT_SUBPROCESS_BUDGET=fail:cat-file=0 stg series -d &&
+    STGIT_SUBPROCESS_BUDGET=fail:cat-file=0 stg show patch-3 &&
+    STGIT_SUBPROCESS_BUDGET=fail:cat-file=1 stg log -f &&
+    git log -p master.stgit
+}
+
+test_expect_success 'Read a stack packed with offset deltas' '
+    git repack -a -d -f -q --depth=50 --window=50 &&
+    read_stack >expected.txt &&
+    git config stgit.packreader yes &&
+    read_stack_in_budget >actual.txt &&
+    git config --unset stgit.packreader &&
+    test_cmp expected.txt actual.txt
+'
+
+test_expect_success 'Read a stack packed with ref deltas' '
+    git config repack.usedeltabaseoffset false &&
+    git repack -a -d -f -q --depth=50 --window=50 &&
+    git config stgit.packreader yes &&
+    read_stack_in_budget >actual.txt &&
+    test_cmp expected.txt actual.txt
+'
+
+test_expect_success 'Fall back to git for loose objects' '
+    stg pop -a &&
+    stg push -a &&
+    test "$(git count-objects | sed "s/ .*//")" != 0 &&
+    stg undo &&
+    stg redo &&
+    stg series -d >series.txt &&
+    test "$(grep -c "patch" series.txt)" = 5 &&
+    git fsck
+'
+
+test_done
@@ -0,0 +1,57 @@
+#!/bin/sh
+
+test_description='Test stgit.run.run_many
+
+Check that commands run in parallel give their results in order, and
+that a failure is raised without leaving other commands running.'
+
+. ./test-lib.sh
+
+test_expect_success 'Results come back in the order of the commands' '
+    "$PYTHON" -c "
+from stgit.run import Run, run_many
+runs = [Run(\"sh\", \"-c\", \"sleep 0.%d; echo %d\" % (5 - i, i))
+        for i in range(5)]
+print(\" \".join(run_many(runs, lambda r: r.output_one_line(), jobs=3)))
+" >out.txt &&
+    echo "0 1 2 3 4" >expected.txt &&
+    test_cmp expected.txt out.txt
+'
+
+test_expect_success 'A failing command raises, after the others finish' '
+    "$PYTHON" -c "
+from stgit.run import Run, RunException, run_many
+runs = [Run(\"sh\", \"-c\", \"exit 1\"),
+        Run(\"sh\", \"-c\", \"sleep 1; echo done >slow.txt\"),
+        Run(\"sh\", \"-c\", \"echo never >late.txt\")]
+try:
+    run_many(runs, jobs=2)
+except RunException as e:
+    print(e)
+" >out.txt &&
+    echo "sh failed with code 1" >expected.txt &&
+    test_cmp expected.txt out.txt &&
+    echo done >expected.txt &&
+    test_cmp expected.txt slow.txt &&
+    test_path_is_missing late.txt
+'
+
+test_expect_success 'An error in the output function is raised too' '
+    "$PYTHON" -c "
+from stgit.run import Run, run_many
+def output(r):
+    raise ValueError(r.output_one_line())
+runs = [Run(\"echo\", \"first\"),
+        Run(\"sh\", \"-c\", \"sleep 1; echo done >slow-output.txt\")]
+try:
+    run_many(runs, output, jobs=2)
+except ValueError as e:
+    print(e)
+" >out.txt &&
+    echo first >expected.txt &&
+    test_cmp expected.txt out.txt &&
+    echo done >expected.txt &&
+    test_cmp expected.txt slow-output.txt
+'
+
+test_done
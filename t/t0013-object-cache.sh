@@ -0,0 +1,64 @@
+#!/bin/sh
+
+test_description='Test the limits of the object data cache
+
+Set small limits on the caches of a Repository, and check that the
+least recently used data is dropped, counted, and read again when it
+is needed.'
+
+. ./test-lib.sh
+
+test_expect_success 'Create some commits' '
+    for i in 1 2 3 4; do
+        echo "$i" >>file.txt &&
+        git add file.txt &&
+        git commit -q -m "commit $i" || return 1
+    done &&
+    git rev-list -4 HEAD >commits.txt
+'
+
+test_expect_success 'Evict the least recently used commits' '
+    "$PYTHON" -c "
+from stgit.lib.git import Repository
+repo = Repository.default()
+cache = repo.object_caches[\"commit\"]
+cache.max_entries = 2
+c = [repo.get_commit(l.strip()) for l in open(\"commits.txt\")]
+for commit in c:
+    commit.data
+s = cache.stats
+assert (s[\"entries\"], s[\"misses\"], s[\"evictions\"]) == (2, 4, 2), s
+assert c[3].data.message == \"commit 1\n\"
+s = cache.stats
+assert (s[\"hits\"], s[\"misses\"], s[\"evictions\"]) == (1, 4, 2), s
+assert c[0].data.message == \"commit 4\n\"
+s = cache.stats
+assert (s[\"hits\"], s[\"misses\"], s[\"evictions\"]) == (1, 5, 3), s
+assert not c[2].has_data and c[3].has_data and c[0].has_data
+assert c[0] is repo.get_commit(c[0].sha1)
+assert s[\"objects\"] == 5, s  # the fifth is the parent of c[3]
+"
+'
+
+test_expect_success 'Evict data when over the byte limit' '
+    "$PYTHON" -c "
+from stgit.lib.git import Repository
+repo = Repository.default()
+cache = repo.object_caches[\"blob\"]
+cache.max_bytes = 12
+blobs = [repo.get_commit(l.strip()).data.tree.data.entries[\"file.txt\"][1]
+         for l in open(\"commits.txt\")]
+sizes = [len(b.data.bytes) for b in blobs]
+assert sizes == [8, 6, 4, 2], sizes
+s = cache.stats
+assert s[\"bytes\"] == 12 and s[\"entries\"] == 3, s
+assert s[\"misses\"] == 4 and s[\"evictions\"] == 1, s
+assert blobs[0].data.bytes == b\"1\n2\n3\n4\n\"
+s = cache.stats
+assert s[\"bytes\"] == 10 and s[\"entries\"] == 2, s
+assert s[\"misses\"] == 5 and s[\"evictions\"] == 3, s
+assert cache.has_data(blobs[3].sha1) and not cache.has_data(blobs[1].sha1)
+"
+'
+
+test_done
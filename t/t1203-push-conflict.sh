@@ -41,6 +41,15 @@ test_expect_success \
 	conflict stg push foo
 	'
 
+test_expect_success \
+	'Only the stack log marks the push as conflicting' \
+	'
+	git reflog -1 --format=%gs refs/heads/master >msg &&
+	echo "push" >expected &&
+	test_cmp expected msg &&
+	stg log -n 1 | grep -q -e "push (CONFLICT)"
+	'
+
 test_expect_success \
 	'Show the, now empty, first patch' \
 	'
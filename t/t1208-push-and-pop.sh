@@ -138,4 +138,24 @@ test_expect_success \
     command_error stg push p99999 2>&1 | grep -e "Unknown patch name: p99999"
 '
 
+test_expect_success \
+    'A failed ref update leaves the series alone' '
+    applied="$(echo $(stg series --applied --noprefix))" &&
+    unapplied="$(echo $(stg series --unapplied --noprefix))" &&
+    head=$(git rev-parse HEAD) &&
+    touch .git/refs/heads/master.lock &&
+    command_error stg pop &&
+    command_error stg push &&
+    command_error stg new px -m px &&
+    rm .git/refs/heads/master.lock &&
+    [ "$(echo $(stg series --applied --noprefix))" = "$applied" ] &&
+    [ "$(echo $(stg series --unapplied --noprefix))" = "$unapplied" ] &&
+    [ "$(git rev-parse HEAD)" = "$head" ] &&
+    git diff --quiet HEAD &&
+    [ "$(stg id p7)" = "$head" ] &&
+    [ "$(cat .git/patches/master/patches/p7/top)" = "$head" ] &&
+    test_path_is_missing .git/patches/master/patches/px &&
+    test_must_fail git rev-parse --verify -q refs/patches/master/px
+'
+
 test_done
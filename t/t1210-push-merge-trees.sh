@@ -0,0 +1,247 @@
+#!/bin/sh
+
+test_description='Test pushing patches that have to be merged
+
+Push patches onto a base that has changed, and check that the merges
+that can be done at the tree level (changes to different files, or to
+the contents and the permissions of the same file) are done without
+running git apply, and that the others still work.'
+
+. ./test-lib.sh
+
+test_expect_success 'Initialize the StGit repository' '
+    mkdir dir other &&
+    test_seq 10 >dir/a.txt &&
+    echo b >dir/b.txt &&
+    echo c >other/c.txt &&
+    stg add dir other &&
+    git commit -m base &&
+    stg init
+'
+
+test_expect_success 'Create some patches' '
+    stg new -m p1 &&
+    sed "s/^2$/two/" dir/a.txt >a.tmp && mv a.tmp dir/a.txt &&
+    stg refresh &&
+    stg new -m p2 &&
+    echo new >dir/new.txt &&
+    stg add dir/new.txt &&
+    stg refresh &&
+    stg new -m p3 &&
+    test_chmod +x other/c.txt &&
+    stg refresh &&
+    stg new -m p4 &&
+    stg rm dir/b.txt &&
+    stg refresh &&
+    stg pop -a
+'
+
+test_expect_success 'Change the base' '
+    sed "s/^9$/nine/" dir/a.txt >a.tmp && mv a.tmp dir/a.txt &&
+    echo more >>other/c.txt &&
+    git commit -a -m "change base"
+'
+
+test_expect_success 'Only merge file contents with git apply' '
+    # One git mktree for the new trees of each of the three merges
+    # done at the tree level, and four for the stack log.
+    STGIT_SUBPROCESS_BUDGET=fail:apply=1,merge-file=0,mktree=7 stg push -a &&
+    test "$(echo $(stg series --applied --noprefix))" = "p1 p2 p3 p4" &&
+    test "$(echo $(cat dir/a.txt))" = "1 two 3 4 5 6 7 8 nine 10" &&
+    test "$(echo $(cat other/c.txt))" = "c more" &&
+    test "$(echo $(ls dir))" = "a.txt new.txt" &&
+    test "$(git ls-files -s other/c.txt | cut -c1-6)" = 100755 &&
+    test -z "$(stg status)"
+'
+
+test_expect_success 'Push a patch that conflicts' '
+    stg pop -a &&
+    sed "s/^2$/TWO/" dir/a.txt >a.tmp && mv a.tmp dir/a.txt &&
+    git commit -a -m "change base again" &&
+    conflict stg push p1 &&
+    test "$(echo $(stg status))" = "UU dir/a.txt" &&
+    stg undo --hard
+'
+
+test_expect_success 'Push a patch that changes a file deleted in the base' '
+    git rm -q dir/a.txt &&
+    git commit -m "delete a.txt" &&
+    conflict stg push p1 &&
+    test "$(echo $(stg status))" = "DU dir/a.txt"
+'
+
+# StGit only merges with git merge-tree if it takes trees for
+# --merge-base, which it does since git 2.45.
+test_lazy_prereq MERGE_TREE_TREES '
+    git version | {
+        IFS=" ." read git version major minor rest &&
+        test "$major" -gt 2 || { test "$major" = 2 && test "$minor" -ge 45; }
+    } &&
+    t=$(git rev-parse HEAD^{tree}) &&
+    git merge-tree --write-tree -z --merge-base=$t $t $t
+'
+
+test_have_prereq MERGE_TREE_TREES ||
+say "$(git version) can't merge trees with merge-tree; skipping the tests of that backend"
+
+test_expect_success MERGE_TREE_TREES 'Push a patch onto a base that renamed its file' '
+    stg undo --hard &&
+    stg new -m p5 &&
+    echo "p5" >>other/c.txt &&
+    stg refresh &&
+    stg pop &&
+    git mv other/c.txt other/d.txt &&
+    git commit -m "rename c.txt" &&
+    STGIT_SUBPROCESS_BUDGET=fail:apply=0,merge-recursive=0 stg push p5 &&
+    test "$(echo $(cat other/d.txt))" = "c more p5" &&
+    test ! -e other/c.txt &&
+    test -z "$(stg status)"
+'
+
+test_expect_success MERGE_TREE_TREES 'Push a patch that conflicts with git merge-tree' '
+    stg new -m p6 &&
+    echo "p6" >>other/d.txt &&
+    stg refresh &&
+    stg pop -a &&
+    echo "base" >>other/d.txt &&
+    git commit -a -m "change d.txt" &&
+    STGIT_SUBPROCESS_BUDGET=fail:apply=0,merge-recursive=0 \
+        conflict stg push p6 &&
+    test "$(echo $(stg status))" = "UU other/d.txt"
+'
+
+test_expect_success 'Push with a temporary index if asked to' '
+    stg undo --hard &&
+    echo e >e.txt &&
+    git add e.txt &&
+    git commit -m "add e.txt" &&
+    stg new -m p7 &&
+    echo p7 >>e.txt &&
+    stg refresh &&
+    stg pop &&
+    echo base >>e.txt &&
+    git commit -a -m "change e.txt" &&
+    git config stgit.mergebackend index &&
+    STGIT_SUBPROCESS_BUDGET=fail:merge-tree=0 conflict stg push p7 &&
+    test "$(echo $(stg status))" = "UU e.txt" &&
+    git config --unset stgit.mergebackend
+'
+
+test_expect_success POSIXPERM 'Push with a sparse temporary index' '
+    stg undo --hard &&
+    test_seq 5 >f.txt &&
+    git add f.txt &&
+    git commit -m "add f.txt" &&
+    stg new -m p8 &&
+    chmod +x f.txt &&
+    sed "s/^1$/one/" f.txt >tmp && cat tmp >f.txt && rm tmp &&
+    stg refresh &&
+    stg pop &&
+    chmod +x f.txt &&
+    sed "s/^5$/five/" f.txt >tmp && cat tmp >f.txt && rm tmp &&
+    git commit -a -m "change f.txt" &&
+    git config stgit.mergebackend index &&
+    git config stgit.tempindex sparse &&
+    STGIT_SUBPROCESS_BUDGET=fail:write-tree=0 stg push p8 &&
+    git config --unset stgit.tempindex &&
+    git config --unset stgit.mergebackend &&
+    test "$(echo $(cat f.txt))" = "one 2 3 4 five" &&
+    test "$(git ls-files -s f.txt | cut -c1-6)" = 100755 &&
+    test "$(echo $(ls))" = "dir e.txt f.txt other" &&
+    test -z "$(stg status)"
+'
+
+test_expect_success 'Push when git merge-tree will not merge trees' '
+    stg undo --hard &&
+    mkdir fakegit &&
+    write_script fakegit/git <<-EOF &&
+	test "\$1" = version && echo "git version 2.44.0" && exit 0
+	exec "$(command -v git)" "\$@"
+	EOF
+    echo x >x.txt &&
+    git add x.txt &&
+    git commit -m "add x.txt" &&
+    stg new -m p9 &&
+    echo p9 >>x.txt &&
+    stg refresh &&
+    stg pop &&
+    echo base >>x.txt &&
+    git commit -a -m "change x.txt" &&
+    PATH="$(pwd)/fakegit:$PATH" STGIT_SUBPROCESS_BUDGET=fail:merge-tree=0 \
+        conflict stg push p9 &&
+    test "$(echo $(stg status x.txt))" = "UU x.txt" &&
+    stg undo --hard &&
+    rm -r fakegit
+'
+
+test_expect_success 'Merge file contents with the gitattributes merge driver' '
+    test_seq 10 >m.txt &&
+    echo "m.txt merge=keep" >.gitattributes &&
+    git add m.txt .gitattributes &&
+    git commit -m "add m.txt" &&
+    git config merge.keep.driver true &&
+    stg new -m p11 &&
+    sed "s/^2$/two/" m.txt >tmp && cat tmp >m.txt && rm tmp &&
+    stg refresh &&
+    stg pop &&
+    sed "s/^5$/five/" m.txt >tmp && cat tmp >m.txt && rm tmp &&
+    git commit -a -m "change m.txt" &&
+    stg push p11 &&
+    test "$(echo $(cat m.txt))" = "1 2 3 4 five 6 7 8 9 10" &&
+    test -z "$(stg status)" &&
+    stg pop &&
+    git config --unset merge.keep.driver
+'
+
+test_lazy_prereq MERGE_TREE_COMMITS '
+    git merge-tree --write-tree -z HEAD HEAD
+'
+
+test_expect_success MERGE_TREE_COMMITS 'Check out the conflicts git merge-tree found' '
+    mkdir fakegit &&
+    write_script fakegit/git <<-EOF &&
+	git="$(command -v git)"
+	case "\$1 \$2 \$3 \$4" in
+	"version   ")
+	    echo "git version 2.45.0"
+	    exit 0
+	    ;;
+	"merge-tree --write-tree -z --merge-base="*)
+	    # Merge the trees as the tips of commits with the given base.
+	    b=\$(echo base | "\$git" commit-tree "\${4#--merge-base=}") &&
+	    o=\$(echo ours | "\$git" commit-tree -p \$b "\$5") &&
+	    t=\$(echo theirs | "\$git" commit-tree -p \$b "\$6") &&
+	    exec "\$git" merge-tree --write-tree -z \$o \$t
+	    ;;
+	esac
+	exec "\$git" "\$@"
+	EOF
+    echo y >y.txt &&
+    echo q >"q\"q.txt" &&
+    git add y.txt "q\"q.txt" &&
+    git commit -m "add y.txt" &&
+    stg new -m p10 &&
+    echo p10 >>y.txt &&
+    echo p10 >>"q\"q.txt" &&
+    stg refresh &&
+    stg pop &&
+    echo base >>y.txt &&
+    echo base >>"q\"q.txt" &&
+    git commit -a -m "change y.txt" &&
+    PATH="$(pwd)/fakegit:$PATH" \
+        STGIT_SUBPROCESS_BUDGET=fail:apply=0,merge-recursive=0 \
+        conflict stg push p10 2>err &&
+    test "$(echo $(stg status y.txt))" = "UU y.txt" &&
+    git ls-files -u y.txt >unmerged &&
+    test_line_count = 3 unmerged &&
+    git ls-files -u "q\"q.txt" >unmerged &&
+    test_line_count = 3 unmerged &&
+    grep "Merge conflict in q\"q.txt" err &&
+    grep "^<<<<<<<" y.txt &&
+    grep "^p10$" y.txt &&
+    grep "^p10$" "q\"q.txt" &&
+    stg undo --hard &&
+    rm -r fakegit
+'
+
+test_done
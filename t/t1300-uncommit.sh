@@ -114,6 +114,12 @@ test_expect_success \
   stg commit --all
   '
 
+test_expect_success 'Uncommit one patch without listing the commits' '
+  STGIT_SUBPROCESS_BUDGET=fail:rev-list=0 stg uncommit &&
+  [ "$(echo $(stg series --applied --noprefix))" = "bar-patch" ] &&
+  stg commit --all
+'
+
 test_expect_success 'Attempt to reuse patch name' '
   stg uncommit &&
   [ "$(echo $(stg series --applied --noprefix))" = "bar-patch" ] &&
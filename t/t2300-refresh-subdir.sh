@@ -72,4 +72,13 @@ test_expect_success 'refresh an unapplied patch' '
     test "$(echo $(stg files p1))" = "A bar/baz.txt M foo.txt"
 '
 
+test_expect_success 'refresh in a subdirectory finds the repository once' '
+    echo xyzzy >> bar/bar.txt &&
+    (
+        cd bar &&
+        STGIT_SUBPROCESS_BUDGET=fail:rev-parse=1,symbolic-ref=0 stg refresh
+    ) &&
+    test "$(stg status)" = ""
+'
+
 test_done
@@ -168,6 +168,13 @@ test_expect_success 'Test annotate' '
     stg log -f | grep -e "My Annotation"
 '
 
+test_expect_success 'Refresh checks the index and worktree with one git status' '
+    echo more >> foo2.txt &&
+    STGIT_SUBPROCESS_BUDGET=fail:status=2,diff-index=0,ls-files=0 \
+        stg refresh &&
+    test -z "$(stg status)"
+'
+
 test_expect_success 'Attempt refresh with open conflict' '
     stg new -m p6 &&
     echo "foo" > conflicting.txt &&
@@ -183,4 +190,89 @@ test_expect_success 'Attempt refresh with open conflict' '
     grep -e "resolve conflicts first"
 '
 
+test_expect_success 'Find the open conflict in the index file' '
+    test_when_finished "git config --unset stgit.indexreader" &&
+    git config stgit.indexreader yes &&
+    STGIT_SUBPROCESS_BUDGET=fail:ls-files=0 command_error stg refresh 2>&1 |
+    grep -e "resolve conflicts first"
+'
+
+test_expect_success 'Refresh an unapplied patch on a root commit' '
+    git init root &&
+    (
+        cd root &&
+        echo a >a.txt &&
+        git add a.txt &&
+        git commit -m root &&
+        stg init &&
+        stg new -m r1 &&
+        echo b >b.txt &&
+        stg add b.txt &&
+        stg refresh &&
+        stg pop -a &&
+        echo c >c.txt &&
+        stg add c.txt &&
+        stg refresh -p r1 &&
+        test "$(echo $(stg files r1))" = "A b.txt A c.txt"
+    )
+'
+
+# With git status out of the way, whether the index is clean can only
+# come from the cache-tree in the index file, or from git diff-index.
+test_expect_success 'Setup a stack with the index reader and no git status' '
+    git init ctree &&
+    (
+        cd ctree &&
+        echo a >a.txt &&
+        git add a.txt &&
+        git commit -m a &&
+        stg init &&
+        stg new -m c1 &&
+        echo b >b.txt &&
+        stg add b.txt &&
+        stg refresh &&
+        git config stgit.indexreader yes
+    ) &&
+    mkdir fakegit &&
+    write_script fakegit/git <<-EOF
+	test "\$1" = status && exit 128
+	exec "$(command -v git)" "\$@"
+	EOF
+'
+
+test_expect_success 'Check a clean index with its cache-tree' '
+    (
+        cd ctree &&
+        PATH="$TRASH_DIRECTORY/fakegit:$PATH" \
+            STGIT_SUBPROCESS_BUDGET=fail:diff-index=0 stg pop &&
+        stg push &&
+        test "$(echo $(stg series))" = "> c1"
+    )
+'
+
+test_expect_success 'Check a clean index with an invalidated cache-tree' '
+    (
+        cd ctree &&
+        echo more >>a.txt &&
+        git add a.txt &&
+        git checkout HEAD -- a.txt &&
+        PATH="$TRASH_DIRECTORY/fakegit:$PATH" \
+            STGIT_SUBPROCESS_BUDGET=fail:diff-index=1 stg pop &&
+        stg push &&
+        test "$(echo $(stg series))" = "> c1"
+    )
+'
+
+test_expect_success 'Check a dirty index with an invalidated cache-tree' '
+    (
+        cd ctree &&
+        echo more >>a.txt &&
+        git add a.txt &&
+        PATH="$TRASH_DIRECTORY/fakegit:$PATH" \
+            command_error stg pop 2>&1 |
+        grep -e "Index not clean" &&
+        test "$(echo $(stg series))" = "> c1"
+    )
+'
+
 test_done
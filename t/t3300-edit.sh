@@ -162,6 +162,19 @@ test_expect_success 'Edit patch diff' '
 '
 rm -f diffedit
 
+write_script diffedit <<EOF
+sed 's/111YY/111Yy/' "\$1" > "\$1".tmp && mv "\$1".tmp "\$1"
+EOF
+test_expect_success 'Edit patch diff with a sparse temporary index' '
+    git config stgit.tempindex sparse &&
+    EDITOR=./diffedit STGIT_SUBPROCESS_BUDGET=fail:write-tree=0 \
+        stg edit -d p2 &&
+    git config --unset stgit.tempindex &&
+    test "$(grep 111 foo)" = "111Yy" &&
+    test "$(git ls-files)" = "foo"
+'
+rm -f diffedit
+
 test_expect_success 'Sign a patch' '
     m=$(msg HEAD) &&
     stg edit --sign p2 &&
@@ -222,6 +235,61 @@ test_expect_success 'Set author date to "now"' '
     printf "$before\n$(adate HEAD)\n$after\n" | sort -c -
 '
 
+test_expect_success 'Set author date (ISO 8601 format with T and Z)' '
+    stg edit p2 --authdate "2013-01-28T22:30:00Z" &&
+    test "$(adate HEAD)" = "2013-01-28 22:30:00 +0000"
+'
+
+test_expect_success 'Set author date (seconds since the epoch)' '
+    stg edit p2 --authdate "@1359415800 -0300" &&
+    test "$(adate HEAD)" = "2013-01-28 20:30:00 -0300"
+'
+
+test_expect_success 'Parse dates without running git var or date' '
+    STGIT_SUBPROCESS_LOG=debug:log.txt \
+        stg edit p2 --authdate "2 days ago" &&
+    test "$(adate HEAD)" != "2013-01-28 20:30:00 -0300" &&
+    STGIT_SUBPROCESS_LOG=debug:log.txt stg edit p2 --authdate now &&
+    ! grep -E "u?.var.,|\[u?.date.," log.txt
+'
+
+test_expect_success 'Parse mail dates with zone names and comments' '
+    STGIT_SUBPROCESS_BUDGET=fail:var=0 \
+        stg edit p2 --authdate "Tue, 5 Mar 2019 10:00:00 -0800 (PST)" &&
+    test "$(adate HEAD)" = "2019-03-05 10:00:00 -0800" &&
+    STGIT_SUBPROCESS_BUDGET=fail:var=0 \
+        stg edit p2 --authdate "Tue, 5 Mar 2019 10:00:00 EDT" &&
+    test "$(adate HEAD)" = "2019-03-05 10:00:00 -0400"
+'
+
+test_expect_success 'Parse dates in git'"'"'s default format' '
+    STGIT_SUBPROCESS_BUDGET=fail:var=0 \
+        stg edit p2 --authdate "Thu Apr 7 22:13:13 2005 +0200" &&
+    test "$(adate HEAD)" = "2005-04-07 22:13:13 +0200" &&
+    STGIT_SUBPROCESS_BUDGET=fail:var=0 \
+        stg edit p2 --authdate "$(git log -1 --pretty=format:%ad $(stg id p4))" &&
+    test "$(adate HEAD)" = "$(adate $(stg id p4))"
+'
+
+test_expect_success 'Ask git var and date about the dates we do not parse' '
+    STGIT_SUBPROCESS_LOG=debug:log.txt \
+        stg edit p2 --authdate "7 April 2005 12:00 +0200" &&
+    test "$(adate HEAD)" = "2005-04-07 12:00:00 +0200" &&
+    grep -E "u?.var.," log.txt &&
+    ! grep -E "\[u?.date.," log.txt &&
+    STGIT_SUBPROCESS_LOG=debug:log.txt \
+        stg edit p2 --authdate "yesterday 12:00" &&
+    adate HEAD | grep -e "^$(date -d yesterday +%F) 12:00:00 " &&
+    grep -E "\[u?.date.," log.txt
+'
+
+test_expect_success 'Time zones with and without a colon are the same' '
+    stg edit p2 --authdate "2013-01-28 22:30:00 -03:00" &&
+    test "$(adate HEAD)" = "2013-01-28 22:30:00 -0300" &&
+    stg edit p2 --authdate "@1359415800 -03:00" &&
+    test "$(adate HEAD)" = "2013-01-28 20:30:00 -0300"
+'
+
 test_expect_success 'Set patch tree' '
     p2tree=$(git log -1 --pretty=format:%T $(stg id p2)) &&
     p4commit=$(stg id p4) &&
@@ -47,4 +47,55 @@ test_expect_success 'refresh with config' '
    [ "$(stg status)" = "" ]
 '
 
+test_expect_success 'refresh finds submodules without listing the tree' '
+  stg new p2 -m p2 &&
+  (
+    cd foo &&
+    touch file4 &&
+    git add file4 &&
+    git commit -m "another change in submodule"
+  ) &&
+  echo file3 >file3 &&
+  git add file3 &&
+  STGIT_SUBPROCESS_BUDGET=fail:ls-tree=0 stg refresh --no-submodules &&
+  test -s .git/stgit-submodules &&
+  echo more >>file3 &&
+  STGIT_SUBPROCESS_BUDGET=fail:ls-tree=0 stg refresh --no-submodules &&
+  [ "$(stg status)" = " M foo" ] &&
+  [ "$(stg files)" = "A file3" ]
+'
+
+test_expect_success 'untracked files do not make a submodule changed' '
+  stg refresh --submodules &&
+  touch foo/untracked &&
+  command_error stg patches 2>err &&
+  grep -e "No files specified or no local changes" err
+'
+
+test_expect_success 'a held lock leaves the submodule cache alone' '
+  cp .git/stgit-submodules cache-before &&
+  touch .git/stgit-submodules.lock &&
+  stg new p3 -m p3 &&
+  echo file5 >file5 &&
+  git add file5 &&
+  stg refresh --no-submodules &&
+  rm .git/stgit-submodules.lock &&
+  test_cmp cache-before .git/stgit-submodules &&
+  [ "$(stg files)" = "A file5" ]
+'
+
+test_expect_success 'each worktree has its own submodule cache' '
+  git worktree add -b other wt &&
+  (
+    cd wt &&
+    stg init &&
+    stg new q1 -m q1 &&
+    echo file6 >file6 &&
+    git add file6 &&
+    stg refresh --no-submodules
+  ) &&
+  test -s .git/worktrees/wt/stgit-submodules &&
+  test_cmp cache-before .git/stgit-submodules
+'
+
 test_done